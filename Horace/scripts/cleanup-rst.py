@@ -7,12 +7,18 @@ import sys
 import re
 import argparse
 import os.path
+import hashlib
+import json
+from concurrent.futures import ProcessPoolExecutor
 
 
 _parser = argparse.ArgumentParser(description='Convert source rst from pandoc to SPHINX standard', add_help=True)
 _parser.add_argument('--input', '-i', help="Input file")
 _parser.add_argument('--output', '-o', help="Output directory")
 _parser.add_argument('--debug', action="store_true")
+_parser.add_argument('--jobs', '-j', type=int,
+                     help="Convert pages in parallel with this many processes, "
+                     "only rewriting pages whose source changed since the last run")
 
 argList = _parser.parse_args()
 if not argList.input:
@@ -40,42 +46,96 @@ TABLE_START_RE = re.compile(r"{\\?\|")
 TABLE_END_RE = re.compile(r"\|}")
 IMAGE_RE = re.compile(r"\\ `(?P<size>[0-9]+px)\s*(\s|\|)\s*(?P<label>[^<]+)<image:(?P<path>[^>]+)>`__")
 NL_RE = re.compile(r"\n")
-ANY_MATCH_RE = re.compile("|".join(map(lambda r: r.pattern, (
-    NEWPAGE_RE,
-    TITLE_RE,
-    SUBTITLE_RE,
-    MINORTITLE_RE,
-    LIST_RE,
-    LITERAL_BLOCK_RE,
-    TABLE_START_RE,
-    IMAGE_RE,
-    NL_RE,))))
+# Tokens in order of precedence; the kind of a match is its outer group name
+TOKENS = (
+    ("NEWPAGE", NEWPAGE_RE),
+    ("TITLE", TITLE_RE),
+    ("SUBTITLE", SUBTITLE_RE),
+    ("MINORTITLE", MINORTITLE_RE),
+    ("LIST", LIST_RE),
+    ("LITERAL_BLOCK", LITERAL_BLOCK_RE),
+    ("TABLE_START", TABLE_START_RE),
+    ("IMAGE", IMAGE_RE),
+    ("NL", NL_RE),
+)
+
+
+def _token_re(tokens):
+    """ Combine token REs into one, with anchors dropped so it can be used at any position """
+    return re.compile("|".join(f"(?P<{kind}>{regex.pattern.lstrip('^')})" for kind, regex in tokens))
+
+
+# Any token, matched at the start of the unconverted text
+ANY_MATCH_RE = _token_re(TOKENS)
+# Tokens which may also start later in the text
+FLOATING_MATCH_RE = _token_re([(kind, regex) for kind, regex in TOKENS if not regex.pattern.startswith("^")])
+# Tokens can only start this far back when text is appended, see main
+CARRY_RE = re.compile(r"\w*\s*\Z")
+IMAGE_START = "\\ `"
+# End of line slash and non-escaped *
+EOL_SLASH_RE = re.compile(r"(?<!\\)\\$")
+STAR_RE = re.compile(r"(?<!\\)\*")
 
 
 RST_EXT = ".rst"
 HTML_EXT = ".html"
 MAKE_COMMAND = "rst2html.py"
 
-MAKE_FILE = open(argList.output+"/"+"make.sh", 'w')
-print(r"#!/bin/bash", file=MAKE_FILE)
+MAKE_FILE = None
+# Source hash and pages of each chunk, and the chunk each page was written
+# from, at the last parallel conversion
+MANIFEST = ".cleanup-rst-manifest.json"
+
+
+def page_header(filename):
+    """ Title at the start of a page """
+    nameLen = len(filename)
+    return "#"*nameLen + "\n" + filename + "\n" + "#"*nameLen + "\n\n"
 
 
 def new_file(fp, filename):
     """ Open a new file """
     fp = open(argList.output+"/"+filename+RST_EXT, 'w')
-    nameLen = len(filename)
     print(f"{MAKE_COMMAND} {filename+RST_EXT} > {filename+HTML_EXT}", file=MAKE_FILE)
-    print("#"*nameLen, file=fp)
-    print(filename, file=fp)
-    print("#"*nameLen, file=fp)
-    print(file=fp)
+    fp.write(page_header(filename))
     print(f"STATUS: Parsing {filename}")
     return fp
 
 
+def format_line(*args):
+    """ Line of output (no unicode) """
+    return " ".join(arg.encode('latin-1').decode('latin-1') for arg in args) + "\n"
+
+
 def output(*args):
-    """ Print to file (no unicode) """
-    print(*map(lambda x: x.encode('latin-1').decode('latin-1'), args), file=OUTFILE)
+    """ Print to file (no unicode), buffered until flush_output """
+    if OUTFILE is None:
+        sys.stdout.write(format_line(*args))
+    else:
+        OUTPUT.append(format_line(*args))
+
+
+def flush_output():
+    """ Write buffered output to the current file """
+    if OUTPUT:
+        OUTFILE.write("".join(OUTPUT))
+        OUTPUT.clear()
+
+
+REPLACEMENTS = str.maketrans({
+    u"\u2212": "-",
+    u"\u2013": "--",
+    u"\u2014": "---",
+    u"\u2026": "...",
+    u"\u201c": "\"",
+    u"\u201d": "\"",
+    u"\u2018": "'",
+    u"\u2019": "'",
+    u"\u2009": " ",
+    u"\u0127": "h-bar",
+    u"\u03b1": "alpha",
+    u"\u03bc": "mu",
+})
 
 
 def standard_replace(string: str, newline=True):
@@ -83,23 +143,11 @@ def standard_replace(string: str, newline=True):
     indent = re.match(r"^\s*", string)
     if newline:
         string = string.replace(r"\n", "\n"+" "*(indent.end() - indent.start()))
-    string = string.replace(u"\u2212", "-")
-    string = string.replace(u"\u2013", "--")
-    string = string.replace(u"\u2014", "---")
-    string = string.replace(u"\u2026", "...")
-    string = string.replace(u"\u201c", "\"")
-    string = string.replace(u"\u201d", "\"")
-    string = string.replace(u"\u2018", "'")
-    string = string.replace(u"\u2019", "'")
-    string = string.replace(u"\u2009", " ")
-
-    string = string.replace(u"\u0127", "h-bar")
-    string = string.replace(u"\u03b1", "alpha")
-    string = string.replace(u"\u03bc", "mu")
+    string = string.translate(REPLACEMENTS)
     return string
 
 
-def print_table(table):
+def print_table(table, output=output):
     """ Print a table in rst format """
     maxCols = max([len(row) for row in table])
     if maxCols == 1:
@@ -154,169 +202,389 @@ def print_table(table):
 
 
 OUTFILE = None
+OUTPUT = []
 
 
-def main(filename):
-    """ Perform the main conversion """
-    global OUTFILE
+def next_token(line, pos, start):
+    """ First token in line[pos:], which cannot start before start unless at pos """
+    match = ANY_MATCH_RE.match(line, pos)
+    if match is None:
+        match = FLOATING_MATCH_RE.search(line, max(pos, start))
+    return match
 
-    def next_line(newline=True):
-        for line in inFile:
-            val = line.rstrip('\n')
-            break
-        else:
-            return None
-        return standard_replace(val, newline)
 
-    with open(filename, 'r', encoding="utf8") as inFile:
-        line = next_line()
-        while inFile:
-            # Reached a newline
-            match = ANY_MATCH_RE.search(line)
-            while match:
-                if NEWPAGE_RE.search(line) and match.group() == NEWPAGE_RE.search(line).group():
-                    if DEBUG:
-                        print("newpage", match)
-                    title = match.group('title').strip()
-                    output(line[:match.start()])
-                    if OUTFILE is not None:
-                        OUTFILE.close()
-                    OUTFILE = new_file(OUTFILE, title)
-                    line = line[match.end():]
-                elif TITLE_RE.search(line) and match.group() == TITLE_RE.search(line).group():
-                    if DEBUG:
-                        print("title", match)
-                    title = match.group('subtitle').strip()
-                    output(line[:match.start()])
-                    output(title)
-                    output("*"*len(title))
-                    output()
-                    line = line[match.end():]
-                elif SUBTITLE_RE.search(line) and match.group() == SUBTITLE_RE.search(line).group():
-                    if DEBUG:
-                        print("subtitle", match)
-                    title = match.group('subsubtitle').strip()
-                    output(line[:match.start()])
-                    output(title)
-                    output("="*len(title))
-                    output()
-                    line = line[match.end():]
-
-                elif MINORTITLE_RE.search(line) and match.group() == MINORTITLE_RE.search(line).group():
-                    if DEBUG:
-                        print("minortitle", match)
-                    title = match.group('minortitle').strip()
-                    output(line[:match.start()])
-                    output(title)
-                    output("-"*len(title))
-                    output()
-                    line = line[match.end():]
-
-                elif LIST_RE.search(line) and match.group() == LIST_RE.search(line).group():
-                    if DEBUG:
-                        print("list", match)
-
-                    matchGroup = match.group()
-                    line = line.replace(matchGroup, "   "*(matchGroup.count('*')-1)+"- ", 1)
-
-                elif LITERAL_BLOCK_RE.search(line) and match.group() == LITERAL_BLOCK_RE.search(line).group():
-                    if DEBUG:
-                        print("literal", match)
-                    output(line[:match.start()])
-                    output("::")
-                    line = line[match.end():]
-
-                elif TABLE_START_RE.search(line) and match.group() == TABLE_START_RE.search(line).group():
-                    if DEBUG:
-                        print("table", match)
-                    output(line[:match.start()])
-                    line = line[match.start():]
-                    endmatch = TABLE_END_RE.search(line)
-                    while not endmatch:
-                        nextLine = next_line()
-                        if nextLine is None:
-                            raise IOError('Table never closed')
-                        if line:
-                            line += " " + nextLine
-                        else:
-                            line = nextLine
-                        endmatch = TABLE_END_RE.search(line)
-
-                    tableData = line[:endmatch.end()]
-                    row = []
-                    data = []
-                    for tableLine in tableData.splitlines():
-                        tableLine = tableLine.lstrip("{").rstrip("}").strip("\\").strip()
-                        if re.match(r"\|-(?!-)", tableLine):
-                            if row:
-                                data.append(row)
-                            row = []
-                        elif "class=" in tableLine:
-                            continue
-                        elif "colspan=" in tableLine:
-                            rowmatch = re.search(r"='([0-9]+)'[ \\\|]+", tableLine)
-                            val = (tableLine[rowmatch.end():], int(rowmatch.group(1)))
-
-                            row.append(val)
-                        elif re.match(r"^(!|\|)", tableLine):
-                            rowmatch = re.match(r"^(!|\|)", tableLine)
-                            val = tableLine[rowmatch.end():].strip()
-                            row.append(val)
-                    # Catch final
-                    data.append(row)
-                    tableData = data
-                    del data
-
-                    for i, row in enumerate(tableData):
-                        tableData[i] = [elem for elem in tableData[i] if elem]
-
-                    tableData = [row for row in tableData if row]
-                    if DEBUG:
-                        for row in tableData:
-                            print(row)
-
-                    print_table(tableData)
-                    line = line[endmatch.end():]
-                elif IMAGE_RE.search(line) and match.group() == IMAGE_RE.search(line).group():
-                    output(f"""
+class UnclosedTableError(IOError):
+    """ Input ended inside a table """
+
+
+def new_page(title):
+    """ Start writing to the file of a new page """
+    global OUTFILE
+    if OUTFILE is not None:
+        flush_output()
+        OUTFILE.close()
+    OUTFILE = new_file(OUTFILE, title)
+
+
+def convert(lines, output, new_page):
+    """ Convert input lines, calling new_page(title) at each page title and output to write """
+    lines = (standard_replace(line.rstrip('\n')) for line in lines)
+    line = next(lines, None)
+    # line[pos:] is not yet converted
+    pos = 0
+    # Text carried over from earlier lines has no tokens, so after
+    # appending a line a token can only start at pos (an anchored title
+    # finished by the new line), in the last word and spaces before the
+    # new line (a datestamp or literal block in it) or at an image
+    # start. carry and image are these positions in line[pos:checked].
+    carry = checked = 0
+    image = -1
+    while True:
+        if image < 0:
+            image = line.find(IMAGE_START, max(pos, checked - len(IMAGE_START) + 1))
+        match = next_token(line, pos, min(carry, image) if image >= 0 else carry)
+        while match:
+            kind = match.lastgroup
+            if kind == "NEWPAGE":
+                if DEBUG:
+                    print("newpage", match)
+                title = match.group('title').strip()
+                output(line[pos:match.start()])
+                new_page(title)
+                pos = match.end()
+            elif kind == "TITLE":
+                if DEBUG:
+                    print("title", match)
+                title = match.group('subtitle').strip()
+                output(line[pos:match.start()])
+                output(title)
+                output("*"*len(title))
+                output()
+                pos = match.end()
+            elif kind == "SUBTITLE":
+                if DEBUG:
+                    print("subtitle", match)
+                title = match.group('subsubtitle').strip()
+                output(line[pos:match.start()])
+                output(title)
+                output("="*len(title))
+                output()
+                pos = match.end()
+            elif kind == "MINORTITLE":
+                if DEBUG:
+                    print("minortitle", match)
+                title = match.group('minortitle').strip()
+                output(line[pos:match.start()])
+                output(title)
+                output("-"*len(title))
+                output()
+                pos = match.end()
+
+            elif kind == "LIST":
+                if DEBUG:
+                    print("list", match)
+
+                matchGroup = match.group()
+                line = "   "*(matchGroup.count('*')-1) + "- " + line[match.end():]
+                pos = 0
+
+            elif kind == "LITERAL_BLOCK":
+                if DEBUG:
+                    print("literal", match)
+                output(line[pos:match.start()])
+                output("::")
+                pos = match.end()
+
+            elif kind == "TABLE_START":
+                if DEBUG:
+                    print("table", match)
+                output(line[pos:match.start()])
+                # Table is joined into one line; "|}" cannot span the joins
+                table = [line[match.start():]]
+                endmatch = TABLE_END_RE.search(table[0])
+                while not endmatch:
+                    nextLine = next(lines, None)
+                    if nextLine is None:
+                        raise UnclosedTableError('Table never closed')
+                    table.append(" " + nextLine)
+                    endmatch = TABLE_END_RE.search(table[-1])
+                line = "".join(table)
+                pos = len(line) - len(table[-1]) + endmatch.end()
+                del table
+
+                tableData = line[:pos]
+                row = []
+                data = []
+                for tableLine in tableData.splitlines():
+                    tableLine = tableLine.lstrip("{").rstrip("}").strip("\\").strip()
+                    if re.match(r"\|-(?!-)", tableLine):
+                        if row:
+                            data.append(row)
+                        row = []
+                    elif "class=" in tableLine:
+                        continue
+                    elif "colspan=" in tableLine:
+                        rowmatch = re.search(r"='([0-9]+)'[ \\\|]+", tableLine)
+                        val = (tableLine[rowmatch.end():], int(rowmatch.group(1)))
+
+                        row.append(val)
+                    elif re.match(r"^(!|\|)", tableLine):
+                        rowmatch = re.match(r"^(!|\|)", tableLine)
+                        val = tableLine[rowmatch.end():].strip()
+                        row.append(val)
+                # Catch final
+                data.append(row)
+                tableData = data
+                del data
+
+                for i, row in enumerate(tableData):
+                    tableData[i] = [elem for elem in tableData[i] if elem]
+
+                tableData = [row for row in tableData if row]
+                if DEBUG:
+                    for row in tableData:
+                        print(row)
+
+                print_table(tableData, output)
+            elif kind == "IMAGE":
+                output(f"""
 .. image:: images/{match.group("path")}
    :width: {match.group("size")}
    :alt: {match.group("label")}
 
 """)
 
-                    line = line[match.end():]
-
-                elif NL_RE.search(line) and match.group() == NL_RE.search(line).group():
-                    if DEBUG:
-                        print("newline", match)
-                    val = line[:match.start()]
-                    # Remove end of line slashes
-                    val = re.sub(r"(?<!\\)\\$", "", val)
-                    # Count of non-escaped *s
-                    if len(re.findall(r"(?<!\\)\*", val)) % 2:
-                        ind = val.rfind("*")
-                        val = val[:ind] + val[ind+1:]
-                    output(val)
-                    line = line[match.end():]
-
-                match = ANY_MATCH_RE.search(line)
-                # End main block
-            nextLine = next_line()
-            if nextLine is None:
-                break
+                pos = match.end()
+
+            elif kind == "NL":
+                if DEBUG:
+                    print("newline", match)
+                val = line[pos:match.start()]
+                # Remove end of line slashes
+                val = EOL_SLASH_RE.sub("", val)
+                # Count of non-escaped *s
+                if len(STAR_RE.findall(val)) % 2:
+                    ind = val.rfind("*")
+                    val = val[:ind] + val[ind+1:]
+                output(val)
+                pos = match.end()
+
+            checked = pos
+            image = -1
+            match = next_token(line, pos, pos)
+            # End main block
+
+        # Update carry and image for the text added since checked
+        start = CARRY_RE.search(line, checked).start()
+        if start > checked or checked == pos:
+            carry = start
+        if image < 0:
+            image = line.find(IMAGE_START, checked)
+
+        nextLine = next(lines, None)
+        if nextLine is None:
+            break
+        if pos:
+            line = line[pos:]
+            carry -= pos
+            image -= pos if image >= 0 else 0
+            pos = 0
+        checked = len(line)
+        if not nextLine:
+            line += "\n\n"
+        else:
+            if line:
+                line += " " + nextLine
             else:
-                if not nextLine:
-                    line += "\n\n"
-                else:
-                    if line:
-                        line += " " + nextLine
-                    else:
-                        line = nextLine
+                line = nextLine
 
     # Dump remainder
-    output(line)
+    output(line[pos:])
+
+
+def main(filename):
+    """ Perform the main conversion """
+    with open(filename, 'r', encoding="utf8") as inFile:
+        convert(inFile, output, new_page)
+
+
+def index_chunks(lines):
+    """ Split input lines into chunks of whole pages
+
+    A chunk starts at a page title at the start of a line after a blank
+    line, where nothing is carried over from earlier lines unless a table
+    is still open, so chunks can be converted independently.
+    """
+    starts = [0]
+    for i in range(1, len(lines)):
+        if not lines[i-1].rstrip('\n') and NEWPAGE_RE.match(standard_replace(lines[i].rstrip('\n'))):
+            starts.append(i)
+    return [lines[start:end] for start, end in zip(starts, starts[1:] + [len(lines)])]
+
+
+def convert_chunk(lines):
+    """ Convert a chunk of pages in memory
+
+    Returns the output before the first page and (title, text) of each
+    page, or None if the chunk ends inside a table.
+    """
+    preamble = []
+    pages = []
+
+    def chunk_output(*args):
+        (pages[-1][1] if pages else preamble).append(format_line(*args))
+
+    def chunk_page(title):
+        pages.append((title, [page_header(title)]))
+
+    try:
+        convert(lines, chunk_output, chunk_page)
+    except UnclosedTableError:
+        return None
+    return "".join(preamble), [(title, "".join(text)) for title, text in pages]
+
+
+def chunk_hash(lines):
+    """ Hash of a chunk's source text """
+    return hashlib.sha256("".join(lines).encode("utf8")).hexdigest()
+
+
+def convert_pages(filename, jobs):
+    """ Convert pages in a process pool, only rewriting those whose source changed
+
+    Only chunks whose hash is not in the manifest of the last run (or
+    whose pages are missing, or were written from another chunk) are
+    converted. make.sh then converts the rst of pages rewritten since
+    their html in parallel. If the input ends inside a table, the pages
+    and manifest entries of the other chunks are still written.
+    """
+    # Output of a different version of this script cannot be reused
+    with open(__file__, 'rb') as script:
+        converter = hashlib.sha256(script.read()).hexdigest()
+    manifestPath = os.path.join(argList.output, MANIFEST)
+    known = {}
+    joined = set()
+    pageChunks = {}
+    if os.path.isfile(manifestPath):
+        with open(manifestPath, 'r') as manifestFile:
+            manifest = json.load(manifestFile)
+        if manifest.get("converter") == converter:
+            known = manifest["chunks"]
+            joined = set(manifest["joined"])
+            pageChunks = manifest["pages"]
+
+    with open(filename, 'r', encoding="utf8") as inFile:
+        pieces = index_chunks(inFile.readlines())
+    # Chunks are joined to the next when they end inside a table (below).
+    # Joining chunks is always safe, so repeat the joins of the last run
+    chunks = []
+    hashes = []
+    joins = []
+    for piece in pieces:
+        if hashes and hashes[-1] in joined:
+            joins.append(hashes[-1])
+            chunks[-1] = chunks[-1] + piece
+            hashes[-1] = chunk_hash(chunks[-1])
+        else:
+            chunks.append(piece)
+            hashes.append(chunk_hash(piece))
+
+    def is_stale(hash_):
+        return hash_ not in known or not all(
+            os.path.isfile(os.path.join(argList.output, title+RST_EXT)) for title in known[hash_])
+
+    stale = [is_stale(hash_) for hash_ in hashes]
+    results = [None] * len(chunks)
+    failed = False
+    with ProcessPoolExecutor(jobs) as executor:
+
+        def convert_stale():
+            todo = [i for i, isStale in enumerate(stale) if isStale and results[i] is None]
+            for i, result in zip(todo, executor.map(convert_chunk, [chunks[i] for i in todo],
+                                                    chunksize=max(1, len(todo) // (4*jobs)))):
+                results[i] = result
+
+        convert_stale()
+
+        # A page title inside an open table does not start a page, so join
+        # chunks which ended inside a table to the next
+        i = 0
+        while i < len(chunks):
+            if stale[i] and results[i] is None:
+                if i + 1 == len(chunks):
+                    # Keep the pages of the other chunks, as serial conversion does
+                    failed = True
+                    del chunks[i], hashes[i], stale[i], results[i]
+                    break
+                joins.append(hashes[i])
+                chunks[i:i+2] = [chunks[i] + chunks[i+1]]
+                hashes[i:i+2] = [chunk_hash(chunks[i])]
+                stale[i:i+2] = [True]
+                results[i:i+2] = [convert_chunk(chunks[i])]
+            else:
+                i += 1
+
+        titles = [[title for title, _ in results[i][1]] if stale[i] else known[hash_]
+                  for i, hash_ in enumerate(hashes)]
+        # As in serial conversion, the last of pages with the same title is kept
+        lastPage = {title: (i, j) for i, chunkTitles in enumerate(titles) for j, title in enumerate(chunkTitles)}
+        # A page last written from another chunk, which has since changed
+        # or gone, is written again from the unchanged chunk which now has it
+        for title, (i, _) in lastPage.items():
+            if not stale[i] and pageChunks.get(title) != hashes[i]:
+                stale[i] = True
+        convert_stale()
+
+    if stale and stale[0]:
+        # Text before the first page. Later chunks start with the empty
+        # text before their title, which ends the previous chunk instead
+        sys.stdout.write(results[0][0])
+
+    nChanged = 0
+    for i, result in enumerate(results):
+        if not stale[i]:
+            continue
+        for j, (title, text) in enumerate(result[1]):
+            if lastPage[title] != (i, j):
+                continue
+            print(f"STATUS: Parsing {title}")
+            pagePath = os.path.join(argList.output, title+RST_EXT)
+            if os.path.isfile(pagePath):
+                with open(pagePath, 'r') as pageFile:
+                    if pageFile.read() == text:
+                        continue
+            with open(pagePath, 'w') as pageFile:
+                pageFile.write(text)
+            nChanged += 1
+    allTitles = list(dict.fromkeys(title for chunkTitles in titles for title in chunkTitles))
+    print(f"STATUS: {nChanged} of {len(allTitles)} pages rewritten")
+
+    with open(manifestPath, 'w') as manifestFile:
+        json.dump({"converter": converter, "chunks": dict(zip(hashes, titles)), "joined": joins,
+                   "pages": {title: hashes[i] for title, (i, _) in lastPage.items()}},
+                  manifestFile, indent=1)
+
+    # Convert pages whose rst is newer than their html, in parallel
+    with open(os.path.join(argList.output, "make.sh"), 'w') as makeFile:
+        print(r"#!/bin/bash", file=makeFile)
+        print(f"xargs -P {jobs} -I {{}} sh -c "
+              f"'[ {{}}{HTML_EXT} -nt {{}}{RST_EXT} ] || {MAKE_COMMAND} {{}}{RST_EXT} > {{}}{HTML_EXT}' <<EOF",
+              file=makeFile)
+        for title in allTitles:
+            print(title, file=makeFile)
+        print("EOF", file=makeFile)
+    if failed:
+        raise UnclosedTableError('Table never closed')
 
 
 if __name__ == "__main__":
-    main(argList.input)
+    if argList.jobs:
+        convert_pages(argList.input, argList.jobs)
+    else:
+        MAKE_FILE = open(argList.output+"/"+"make.sh", 'w')
+        print(r"#!/bin/bash", file=MAKE_FILE)
+        try:
+            main(argList.input)
+        finally:
+            # Keep what was converted, even if conversion failed
+            flush_output()
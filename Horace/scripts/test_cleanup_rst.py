@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""
+Check that parallel, incremental conversion by cleanup-rst.py matches serial conversion
+"""
+
+import os.path
+import subprocess
+import sys
+import tempfile
+import unittest
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cleanup-rst.py")
+
+
+def page(title, body):
+    """ Source of a page with a datestamped title """
+    return f"{title} 20200101\n\n{body}\n\n"
+
+
+class TestIncrementalConversion(unittest.TestCase):
+
+    def convert(self, source, output, *args):
+        """ Convert source into output directory, returning the text of each page """
+        inPath = os.path.join(output, "input.rst")
+        with open(inPath, 'w', encoding="utf8") as inFile:
+            inFile.write(source)
+        subprocess.run([sys.executable, SCRIPT, "-i", inPath, "-o", output, *args],
+                       check=True, stdout=subprocess.DEVNULL)
+        pages = {}
+        for name in os.listdir(output):
+            if name.endswith(".rst") and name != "input.rst":
+                with open(os.path.join(output, name), 'r') as pageFile:
+                    pages[name] = pageFile.read()
+        return pages
+
+    def test_page_owner_moves_to_unchanged_chunk(self):
+        """ A duplicate title whose last page is renamed is written from the earlier page """
+        first = page("PageX", "first body") + page("PageY", "second body")
+        with tempfile.TemporaryDirectory() as parallel, tempfile.TemporaryDirectory() as serial:
+            self.convert(first + page("PageX", "third body"), parallel, "-j", "2")
+            edited = first + page("PageZ", "third body")
+            pages = self.convert(edited, parallel, "-j", "2")
+            self.assertIn("first body", pages["PageX.rst"])
+            self.assertEqual(pages, self.convert(edited, serial))
+
+
+if __name__ == "__main__":
+    unittest.main()
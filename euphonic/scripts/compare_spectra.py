@@ -1,4 +1,7 @@
-from euphonic import Spectrum1D, Quantity, ureg
+from typing import NamedTuple, Sequence, Union
+
+import numpy as np
+from euphonic import Spectrum1D, Spectrum1DCollection, Quantity, ureg
 from numpy import absolute, allclose, mean, square, sqrt
 
 
@@ -70,3 +73,121 @@ def diff_1d_avg(spectrum: Spectrum1D,
         return sqrt(mean(square(diff.magnitude))) * diff.units
     else:
         return mean(diff.magnitude) * diff.units
+
+
+def error_1d_avg(spectrum: Spectrum1D,
+                 error: Spectrum1D,
+                 fractional: bool = False,
+                 threshold: float = 1e-12) -> Quantity:
+    """Root mean square of an estimated error spectrum, returning a scalar
+
+    This is the counterpart of diff_1d_avg(rms=True) for spectra whose error
+    is estimated statistically (e.g. from independent scrambles) rather than
+    measured against a reference.
+
+    Args:
+        spectrum: Spectrum with same x-values as error
+        error: Estimated standard error of each value of spectrum
+        fractional:
+            Calculate relative error E/S. If False, use the unscaled error.
+        threshold:
+            Ignore error from values smaller than this threshold in spectrum
+            when fractional=True
+
+    Returns:
+        Quantity:
+            RMS error
+    """
+
+    assert spectrum.x_data_unit == error.x_data_unit
+    assert allclose(spectrum.x_data.magnitude, error.x_data.magnitude)
+
+    error_values = error.y_data.to(spectrum.y_data_unit).magnitude
+
+    if fractional:
+        values = spectrum.y_data.magnitude
+        mask = absolute(values) > threshold
+        error_values = error_values[mask] / values[mask]
+        units = ureg(None)
+    else:
+        units = spectrum.y_data.units
+
+    return sqrt(mean(square(error_values))) * units
+
+
+class SpectraDiff(NamedTuple):
+    """Differences between a stack of spectra and a single reference
+
+    Attributes:
+        residuals: (n_spectra, n_bins) array of unscaled differences S - R
+        mean, rms: (n_spectra,) arrays of the signed mean and root mean
+            square of residuals
+        fractional: (n_spectra, n_masked) array of relative differences
+            (S - R)/R, over bins where the reference exceeds the threshold
+        fractional_mean, fractional_rms: (n_spectra,) arrays of the signed
+            mean and root mean square of fractional
+        units: Units of residuals, mean and rms; fractional values are
+            dimensionless
+    """
+    residuals: np.ndarray
+    mean: np.ndarray
+    rms: np.ndarray
+    fractional: np.ndarray
+    fractional_mean: np.ndarray
+    fractional_rms: np.ndarray
+    units: ureg.Unit
+
+
+def diff_1d_batch(spectra: Union[Sequence[Spectrum1D], Spectrum1DCollection],
+                  reference: Spectrum1D,
+                  threshold: float = 1e-12) -> SpectraDiff:
+    """Compare a stack of spectra against one reference in a single pass
+
+    This gives the same values as diff_1d and diff_1d_avg for each spectrum,
+    but checks the x-axis and converts units once for the whole stack.
+
+    Args:
+        spectra:
+            Spectrum1DCollection, or sequence of Spectrum1D, with the same
+            x-values as reference
+        reference: Reference spectrum
+        threshold:
+            Ignore error from values smaller than this threshold in reference
+            spectrum for fractional differences
+
+    Returns:
+        SpectraDiff:
+            Residuals and averaged differences as plain NumPy arrays
+    """
+    ref_values = reference.y_data.magnitude
+
+    if isinstance(spectra, Spectrum1DCollection):
+        assert spectra.x_data_unit == reference.x_data_unit
+        assert allclose(spectra.x_data.magnitude, reference.x_data.magnitude)
+        values = spectra.y_data.to(reference.y_data_unit).magnitude
+    else:
+        assert all(spectrum.x_data_unit == reference.x_data_unit
+                   for spectrum in spectra)
+        assert allclose(np.stack([spectrum.x_data.magnitude
+                                  for spectrum in spectra]),
+                        reference.x_data.magnitude)
+        if all(spectrum.y_data_unit == reference.y_data_unit
+               for spectrum in spectra):
+            values = np.stack([spectrum.y_data.magnitude
+                               for spectrum in spectra])
+        else:
+            values = np.stack([spectrum.y_data.to(reference.y_data_unit)
+                               .magnitude for spectrum in spectra])
+
+    residuals = values - ref_values
+    mask = absolute(ref_values) > threshold
+    fractional = residuals[:, mask] / ref_values[mask]
+
+    return SpectraDiff(
+        residuals=residuals,
+        mean=mean(residuals, axis=1),
+        rms=sqrt(mean(square(residuals), axis=1)),
+        fractional=fractional,
+        fractional_mean=mean(fractional, axis=1),
+        fractional_rms=sqrt(mean(square(fractional), axis=1)),
+        units=reference.y_data.units)
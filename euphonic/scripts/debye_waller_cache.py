@@ -0,0 +1,186 @@
+"""Debye-Waller factors shared across a sweep, with grid convergence checks
+
+The Debye-Waller factor is an average over the whole Brillouin zone, and for
+materials with dispersive bands (e.g. Nb and graphite) grids of 50^3 or more
+are needed to converge it (see 02_debye_waller_factors.md in
+euphonic/performance). It depends only on the material, temperature and
+grid, not on |q|, npts or the sampling scheme, so it is calculated once per
+sweep and stored in the DiskCache under these parameters.
+
+Rather than guessing a grid, a tolerance may be given: the grid is then
+doubled, starting from a coarse one, until the factors e^-W change by less
+than the tolerance (see get_dw_change). Each grid is cached separately, so
+repeating or tightening the check only calculates the new grids.
+
+For a temperature scan, cached_debye_wallers calculates the factors at all
+temperatures from the same phonons on each grid.
+"""
+
+import warnings
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from euphonic import ureg, DebyeWaller, ForceConstants, Quantity
+
+from disk_cache import DiskCache, hash_key
+from sphere_sampling import (DEFAULT_CHUNK_SIZE, DEFAULT_DW_SPACING,
+                             get_debye_wallers)
+
+# Starting grid spacing when converging to a tolerance
+DEFAULT_DW_START_SPACING = 0.1 * ureg('1/angstrom')
+# Doubling stops (with a warning) rather than exceed this many q-points
+DEFAULT_DW_MAX_QPTS = 2 * 10**6
+
+
+def get_dw_change(dw: DebyeWaller, other_dw: DebyeWaller,
+                  q_max: Quantity) -> float:
+    """Largest fractional change in e^-W between two Debye-Waller factors
+
+    The term for atom k at scattering vector Q is exp(-Q.W_k.Q), so the
+    fractional change is |exp(-Q.dW_k.Q) - 1|. For |Q| <= q_max this is
+    largest along an eigenvector of dW_k with |Q| = q_max.
+
+    Args:
+        dw, other_dw: Debye-Waller factors of the same crystal
+        q_max: Largest scattering vector of interest
+
+    Returns:
+        Maximum over atoms and directions of the fractional change
+    """
+    delta = (other_dw.debye_waller - dw.debye_waller).to('angstrom**2')
+    eigenvalues = np.linalg.eigvalsh(delta.magnitude)
+    q_squared = q_max.to('1/angstrom').magnitude**2
+    return float(np.max(np.abs(np.expm1(-q_squared * eigenvalues))))
+
+
+def _grid_debye_wallers(force_constants: ForceConstants,
+                        temperatures: Sequence[Quantity],
+                        grid: Sequence[int],
+                        *,
+                        fc_hash: Optional[str],
+                        cache: Optional[DiskCache],
+                        chunk_size: int) -> List[DebyeWaller]:
+    """Debye-Waller factors on a given grid, via cache if available
+
+    Factors missing from the cache are calculated together, from one set of
+    phonons on the grid.
+    """
+    use_cache = cache is not None and fc_hash is not None
+    keys = [hash_key(debye_waller=fc_hash, temperature=temperature.to('K'),
+                     grid=[int(n) for n in grid])
+            for temperature in temperatures]
+    dws = [None] * len(temperatures)
+    if use_cache:
+        for i, (key, temperature) in enumerate(zip(keys, temperatures)):
+            arrays = cache.load(key)
+            if arrays is not None:
+                unit = str(arrays['debye_waller_unit'])
+                dws[i] = DebyeWaller(force_constants.crystal,
+                                     arrays['debye_waller'] * ureg(unit),
+                                     temperature)
+
+    missing = [i for i, dw in enumerate(dws) if dw is None]
+    if missing:
+        print("Calculating Debye-Waller factor: grid = "
+              + 'x'.join(map(str, grid))
+              + ('' if len(missing) == 1
+                 else f', {len(missing)} temperatures'))
+        new_dws = get_debye_wallers(force_constants,
+                                    [temperatures[i] for i in missing],
+                                    grid=grid, chunk_size=chunk_size)
+        for i, dw in zip(missing, new_dws):
+            dws[i] = dw
+            if use_cache:
+                cache.save(keys[i], debye_waller=dw.debye_waller.magnitude,
+                           debye_waller_unit=np.array(
+                               str(dw.debye_waller.units)))
+    return dws
+
+
+def cached_debye_waller(force_constants: ForceConstants,
+                        temperature: Quantity,
+                        **kwargs) -> Tuple[DebyeWaller, Tuple[int, ...]]:
+    """Get Debye-Waller factor for a sweep, from cache if available
+
+    Arguments are as for cached_debye_wallers, with a single temperature.
+
+    Returns:
+        dw, grid:
+            Debye-Waller factor and number of grid points along each
+            reciprocal axis used to calculate it
+    """
+    dws, grid = cached_debye_wallers(force_constants, [temperature],
+                                     **kwargs)
+    return dws[0], grid
+
+
+def cached_debye_wallers(force_constants: ForceConstants,
+                         temperatures: Sequence[Quantity],
+                         *,
+                         spacing: Optional[Quantity] = None,
+                         tolerance: Optional[float] = None,
+                         q_max: Optional[Quantity] = None,
+                         max_qpts: int = DEFAULT_DW_MAX_QPTS,
+                         fc_hash: Optional[str] = None,
+                         cache: Optional[DiskCache] = None,
+                         chunk_size: int = DEFAULT_CHUNK_SIZE
+                         ) -> Tuple[List[DebyeWaller], Tuple[int, ...]]:
+    """Get Debye-Waller factors at several temperatures on a common grid
+
+    Args:
+        force_constants: Force constants of material
+        temperatures: Temperatures of Debye-Waller factors
+        spacing: Maximum Monkhorst-Pack grid spacing. Defaults to
+            DEFAULT_DW_SPACING, or DEFAULT_DW_START_SPACING if tolerance is
+            given.
+        tolerance: If provided, the grid from spacing is only the starting
+            point; it is doubled until get_dw_change between successive
+            grids is below tolerance at every temperature, and the finer of
+            the two is used
+        q_max: Largest scattering vector at which e^-W is compared; required
+            with tolerance
+        max_qpts: Stop doubling (and warn) rather than use a grid with more
+            q-points than this
+        fc_hash: Hash of force constants file(s), from hash_files
+        cache: If provided (with fc_hash), look up and store results here
+        chunk_size: Maximum number of q-points per phonon calculation
+
+    Returns:
+        dws, grid:
+            Debye-Waller factor for each temperature and number of grid
+            points along each reciprocal axis used to calculate them
+    """
+    if spacing is None:
+        spacing = (DEFAULT_DW_SPACING if tolerance is None
+                   else DEFAULT_DW_START_SPACING)
+    grid = tuple(int(n) for n in
+                 force_constants.crystal.get_mp_grid_spec(spacing))
+
+    def get_dws(grid):
+        return _grid_debye_wallers(force_constants, temperatures, grid,
+                                   fc_hash=fc_hash, cache=cache,
+                                   chunk_size=chunk_size)
+
+    dws = get_dws(grid)
+    if tolerance is None:
+        return dws, grid
+    if q_max is None:
+        raise ValueError('q_max is required to check convergence of the '
+                         'Debye-Waller factor')
+
+    while True:
+        next_grid = tuple(2 * n for n in grid)
+        if np.prod(next_grid) > max_qpts:
+            warnings.warn('Debye-Waller factor not converged to tolerance '
+                          f'{tolerance} within {max_qpts} q-points; using '
+                          + 'x'.join(map(str, grid)) + ' grid')
+            return dws, grid
+        next_dws = get_dws(next_grid)
+        change = max(get_dw_change(dw, next_dw, q_max)
+                     for dw, next_dw in zip(dws, next_dws))
+        print('Debye-Waller grid ' + 'x'.join(map(str, next_grid))
+              + f': max change in e^-W = {change:.3g}')
+        dws, grid = next_dws, next_grid
+        if change < tolerance:
+            return dws, grid
@@ -0,0 +1,204 @@
+"""Content-addressed on-disk cache shared by the powder convergence scripts
+
+Entries are stored as uncompressed .npz archives named by a SHA-256 key, so
+the same calculation requested by different scripts (or repeated runs of the
+same script) is only performed once. The cache is bounded in size; when it
+grows too large the least-recently-used entries are removed.
+
+The binary copies of force constants, precomputed phonon data and mode grids
+written by force_constants_cache are directories in the FC_CACHE_SUBDIR
+subdirectory. These count towards the same limit, and each is evicted as a
+whole.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+from typing import Callable, Dict, Iterable, Optional
+
+import numpy as np
+
+from euphonic import ureg, Quantity, Spectrum1D
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache',
+                                 'euphonic-scripts')
+DEFAULT_CACHE_SIZE = 1024  # MB
+# Subdirectory of directory entries written by force_constants_cache
+FC_CACHE_SUBDIR = 'force-constants'
+
+# Data files that phonopy.yaml may refer to; these are hashed alongside it
+PHONOPY_DATA_FILES = ('FORCE_CONSTANTS', 'force_constants.hdf5',
+                      'FORCE_SETS', 'BORN')
+
+_READ_BLOCK = 1 << 20
+
+
+def force_constants_files(filename: str) -> list:
+    """List the files which determine the force constants read from filename
+
+    For phonopy YAML files, force constants and Born charges may be stored in
+    separate files in the same directory; any of these which exist are
+    included.
+    """
+    files = [filename]
+    if filename.endswith(('.yaml', '.yml')):
+        path = os.path.dirname(filename)
+        files += [os.path.join(path, name) for name in PHONOPY_DATA_FILES
+                  if os.path.isfile(os.path.join(path, name))]
+    return files
+
+
+def hash_files(filenames: Iterable[str]) -> str:
+    """Get a SHA-256 hex digest of the contents of a sequence of files"""
+    sha = hashlib.sha256()
+    for filename in filenames:
+        sha.update(os.path.basename(filename).encode())
+        with open(filename, 'rb') as fd:
+            for block in iter(lambda: fd.read(_READ_BLOCK), b''):
+                sha.update(block)
+    return sha.hexdigest()
+
+
+def hash_key(**params) -> str:
+    """Get a SHA-256 hex digest identifying a set of calculation parameters
+
+    Quantities are reduced to magnitude and units and arrays to their values,
+    so that equal parameters always give the same key.
+    """
+    def _serialise(value):
+        if isinstance(value, Quantity):
+            return [_serialise(value.magnitude), str(value.units)]
+        if isinstance(value, np.ndarray):
+            return value.tolist()
+        if isinstance(value, np.generic):
+            return value.item()
+        return str(value)
+
+    return hashlib.sha256(
+        json.dumps(params, sort_keys=True, default=_serialise).encode()
+        ).hexdigest()
+
+
+class DiskCache:
+    """Size-bounded, least-recently-used cache of NumPy arrays on disk
+
+    Args:
+        directory: Location of cache files; created if it does not exist
+        max_size: Maximum total size of the cache in MB, including the
+            directory entries in FC_CACHE_SUBDIR. When this is exceeded, the
+            least-recently-used entries are deleted.
+    """
+    suffix = '.npz'
+
+    def __init__(self, directory: str = DEFAULT_CACHE_DIR,
+                 max_size: float = DEFAULT_CACHE_SIZE) -> None:
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+        # Entries may have been added by other scripts without a DiskCache
+        self.evict()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + self.suffix)
+
+    def load(self, key: str) -> Optional[Dict[str, np.ndarray]]:
+        """Get the arrays stored for key, or None if there is no such entry"""
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                arrays = {name: data[name] for name in data.files}
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        # Use modification time to track last use; atime is often disabled
+        os.utime(path)
+        return arrays
+
+    def save(self, key: str, **arrays: np.ndarray) -> None:
+        """Store a set of named arrays under key, then enforce size limit"""
+        path = self._path(key)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as fd:
+            np.savez(fd, **arrays)
+        # Atomic, so concurrent readers never see a partial entry
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def _directory_entries(self) -> list:
+        """(mtime, size, path) of each complete entry in FC_CACHE_SUBDIR"""
+        entries = []
+        try:
+            subdir_entries = list(os.scandir(
+                os.path.join(self.directory, FC_CACHE_SUBDIR)))
+        except FileNotFoundError:
+            return entries
+        for entry in subdir_entries:
+            # Skip entries which are still being written
+            if not entry.is_dir() or entry.name.endswith('.tmp'):
+                continue
+            size = 0
+            for dirpath, _, filenames in os.walk(entry.path):
+                for filename in filenames:
+                    try:
+                        size += os.path.getsize(
+                            os.path.join(dirpath, filename))
+                    except FileNotFoundError:
+                        pass
+            entries.append((entry.stat().st_mtime, size, entry.path))
+        return entries
+
+    def evict(self) -> None:
+        """Remove least-recently-used entries until within max_size"""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(self.suffix):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries += self._directory_entries()
+
+        total_size = sum(size for _, size, _ in entries)
+        max_bytes = self.max_size * 1024**2
+        for _, size, path in sorted(entries):
+            if total_size <= max_bytes:
+                break
+            if os.path.isdir(path):
+                # Processes which have memory-mapped its arrays keep them
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total_size -= size
+
+
+def spectrum_to_arrays(spectrum: Spectrum1D) -> Dict[str, np.ndarray]:
+    """Convert Spectrum1D to arrays suitable for DiskCache.save"""
+    return {'x_data': spectrum.x_data.magnitude,
+            'x_data_unit': np.array(str(spectrum.x_data.units)),
+            'y_data': spectrum.y_data.magnitude,
+            'y_data_unit': np.array(str(spectrum.y_data.units))}
+
+
+def spectrum_from_arrays(arrays: Dict[str, np.ndarray]) -> Spectrum1D:
+    """Recreate Spectrum1D from arrays produced by spectrum_to_arrays"""
+    return Spectrum1D(arrays['x_data'] * ureg(str(arrays['x_data_unit'])),
+                      arrays['y_data'] * ureg(str(arrays['y_data_unit'])))
+
+
+def cached_spectrum(cache: Optional[DiskCache], key: str,
+                    calculate: Callable[[], Spectrum1D]) -> Spectrum1D:
+    """Get spectrum from cache, calling calculate() and storing it if missing
+
+    If cache is None, the spectrum is always calculated.
+    """
+    if cache is None:
+        return calculate()
+
+    arrays = cache.load(key)
+    if arrays is not None:
+        return spectrum_from_arrays(arrays)
+
+    spectrum = calculate()
+    cache.save(key, **spectrum_to_arrays(spectrum))
+    return spectrum
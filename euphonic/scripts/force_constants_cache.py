@@ -0,0 +1,381 @@
+"""Fast-loading binary copies of force constants files
+
+Parsing phonopy.yaml and FORCE_CONSTANTS takes several seconds for large
+supercells, and every script (and every worker process) does it on startup.
+The first time a file is read, its arrays are written as raw .npy files with a
+JSON header in the cache directory; later runs memory-map them instead.
+
+Entries are stored under the SHA-256 hash of the source file(s), so a changed
+source file can never be matched to a stale entry. To avoid re-hashing large
+files on every run, an index records the modification time and size of the
+source files alongside their hash; the files are only hashed again if these
+differ.
+
+The q-independent data which ForceConstants prepares before its first phonon
+calculation (supercell atom images and, for polar materials, the real-space
+and Gamma-point terms of the Ewald dipole correction) are cached in the same
+way and attached to the loaded object, so that they are not recalculated by
+every run or worker process. These are private euphonic attributes, so the
+entries are also keyed by the euphonic version.
+
+Each entry is a directory in FC_CACHE_SUBDIR, whose modification time is
+updated when it is loaded. DiskCache counts these towards its size limit and
+evicts the least-recently-used ones; a removed entry is rebuilt when next
+needed.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+from typing import Any, Callable, Dict, Tuple
+
+import numpy as np
+
+import euphonic
+from euphonic import ureg, Crystal, ForceConstants
+
+from disk_cache import (DEFAULT_CACHE_DIR, FC_CACHE_SUBDIR,
+                        force_constants_files, hash_files)
+
+HEADER_NAME = 'header.json'
+
+# ForceConstants and Crystal store data in atomic units. Arrays are saved in
+# these units, so they can be memory-mapped and used without a converted copy,
+# and so that the loaded object is identical to the original (a round trip
+# through the user's units can change the last bit)
+_INTERNAL_UNITS = {'force_constants': 'hartree/bohr**2',
+                   'cell_vectors': 'bohr',
+                   'atom_mass': 'm_e',
+                   'born': 'e',
+                   'dielectric': 'e**2/(bohr*hartree)'}
+# Increment if the layout of force constants entries changes
+_FC_FORMAT_VERSION = 2
+
+# Number of supercells searched for atom images; fixed in euphonic
+_N_SC_SHELLS = 2
+_DIPOLE_PREFIX = 'dipole_'
+
+
+def _write_json(path: str, data: Any) -> None:
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as fd:
+        json.dump(data, fd)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path: str) -> Any:
+    try:
+        with open(path) as fd:
+            return json.load(fd)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def get_files_hash(filename: str, cache_dir: str = DEFAULT_CACHE_DIR) -> str:
+    """Get hash_files of the files which determine the data read from filename
+
+    The hash is recorded in cache_dir along with the modification times and
+    sizes of the files; while these are unchanged the recorded hash is
+    returned without reading the files.
+    """
+    filenames = [os.path.abspath(name)
+                 for name in force_constants_files(filename)]
+    stats = []
+    for name in filenames:
+        stat = os.stat(name)
+        stats.append([name, stat.st_mtime_ns, stat.st_size])
+
+    index_dir = os.path.join(cache_dir, FC_CACHE_SUBDIR)
+    os.makedirs(index_dir, exist_ok=True)
+    index_path = os.path.join(
+        index_dir,
+        hashlib.sha256(filenames[0].encode()).hexdigest() + '.json')
+
+    index = _read_json(index_path)
+    if index is not None and index.get('files') == stats:
+        return index['hash']
+
+    files_hash = hash_files(filenames)
+    _write_json(index_path, {'files': stats, 'hash': files_hash})
+    return files_hash
+
+
+class ArraysWriter:
+    """Assemble a cache entry in a temporary directory
+
+    Arrays are written as individual .npy files so that they can be
+    memory-mapped by load_arrays; all other values go in a JSON header. Use
+    as a context manager: when the context exits without error the entry is
+    moved into place, so readers never see a partial entry.
+
+    Args:
+        directory: Final location of entry
+    """
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self.tmp_directory = f'{directory}.{os.getpid()}.tmp'
+        self.header = {'arrays': [], 'values': {}}
+        self._memmaps = []
+
+    def __enter__(self) -> 'ArraysWriter':
+        os.makedirs(self.tmp_directory, exist_ok=True)
+        return self
+
+    def _array_path(self, key: str) -> str:
+        self.header['arrays'].append(key)
+        return os.path.join(self.tmp_directory, key + '.npy')
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        if isinstance(value, np.ndarray):
+            np.save(self._array_path(key), value, allow_pickle=False)
+        elif isinstance(value, np.generic):
+            self.header['values'][key] = value.item()
+        else:
+            self.header['values'][key] = value
+
+    def new_array(self, key: str, shape: Tuple[int, ...],
+                  dtype) -> np.memmap:
+        """Create a writable memory-mapped array, to be filled in place
+
+        This allows entries larger than the available memory to be built.
+        """
+        array = np.lib.format.open_memmap(self._array_path(key), mode='w+',
+                                          dtype=dtype, shape=shape)
+        self._memmaps.append(array)
+        return array
+
+    def __exit__(self, exc_type, exc_value, traceback) -> bool:
+        for array in self._memmaps:
+            array.flush()
+        self._memmaps = []
+        if exc_type is not None:
+            shutil.rmtree(self.tmp_directory, ignore_errors=True)
+            return False
+
+        _write_json(os.path.join(self.tmp_directory, HEADER_NAME),
+                    self.header)
+        try:
+            os.rename(self.tmp_directory, self.directory)
+        except OSError:
+            # Another process has already written this entry
+            shutil.rmtree(self.tmp_directory, ignore_errors=True)
+        return False
+
+
+def save_arrays(directory: str, data: Dict[str, Any]) -> None:
+    """Write a dict of arrays and JSON-compatible values as a cache entry
+
+    See ArraysWriter for the format.
+    """
+    with ArraysWriter(directory) as writer:
+        for key, value in data.items():
+            writer[key] = value
+
+
+def load_arrays(directory: str):
+    """Read a cache entry written by ArraysWriter, or None if there is none
+
+    Arrays are memory-mapped read-only, so only the parts which are used are
+    read from disk and the pages are shared between processes.
+    """
+    header = _read_json(os.path.join(directory, HEADER_NAME))
+    if header is None:
+        return None
+    data = dict(header['values'])
+    try:
+        for key in header['arrays']:
+            data[key] = np.load(os.path.join(directory, key + '.npy'),
+                                mmap_mode='r', allow_pickle=False)
+    except (FileNotFoundError, ValueError, OSError):
+        return None
+    # Use modification time to track last use, as in DiskCache
+    try:
+        os.utime(directory)
+    except OSError:
+        pass
+    return data
+
+
+def force_constants_to_arrays(force_constants: ForceConstants
+                              ) -> Dict[str, Any]:
+    """Convert ForceConstants to data suitable for save_arrays
+
+    Quantities are stored as the internal arrays (see _INTERNAL_UNITS),
+    with the original units recorded so they can be restored.
+    """
+    crystal = force_constants.crystal
+    data = {'force_constants': force_constants._force_constants,
+            'force_constants_unit': force_constants.force_constants_unit,
+            'sc_matrix': np.asarray(force_constants.sc_matrix),
+            'cell_origins': np.asarray(force_constants.cell_origins),
+            'cell_vectors': crystal._cell_vectors,
+            'cell_vectors_unit': crystal.cell_vectors_unit,
+            'atom_r': np.asarray(crystal.atom_r),
+            'atom_type': np.asarray(crystal.atom_type, dtype=str),
+            'atom_mass': crystal._atom_mass,
+            'atom_mass_unit': crystal.atom_mass_unit}
+    if force_constants._born is not None:
+        data.update(born=force_constants._born,
+                    born_unit=force_constants.born_unit,
+                    dielectric=force_constants._dielectric,
+                    dielectric_unit=force_constants.dielectric_unit)
+    return data
+
+
+def force_constants_from_arrays(data: Dict[str, Any]) -> ForceConstants:
+    """Recreate ForceConstants from force_constants_to_arrays data
+
+    The (possibly memory-mapped) force constant array is used directly
+    rather than copied.
+    """
+    def internal(key):
+        return ureg.Quantity(data[key], _INTERNAL_UNITS[key])
+
+    crystal = Crystal(internal('cell_vectors'), np.asarray(data['atom_r']),
+                      np.asarray(data['atom_type']), internal('atom_mass'))
+    crystal.cell_vectors_unit = data['cell_vectors_unit']
+    crystal.atom_mass_unit = data['atom_mass_unit']
+
+    if 'born' in data:
+        born, dielectric = internal('born'), internal('dielectric')
+    else:
+        born, dielectric = None, None
+
+    force_constants = ForceConstants(
+        crystal, internal('force_constants'),
+        np.asarray(data['sc_matrix']), np.asarray(data['cell_origins']),
+        born, dielectric)
+    for key in ('force_constants', 'born', 'dielectric'):
+        if key + '_unit' in data:
+            setattr(force_constants, key + '_unit', data[key + '_unit'])
+    return force_constants
+
+
+def precomputed_to_arrays(force_constants: ForceConstants,
+                          dipole_parameter: float = 1.0) -> Dict[str, Any]:
+    """Calculate q-independent phonon data, in a form for save_arrays
+
+    This is the data ForceConstants otherwise calculates and stores on its
+    first phonon calculation with the given dipole_parameter.
+    """
+    force_constants._calculate_supercell_images(_N_SC_SHELLS)
+    data = {'sc_image_i': force_constants._sc_image_i,
+            'n_sc_images': force_constants._n_sc_images}
+    if force_constants._born is not None:
+        dipole_init_data = force_constants._dipole_correction_init(
+            force_constants.crystal, force_constants._born,
+            force_constants._dielectric, dipole_parameter)
+        for key, value in dipole_init_data.items():
+            data[_DIPOLE_PREFIX + key] = value
+    return data
+
+
+def attach_precomputed(force_constants: ForceConstants,
+                       data: Dict[str, Any]) -> None:
+    """Set data from precomputed_to_arrays on force_constants
+
+    Later phonon calculations use it instead of recalculating it. The arrays
+    are identical, so the results are too.
+    """
+    force_constants._sc_image_i = data['sc_image_i']
+    force_constants._n_sc_images = data['n_sc_images']
+    dipole_init_data = {key[len(_DIPOLE_PREFIX):]: value
+                        for key, value in data.items()
+                        if key.startswith(_DIPOLE_PREFIX)}
+    if dipole_init_data:
+        force_constants._dipole_init_data = dipole_init_data
+
+
+def cached_precomputed(force_constants: ForceConstants,
+                       files_hash: str,
+                       cache_dir: str = DEFAULT_CACHE_DIR,
+                       dipole_parameter: float = 1.0) -> bool:
+    """Attach q-independent phonon data from cache, calculating if missing
+
+    Args:
+        force_constants: Force constants read from the files with files_hash
+        files_hash: Hash of force constants file(s) (see get_files_hash)
+        cache_dir: Base directory of cache
+        dipole_parameter: Ewald parameter of the phonon calculations which
+            will use the data (the euphonic default is 1.0)
+
+    Returns:
+        False if this version of euphonic does not prepare data in the
+        expected way, in which case nothing is attached
+    """
+    directory = os.path.join(
+        cache_dir, FC_CACHE_SUBDIR,
+        f'{files_hash}-precomputed-{euphonic.__version__}'
+        f'-dipole{dipole_parameter:g}')
+
+    data = load_arrays(directory)
+    if data is None:
+        try:
+            data = precomputed_to_arrays(force_constants, dipole_parameter)
+        except (AttributeError, TypeError):
+            return False
+        save_arrays(directory, data)
+        # Use the memory-mapped copy, so that worker processes which load
+        # the same entry share its pages
+        data = load_arrays(directory)
+    attach_precomputed(force_constants, data)
+    return True
+
+
+def cached_force_constants(filename: str,
+                           load: Callable[[], ForceConstants],
+                           cache_dir: str = DEFAULT_CACHE_DIR,
+                           precompute: bool = True
+                           ) -> Tuple[ForceConstants, str]:
+    """Get force constants from binary cache, calling load() if missing
+
+    Args:
+        filename: Force constants file (e.g. phonopy.yaml); for phonopy,
+            related data files in the same directory are also checked
+        load: Function which reads force constants from filename
+        cache_dir: Base directory of cache
+        precompute: Also attach cached q-independent phonon data (see
+            cached_precomputed), for the default dipole_parameter
+
+    Returns:
+        force_constants, files_hash:
+            files_hash is the hash_files of the source file(s), which can be
+            used to identify the material in other cache keys
+    """
+    files_hash = get_files_hash(filename, cache_dir)
+    directory = os.path.join(
+        cache_dir, FC_CACHE_SUBDIR,
+        f'{files_hash}-force-constants-v{_FC_FORMAT_VERSION}')
+
+    data = load_arrays(directory)
+    if data is not None:
+        force_constants = force_constants_from_arrays(data)
+    else:
+        force_constants = load()
+        save_arrays(directory, force_constants_to_arrays(force_constants))
+
+    if precompute:
+        cached_precomputed(force_constants, files_hash, cache_dir)
+    return force_constants, files_hash
+
+
+def cached_summary(filename: str,
+                   load: Callable[[], Dict[str, Any]],
+                   cache_dir: str = DEFAULT_CACHE_DIR) -> Dict[str, Any]:
+    """Get dict of arrays and values from binary cache, calling load() if
+    missing
+
+    This is intended for the raw data returned by
+    euphonic.readers.phonopy._extract_summary.
+    """
+    directory = os.path.join(cache_dir, FC_CACHE_SUBDIR,
+                             get_files_hash(filename, cache_dir) + '-summary')
+
+    data = load_arrays(directory)
+    if data is not None:
+        return data
+
+    data = load()
+    save_arrays(directory, data)
+    return data
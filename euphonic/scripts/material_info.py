@@ -0,0 +1,73 @@
+"""Per-material data needed to set up the powder convergence scripts
+
+Every script needs the Gamma-point frequencies (to choose an energy range)
+and some need the reciprocal cell. For polar materials the Gamma-point
+calculation includes the full Ewald setup, so these are stored in the
+DiskCache under a hash of the force constants file(s) and reused by all the
+scripts on later runs.
+"""
+
+from typing import Dict, Optional
+
+import numpy as np
+
+from euphonic import ureg, Quantity, ForceConstants
+
+from disk_cache import DiskCache, hash_key
+
+# Energy range is the Gamma-point maximum + 20%
+MAX_ENERGY_FACTOR = 1.2
+
+
+def get_material_info(force_constants: ForceConstants,
+                      *,
+                      fc_hash: Optional[str] = None,
+                      cache: Optional[DiskCache] = None
+                      ) -> Dict[str, Quantity]:
+    """Get Gamma-point frequencies, reciprocal cell and energy range
+
+    Args:
+        force_constants: Force constants of material
+        fc_hash: Hash of force constants file(s), from hash_files
+        cache: If provided (with fc_hash), look up and store results here
+
+    Returns:
+        dict:
+            'gamma_frequencies', 'reciprocal_cell' and 'max_energy' (the
+            Gamma-point maximum + 20%) as Quantities
+    """
+    key = hash_key(material_info=fc_hash)
+    if cache is not None and fc_hash is not None:
+        arrays = cache.load(key)
+        if arrays is not None:
+            return {name: arrays[name] * ureg(str(arrays[name + '_unit']))
+                    for name in ('gamma_frequencies', 'reciprocal_cell',
+                                 'max_energy')}
+
+    gamma_frequencies = (force_constants
+                         .calculate_qpoint_frequencies(np.array([[0, 0, 0]]))
+                         .frequencies[0].to('meV'))
+    reciprocal_cell = force_constants.crystal.reciprocal_cell
+    # Older versions of euphonic provide this as a method
+    if callable(reciprocal_cell):
+        reciprocal_cell = reciprocal_cell()
+    max_energy = np.max(gamma_frequencies) * MAX_ENERGY_FACTOR
+
+    info = {'gamma_frequencies': gamma_frequencies,
+            'reciprocal_cell': reciprocal_cell.to('1/angstrom'),
+            'max_energy': max_energy}
+
+    if cache is not None and fc_hash is not None:
+        arrays = {}
+        for name, value in info.items():
+            arrays[name] = value.magnitude
+            arrays[name + '_unit'] = np.array(str(value.units))
+        cache.save(key, **arrays)
+    return info
+
+
+def get_energy_bins(max_energy: Quantity, bin_width: Quantity) -> Quantity:
+    """Energy bin edges from zero to max_energy"""
+    return np.arange(0,
+                     max_energy.to('meV').magnitude,
+                     bin_width.to('meV').magnitude) * ureg('meV')
@@ -0,0 +1,436 @@
+"""Phonon modes precomputed on a grid over the Brillouin zone
+
+Powder averaging calculates phonons at a very large number of q-points on
+spheres of different |q|. Instead, the frequencies and eigenvectors can be
+calculated once on a regular grid of reduced wavevectors and stored on disk;
+the modes at any other q-point are then obtained by lookup:
+
+- For the DOS (calculate_qpoint_frequencies), frequencies are interpolated
+  trilinearly between the 8 surrounding grid points, band by band in order
+  of energy. The DOS does not depend on which mode is which, so this is
+  enough.
+- For structure factors (calculate_qpoint_phonon_modes), eigenvectors are
+  taken from the nearest grid point. Interpolating frequencies in energy
+  order would pair them with the eigenvectors of different modes wherever
+  bands cross, so instead each mode of the nearest point is matched at
+  every surrounding grid point to the mode with the largest eigenvector
+  overlap, and the frequencies of the matched modes are interpolated.
+  Euphonic's eigenvectors are periodic in the reciprocal lattice, so they
+  can be used with the full scattering vector.
+
+The error therefore depends on the grid spacing relative to the variation of
+the bands and their eigenvectors within a grid cell. This is not limited to
+small |q|: crossings and steep dispersion occur throughout the Brillouin
+zone, and the error is largest on spheres which pass close to any
+reciprocal lattice point, where the acoustic eigenvectors change quickly and
+their low frequencies give large structure factors. The LO-TO splitting of
+polar materials is not interpolated either. check_mode_grid compares S
+from the grid with a direct calculation on a few test points of each
+sphere, and fails if the difference is above a tolerance. converged_mode_grid
+applies this check before a grid is used for structure factors; unless a
+spacing is given, it starts from a coarse grid and halves the spacing until
+the check passes.
+
+Every grid point stores (3 n_atoms)^2 complex eigenvector components, so a
+fine grid of a large cell can need tens of GB. Grids larger than a memory
+limit are refused rather than built (see get_grid_memory).
+
+ModeGrid has calculate_qpoint_phonon_modes and calculate_qpoint_frequencies
+methods and a crystal attribute, so it can be used in place of
+ForceConstants by the sample_sphere_* functions. For the DOS, a grid of
+frequencies only (without eigenvectors) is enough.
+"""
+
+import os
+from typing import Optional, Tuple, Union
+
+import numpy as np
+
+from euphonic import ureg, Crystal, DebyeWaller, ForceConstants, Quantity
+from euphonic import QpointFrequencies, QpointPhononModes
+
+from broadening import WidthFunction, broaden
+from disk_cache import DEFAULT_CACHE_DIR
+from force_constants_cache import FC_CACHE_SUBDIR, ArraysWriter, load_arrays
+from profiling import PROFILER
+from sphere_sampling import DEFAULT_CHUNK_SIZE, sample_sphere_shells
+
+# Spacing of frequencies-only grids, and the starting spacing when
+# converging a grid with eigenvectors to a tolerance in S
+DEFAULT_GRID_SPACING = 0.05 * ureg('1/angstrom')
+DEFAULT_GRID_START_SPACING = 0.1 * ureg('1/angstrom')
+# Grids needing more memory than this (in MB) are not built
+DEFAULT_GRID_MAX_MEMORY = 4096
+# Relative RMS difference in S accepted by check_mode_grid, and number of
+# test points on each sphere
+DEFAULT_GRID_TOLERANCE = 0.02
+DEFAULT_CHECK_NPTS = 200
+
+# Offsets of the corners of a grid cell, for trilinear interpolation
+_CORNERS = np.array([[i, j, k] for i in (0, 1) for j in (0, 1)
+                     for k in (0, 1)])
+
+
+def get_grid_qpts(grid_shape: Tuple[int, int, int]) -> np.ndarray:
+    """Gamma-centred grid of reduced wavevectors in [0, 1)
+
+    Returns:
+        (n1 * n2 * n3, 3) array, in the order of a C-ordered (n1, n2, n3)
+        array
+    """
+    axes = [np.arange(n) / n for n in grid_shape]
+    return np.stack(np.meshgrid(*axes, indexing='ij'),
+                    axis=-1).reshape(-1, 3)
+
+
+class ModeGrid:
+    """Phonon frequencies and eigenvectors on a regular reduced-q grid
+
+    Args:
+        crystal: Crystal of the force constants used to build the grid
+        frequencies: (n1, n2, n3, n_modes) array of frequencies in meV at
+            the points of get_grid_qpts
+        eigenvectors: (n1, n2, n3, n_modes, n_atoms, 3) complex array of
+            corresponding eigenvectors, or None if only frequencies are
+            needed. May be memory-mapped.
+    """
+    def __init__(self, crystal: Crystal, frequencies: np.ndarray,
+                 eigenvectors: Optional[np.ndarray] = None) -> None:
+        self.crystal = crystal
+        self.frequencies = frequencies
+        self.eigenvectors = eigenvectors
+        self.grid_shape = np.array(frequencies.shape[:3])
+
+    @classmethod
+    def from_force_constants(cls, force_constants: ForceConstants,
+                             grid_shape: Tuple[int, int, int],
+                             *,
+                             writer: Optional[ArraysWriter] = None,
+                             eigenvectors: bool = True,
+                             max_memory: float = DEFAULT_GRID_MAX_MEMORY,
+                             chunk_size: int = DEFAULT_CHUNK_SIZE
+                             ) -> 'ModeGrid':
+        """Calculate modes at every grid point
+
+        Args:
+            force_constants: Force constants of material
+            grid_shape: Number of grid points along each reciprocal axis
+            writer: If provided, the arrays are created in this cache entry
+                and filled in place, rather than held in memory
+            eigenvectors: If False, only frequencies are calculated (by
+                eigenvalue-only diagonalisation) and stored
+            max_memory: Raise ValueError rather than build a grid needing
+                more than this many MB (see get_grid_memory)
+            chunk_size: Number of q-points per phonon calculation
+        """
+        grid_shape = tuple(int(n) for n in grid_shape)
+        n_atoms = force_constants.crystal.n_atoms
+        memory = get_grid_memory(n_atoms, grid_shape, eigenvectors)
+        if memory > max_memory:
+            raise ValueError(
+                'x'.join(map(str, grid_shape)) + f' mode grid would need '
+                f'{memory:.0f} MB, more than the limit of {max_memory:.0f} '
+                'MB; use a coarser spacing or raise the limit')
+        shape = grid_shape + (3 * n_atoms,)
+        vectors_shape = shape + (n_atoms, 3)
+        if writer is None:
+            frequencies = np.empty(shape)
+            vectors = (np.empty(vectors_shape, dtype=complex)
+                       if eigenvectors else None)
+        else:
+            frequencies = writer.new_array('frequencies', shape, float)
+            vectors = (writer.new_array('eigenvectors', vectors_shape,
+                                        complex)
+                       if eigenvectors else None)
+
+        qpts = get_grid_qpts(grid_shape)
+        flat_frequencies = frequencies.reshape(len(qpts), -1)
+        if eigenvectors:
+            flat_vectors = vectors.reshape((len(qpts),) + vectors_shape[3:])
+        for start in range(0, len(qpts), chunk_size):
+            chunk = slice(start, start + chunk_size)
+            with PROFILER.stage('mode-grid', n_qpts=len(qpts[chunk])):
+                if eigenvectors:
+                    modes = force_constants.calculate_qpoint_phonon_modes(
+                        qpts[chunk])
+                    flat_vectors[chunk] = modes.eigenvectors
+                else:
+                    modes = force_constants.calculate_qpoint_frequencies(
+                        qpts[chunk])
+                flat_frequencies[chunk] = modes.frequencies.to(
+                    'meV').magnitude
+        return cls(force_constants.crystal, frequencies, vectors)
+
+    def _locate(self, qpts: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Lower corner index and fractional position in grid cell"""
+        position = np.mod(qpts, 1) * self.grid_shape
+        lower = np.floor(position).astype(int)
+        return lower, position - lower
+
+    def _interpolate_frequencies(self, qpts: np.ndarray) -> np.ndarray:
+        lower, fraction = self._locate(qpts)
+        frequencies = np.zeros((len(qpts), self.frequencies.shape[-1]))
+        for corner in _CORNERS:
+            index = np.mod(lower + corner, self.grid_shape)
+            weight = np.prod(np.where(corner, fraction, 1 - fraction),
+                             axis=1)
+            frequencies += (weight[:, np.newaxis]
+                            * self.frequencies[tuple(index.T)])
+        return frequencies
+
+    def _nearest_index(self, qpts: np.ndarray) -> tuple:
+        index = np.mod(np.rint(np.mod(qpts, 1) * self.grid_shape).astype(int),
+                       self.grid_shape)
+        return tuple(index.T)
+
+    def _matched_frequencies(self, qpts: np.ndarray,
+                             nearest: tuple) -> np.ndarray:
+        """Interpolate frequencies of the modes of the nearest grid points
+
+        At each corner, every mode of the nearest grid point is matched to
+        the mode with the largest eigenvector overlap |<e|e'>|^2. Modes in a
+        degenerate subspace may match the same corner mode, but then their
+        frequencies are the same.
+        """
+        vectors = self.eigenvectors[nearest]
+        lower, fraction = self._locate(qpts)
+        frequencies = np.zeros((len(qpts), self.frequencies.shape[-1]))
+        for corner in _CORNERS:
+            index = tuple(np.mod(lower + corner, self.grid_shape).T)
+            overlap = np.abs(np.einsum('qmax,qnax->qmn', vectors.conj(),
+                                       self.eigenvectors[index]))
+            match = np.argmax(overlap, axis=2)
+            weight = np.prod(np.where(corner, fraction, 1 - fraction),
+                             axis=1)
+            frequencies += weight[:, np.newaxis] * np.take_along_axis(
+                self.frequencies[index], match, axis=1)
+        return frequencies
+
+    def calculate_qpoint_frequencies(self, qpts: np.ndarray
+                                     ) -> QpointFrequencies:
+        """Interpolated frequencies at reduced wavevectors qpts"""
+        return QpointFrequencies(
+            self.crystal, qpts,
+            self._interpolate_frequencies(qpts) * ureg('meV'))
+
+    def calculate_qpoint_phonon_modes(self, qpts: np.ndarray
+                                      ) -> QpointPhononModes:
+        """Nearest-grid-point eigenvectors, with mode-matched frequencies
+
+        qpts may lie outside the first Brillouin zone; the returned modes use
+        them unchanged, so that structure factors are calculated for the
+        full scattering vector.
+        """
+        if self.eigenvectors is None:
+            raise ValueError('This ModeGrid was built without eigenvectors')
+        nearest = self._nearest_index(qpts)
+        return QpointPhononModes(
+            self.crystal, qpts,
+            self._matched_frequencies(qpts, nearest) * ureg('meV'),
+            self.eigenvectors[nearest])
+
+
+def get_mode_grid_error(mode_grid: ModeGrid,
+                        force_constants: ForceConstants,
+                        mod_q: Quantity,
+                        *,
+                        energy_bins: Quantity,
+                        width: Union[Quantity, WidthFunction],
+                        dw: Optional[DebyeWaller] = None,
+                        npts: int = DEFAULT_CHECK_NPTS,
+                        chunk_size: int = DEFAULT_CHUNK_SIZE) -> float:
+    """Compare S from a ModeGrid with a direct calculation on test points
+
+    The coherent S is calculated for the same npts golden-sphere points on
+    each shell from the grid and from the force constants, broadened by
+    width and compared.
+
+    Args:
+        mode_grid: ModeGrid with eigenvectors
+        force_constants: Force constants used to build mode_grid
+        mod_q: 1-D array Quantity of sphere radii to test
+        energy_bins: Energy bin edges of test spectra
+        width: Broadening width (or function of energy) applied to both
+            spectra before comparison
+        dw: Debye-Waller factor for S. If None, the Debye-Waller and Bose
+            factors are omitted from both spectra.
+        npts: Number of test points on each sphere
+        chunk_size: Maximum number of q-points per phonon calculation
+
+    Returns:
+        Largest RMS difference over the shells, relative to the RMS of the
+        direct spectrum
+    """
+    options = dict(energy_bins=energy_bins, npts=npts, dw=dw,
+                   temperature=(None if dw is None else dw.temperature),
+                   chunk_size=chunk_size)
+    with PROFILER.stage('mode-grid-check'):
+        spectra = [broaden(sample_sphere_shells(sampler, mod_q, **options),
+                           width)
+                   for sampler in (mode_grid, force_constants)]
+
+    # RMS difference of each shell relative to the RMS of its reference,
+    # which unlike a per-bin relative difference is not dominated by the
+    # tails of the peaks
+    grid_z, ref_z = (spectrum.z_data.to(spectra[1].z_data_unit).magnitude
+                     for spectrum in spectra)
+    diff_sq = np.mean(np.square(grid_z - ref_z), axis=1)
+    ref_sq = np.mean(np.square(ref_z), axis=1)
+    errors = np.sqrt(np.divide(diff_sq, ref_sq, out=np.zeros_like(diff_sq),
+                               where=(ref_sq > 0)))
+    error = float(np.max(errors))
+    print("Mode grid " + 'x'.join(map(str, mode_grid.grid_shape))
+          + f": relative RMS error in S = {error:.3g}")
+    return error
+
+
+def check_mode_grid(mode_grid: ModeGrid,
+                    force_constants: ForceConstants,
+                    mod_q: Quantity,
+                    *,
+                    tolerance: float = DEFAULT_GRID_TOLERANCE,
+                    **kwargs) -> float:
+    """Raise ValueError if S from a ModeGrid is not accurate to tolerance
+
+    Arguments are as for get_mode_grid_error, with tolerance the largest
+    acceptable relative RMS difference. Returns the difference.
+    """
+    error = get_mode_grid_error(mode_grid, force_constants, mod_q, **kwargs)
+    if error > tolerance:
+        raise ValueError(f'Mode grid error in S ({error:.3g}) is above '
+                         f'tolerance {tolerance}; use a finer --mode-grid '
+                         'spacing')
+    return error
+
+
+def get_grid_shape(crystal: Crystal, spacing: Quantity) -> Tuple[int, ...]:
+    """Grid dimensions giving at most the requested reciprocal spacing"""
+    return tuple(int(n) for n in crystal.get_mp_grid_spec(spacing))
+
+
+def get_grid_memory(n_atoms: int, grid_shape: Tuple[int, ...],
+                    eigenvectors: bool = True) -> float:
+    """Size in MB of the arrays of a ModeGrid
+
+    Each grid point has 3 n_atoms frequencies and, with eigenvectors,
+    (3 n_atoms)^2 complex eigenvector components.
+    """
+    n_modes = 3 * n_atoms
+    item_size = 8 + (16 * n_modes if eigenvectors else 0)
+    return float(np.prod(grid_shape)) * n_modes * item_size / 1024**2
+
+
+def cached_mode_grid(force_constants: ForceConstants,
+                     *,
+                     spacing: Quantity = DEFAULT_GRID_SPACING,
+                     fc_hash: Optional[str] = None,
+                     cache_dir: Optional[str] = DEFAULT_CACHE_DIR,
+                     eigenvectors: bool = True,
+                     max_memory: float = DEFAULT_GRID_MAX_MEMORY,
+                     chunk_size: int = DEFAULT_CHUNK_SIZE) -> ModeGrid:
+    """Get ModeGrid from binary cache, building and storing it if missing
+
+    Args:
+        force_constants: Force constants of material
+        spacing: Maximum grid spacing in reciprocal length units
+        fc_hash: Hash of force constants file(s) (see get_files_hash). If
+            this or cache_dir is None, the grid is built in memory and not
+            stored.
+        cache_dir: Base directory of cache
+        eigenvectors: If False, a grid of frequencies only is sufficient
+            (e.g. for the DOS). An existing grid with eigenvectors is used if
+            there is one; otherwise a cheaper frequencies-only grid is built.
+        max_memory: Raise ValueError rather than build a grid needing more
+            than this many MB
+        chunk_size: Number of q-points per phonon calculation when building
+    """
+    grid_shape = get_grid_shape(force_constants.crystal, spacing)
+    if fc_hash is None or cache_dir is None:
+        return ModeGrid.from_force_constants(force_constants, grid_shape,
+                                             eigenvectors=eigenvectors,
+                                             max_memory=max_memory,
+                                             chunk_size=chunk_size)
+
+    grid_name = 'x'.join(map(str, grid_shape))
+    directory = os.path.join(cache_dir, FC_CACHE_SUBDIR,
+                             f'{fc_hash}-mode-grid-{grid_name}')
+    data = load_arrays(directory)
+    if data is None and not eigenvectors:
+        directory += '-frequencies'
+        data = load_arrays(directory)
+    if data is None:
+        print(f"Building {grid_name} mode grid"
+              + ('' if eigenvectors else ' (frequencies only)'))
+        with ArraysWriter(directory) as writer:
+            ModeGrid.from_force_constants(force_constants, grid_shape,
+                                          writer=writer,
+                                          eigenvectors=eigenvectors,
+                                          max_memory=max_memory,
+                                          chunk_size=chunk_size)
+        data = load_arrays(directory)
+    return ModeGrid(force_constants.crystal, data['frequencies'],
+                    data.get('eigenvectors') if eigenvectors else None)
+
+
+def converged_mode_grid(force_constants: ForceConstants,
+                        mod_q: Quantity,
+                        *,
+                        energy_bins: Quantity,
+                        width: Union[Quantity, WidthFunction],
+                        dw: Optional[DebyeWaller] = None,
+                        spacing: Optional[Quantity] = None,
+                        tolerance: float = DEFAULT_GRID_TOLERANCE,
+                        max_memory: float = DEFAULT_GRID_MAX_MEMORY,
+                        fc_hash: Optional[str] = None,
+                        cache_dir: Optional[str] = DEFAULT_CACHE_DIR,
+                        chunk_size: int = DEFAULT_CHUNK_SIZE
+                        ) -> Tuple[ModeGrid, Quantity]:
+    """Get a ModeGrid with eigenvectors whose S passes check_mode_grid
+
+    Args:
+        force_constants: Force constants of material
+        mod_q, energy_bins, width, dw: Spheres and spectra on which the grid
+            is checked, as for check_mode_grid
+        spacing: Grid spacing in reciprocal length units. If given, a grid
+            with this spacing is checked and ValueError raised if its error
+            is above tolerance. Otherwise the spacing is halved, starting from
+            DEFAULT_GRID_START_SPACING, until the error is within tolerance;
+            ValueError is raised if the next grid would need more than
+            max_memory.
+        tolerance: Largest acceptable relative RMS difference in S
+        max_memory: Largest grid to build in MB (see get_grid_memory)
+        fc_hash, cache_dir, chunk_size: As for cached_mode_grid
+
+    Returns:
+        mode_grid, spacing:
+            Checked ModeGrid and the spacing used to build it
+    """
+    options = dict(fc_hash=fc_hash, cache_dir=cache_dir,
+                   max_memory=max_memory, chunk_size=chunk_size)
+    check_options = dict(energy_bins=energy_bins, width=width, dw=dw,
+                         chunk_size=chunk_size)
+    if spacing is not None:
+        mode_grid = cached_mode_grid(force_constants, spacing=spacing,
+                                     **options)
+        check_mode_grid(mode_grid, force_constants, mod_q,
+                        tolerance=tolerance, **check_options)
+        return mode_grid, spacing
+
+    spacing = DEFAULT_GRID_START_SPACING
+    while True:
+        mode_grid = cached_mode_grid(force_constants, spacing=spacing,
+                                     **options)
+        error = get_mode_grid_error(mode_grid, force_constants, mod_q,
+                                    **check_options)
+        if error <= tolerance:
+            return mode_grid, spacing
+        spacing = spacing / 2
+        grid_shape = get_grid_shape(force_constants.crystal, spacing)
+        memory = get_grid_memory(force_constants.crystal.n_atoms, grid_shape)
+        if memory > max_memory:
+            raise ValueError(
+                f'Mode grid not converged to tolerance {tolerance} in S '
+                f'(error {error:.3g}); the next grid, '
+                + 'x'.join(map(str, grid_shape)) + f', would need '
+                f'{memory:.0f} MB, more than the limit of {max_memory:.0f} '
+                'MB')
@@ -1,62 +1,151 @@
 #! /usr/bin/env python3
 # euphonic 0.6.4+7.gded0c57
 
-import sys
+import argparse
 
 import matplotlib.pyplot as plt
+from mpl_toolkits.mplot3d.art3d import Line3DCollection
 import numpy as np
 
 from euphonic.readers.phonopy import _extract_summary
 
-def plot_cell(ax, vecs, trans=np.zeros((3, 3)), color=None):
-    for i, vec in enumerate(vecs):
-        ax.plot([0, vec[0]] + trans[0],
-                [0, vec[1]] + trans[1],
-                [0, vec[2]] + trans[2], color=color)
-
-if len(sys.argv) > 1:
-    summary_file = sys.argv[1]
-else:
-    raise ValueError('Input phonopy.yaml required')
-
-cell_info = _extract_summary(summary_file, fc_extract=True)
-vecs = cell_info['cell_vectors']
-atom_r_cart = np.einsum('ij,jk->ik', cell_info['atom_r'], vecs)
-sc_atom_r_cart = np.einsum('ij,jk->ik', cell_info['sc_atom_r'], vecs)
-
-co_per_atom = cell_info['sc_atom_r'] - cell_info['atom_r'][cell_info['sc_to_pc_atom_idx']]
-non_int = np.where(np.abs(co_per_atom
-                          - np.rint(co_per_atom)) > 1e-5)[0]
-if len(non_int) > 0:
-    raise RuntimeError(
-        f'Non-integer cell origins for atom(s) '
-        f'{", ".join(non_int.astype(str))}, '
-        f'check coordinates and indices are correct')
-co_per_atom = np.rint(co_per_atom).astype(np.int32)
-co_per_atom_cart = np.einsum('ij,jk->ik', co_per_atom, vecs)
-_, co_idx = np.unique(co_per_atom, return_inverse=True, axis=0)
-sc_atom_type = [cell_info['atom_type'][sc_idx] for sc_idx in cell_info['sc_to_pc_atom_idx']]
-_, type_idx = np.unique(sc_atom_type, return_inverse=True)
+from disk_cache import DiskCache, DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE
+from force_constants_cache import cached_summary
 
 markers = ['o', 'x', '^', 's', ]
 colors = ['c', 'orange', 'm', 'g', 'r', 'b', 'y', 'indigo']
 
-# Create plot
-fig = plt.figure()
-ax = fig.add_subplot(projection='3d')
-
-# Plot original unit cell
-for i in range(len(atom_r_cart)):
-    ax.scatter(*atom_r_cart[i], color='k', alpha=0.5, marker='s', s=50)
-# Plot supercell
-for i, sc_atom_r_cart_i in enumerate(sc_atom_r_cart):
-    marker = markers[type_idx[i]%len(markers)]
-    color = colors[co_idx[i]%len(colors)]
-    # Plot atoms
-    ax.scatter(*sc_atom_r_cart_i, color=color, marker=marker)
-    # Plot cell origins
-    ax.scatter(*co_per_atom_cart[i], color=color, marker='*')
-    # Plot cell vectors
-    plot_cell(ax, vecs, trans=co_per_atom_cart[i], color=color)
-
-plt.show()
+DEFAULT_MAX_CELLS = 500
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description=('Plot the atoms of a Phonopy supercell, coloured by '
+                     'the unit cell they belong to'))
+    parser.add_argument('file', type=str, help='Path to Phonopy YAML file')
+    parser.add_argument('--max-cells', type=int, default=DEFAULT_MAX_CELLS,
+                        dest='max_cells',
+                        help=("For supercells with more unit cells than "
+                              "this, draw the atoms of only a random subset "
+                              "of this many cells (cell frames are still "
+                              "drawn for all of them)"))
+    parser.add_argument('--frames-only', action='store_true',
+                        dest='frames_only',
+                        help="Draw only the cell frames and origins")
+    parser.add_argument('--cache-dir', type=str, default=DEFAULT_CACHE_DIR,
+                        dest='cache_dir',
+                        help=("Directory for on-disk cache of binary copies "
+                              "of parsed Phonopy data"))
+    parser.add_argument('--cache-size', type=float,
+                        default=DEFAULT_CACHE_SIZE, dest='cache_size',
+                        help="Maximum size of on-disk cache in MB")
+    parser.add_argument('--no-cache', action='store_false', dest='use_cache',
+                        help="Always parse the Phonopy YAML file")
+    return parser
+
+
+def cell_segments(vecs: np.ndarray, origins: np.ndarray) -> np.ndarray:
+    """Line segments of the cell vectors starting at each origin
+
+    Returns:
+        (n_origins * 3, 2, 3) array of segment end points
+    """
+    starts = np.repeat(origins, len(vecs), axis=0)
+    ends = starts + np.tile(vecs, (len(origins), 1))
+    return np.stack([starts, ends], axis=1)
+
+
+def plot_cells(ax, vecs: np.ndarray, origins: np.ndarray,
+               origin_colors: list) -> Line3DCollection:
+    """Draw the cell vectors at all origins as a single collection"""
+    segments = cell_segments(vecs, origins)
+    lines = Line3DCollection(segments,
+                             colors=np.repeat(origin_colors, len(vecs)))
+    ax.add_collection3d(lines)
+    ax.auto_scale_xyz(*segments.reshape(-1, 3).T, had_data=True)
+    return lines
+
+
+def get_cell_subset(n_cells: int, max_cells: int) -> np.ndarray:
+    """Indices of a reproducible random subset of max_cells cells
+
+    Unlike a regular stride, this does not pick out only some of the
+    colours, which repeat with the cell index.
+    """
+    rng = np.random.default_rng(0)
+    return np.sort(rng.choice(n_cells, size=max_cells, replace=False))
+
+
+def main():
+    args = get_parser().parse_args()
+    summary_file = args.file
+
+    def load_summary():
+        return _extract_summary(summary_file, fc_extract=True)
+
+    if args.use_cache:
+        # Reuse binary copy of parsed data if phonopy.yaml has been read
+        # before; opening the cache also keeps it within --cache-size
+        DiskCache(args.cache_dir, max_size=args.cache_size)
+        cell_info = cached_summary(summary_file, load_summary,
+                                   args.cache_dir)
+    else:
+        cell_info = load_summary()
+    vecs = cell_info['cell_vectors']
+    atom_r_cart = np.einsum('ij,jk->ik', cell_info['atom_r'], vecs)
+    sc_atom_r_cart = np.einsum('ij,jk->ik', cell_info['sc_atom_r'], vecs)
+
+    co_per_atom = (cell_info['sc_atom_r']
+                   - cell_info['atom_r'][cell_info['sc_to_pc_atom_idx']])
+    non_int = np.where(np.abs(co_per_atom
+                              - np.rint(co_per_atom)) > 1e-5)[0]
+    if len(non_int) > 0:
+        raise RuntimeError(
+            f'Non-integer cell origins for atom(s) '
+            f'{", ".join(non_int.astype(str))}, '
+            f'check coordinates and indices are correct')
+    co_per_atom = np.rint(co_per_atom).astype(np.int32)
+    # Each cell origin is drawn once, however many atoms it has
+    unique_co, co_idx = np.unique(co_per_atom, return_inverse=True, axis=0)
+    co_idx = co_idx.ravel()
+    unique_co_cart = np.einsum('ij,jk->ik', unique_co, vecs)
+    sc_atom_type = np.array(cell_info['atom_type'])[
+        cell_info['sc_to_pc_atom_idx']]
+    _, type_idx = np.unique(sc_atom_type, return_inverse=True)
+    type_idx = type_idx.ravel()
+    co_colors = [colors[i % len(colors)] for i in range(len(unique_co))]
+
+    # Create plot
+    fig = plt.figure()
+    ax = fig.add_subplot(projection='3d')
+
+    # Plot original unit cell
+    ax.scatter(*atom_r_cart.T, color='k', alpha=0.5, marker='s', s=50)
+
+    # Plot cell vectors and origins, grouped by colour
+    plot_cells(ax, vecs, unique_co_cart, co_colors)
+    for color_i, color in enumerate(colors):
+        in_group = np.arange(len(unique_co)) % len(colors) == color_i
+        if np.any(in_group):
+            ax.scatter(*unique_co_cart[in_group].T, color=color, marker='*')
+
+    # Plot supercell atoms, one scatter per (type, origin colour) group
+    if not args.frames_only:
+        cells = np.arange(len(unique_co))
+        if len(unique_co) > args.max_cells:
+            cells = get_cell_subset(len(unique_co), args.max_cells)
+            print(f'Supercell has {len(unique_co)} cells; drawing atoms of '
+                  f'{len(cells)} of them (see --max-cells)')
+        shown = np.isin(co_idx, cells)
+        groups = np.stack([type_idx % len(markers),
+                           co_idx % len(colors)], axis=1)
+        for marker_i, color_i in np.unique(groups[shown], axis=0):
+            in_group = shown & np.all(groups == (marker_i, color_i), axis=1)
+            ax.scatter(*sc_atom_r_cart[in_group].T, color=colors[color_i],
+                       marker=markers[marker_i])
+
+    plt.show()
+
+
+if __name__ == '__main__':
+    main()
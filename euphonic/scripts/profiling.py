@@ -0,0 +1,164 @@
+"""Optional timing instrumentation for the powder convergence scripts
+
+Stages of a calculation (sampling, phonon calculation, histogramming,
+broadening, comparison...) are wrapped in PROFILER.stage(), and the option set
+being calculated in PROFILER.options(). When the profiler is enabled (with
+the scripts' --profile option), wall time, number of q-points and peak memory
+are accumulated for each (option set, stage) and written as one row of a
+JSON or CSV report. When it is disabled these context managers do nothing.
+"""
+
+import contextlib
+import csv
+import json
+import sys
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+REPORT_FIELDS = ('options', 'stage', 'calls', 'wall_time', 'n_qpts',
+                 'qpts_per_second', 'peak_rss_mb')
+
+
+def get_peak_rss() -> Optional[float]:
+    """Peak resident memory of this process so far in MB, if available"""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS, kB elsewhere
+    if sys.platform == 'darwin':
+        return max_rss / 1024**2
+    return max_rss / 1024
+
+
+class Profiler:
+    """Accumulate wall time, q-points and peak memory per (options, stage)
+
+    Note that peak RSS is the high-water mark of the whole process at the end
+    of the stage, so it is only an upper bound on the memory used by that
+    stage.
+    """
+    def __init__(self) -> None:
+        self.enabled = False
+        self._options = {}
+        self._records = {}
+
+    @contextlib.contextmanager
+    def options(self, **options: Any) -> Iterator[None]:
+        """Label stages within this context with a set of options
+
+        Nested contexts add to (or override) the enclosing options.
+        """
+        previous = self._options
+        self._options = {**previous, **options}
+        try:
+            yield
+        finally:
+            self._options = previous
+
+    def _options_label(self) -> str:
+        return ', '.join(f'{key}={value}'
+                         for key, value in self._options.items())
+
+    @contextlib.contextmanager
+    def stage(self, name: str, n_qpts: int = 0) -> Iterator[Dict[str, int]]:
+        """Time the enclosed code as stage name of the current option set
+
+        Yields a dict whose 'n_qpts' entry may be updated if the number of
+        q-points processed is not known in advance.
+        """
+        info = {'n_qpts': n_qpts}
+        if not self.enabled:
+            yield info
+            return
+
+        start = time.perf_counter()
+        try:
+            yield info
+        finally:
+            self._add(self._options_label(), name,
+                      wall_time=time.perf_counter() - start,
+                      n_qpts=info['n_qpts'], calls=1,
+                      peak_rss_mb=get_peak_rss())
+
+    def iterate(self, name: str, iterable: Iterable,
+                count=None) -> Iterator:
+        """Yield from iterable, timing the production of each item as a stage
+
+        This is used for lazy generators (e.g. of sampling points) whose work
+        happens as they are consumed. count(item), if given, is the number of
+        q-points in each item.
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name) as info:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                if count is not None:
+                    info['n_qpts'] = count(item)
+            yield item
+
+    def _add(self, options: str, stage: str, *, wall_time: float,
+             n_qpts: int, calls: int, peak_rss_mb: Optional[float]) -> None:
+        record = self._records.setdefault(
+            (options, stage), {'options': options, 'stage': stage,
+                               'calls': 0, 'wall_time': 0., 'n_qpts': 0,
+                               'peak_rss_mb': None})
+        record['calls'] += calls
+        record['wall_time'] += wall_time
+        record['n_qpts'] += n_qpts
+        if peak_rss_mb is not None:
+            record['peak_rss_mb'] = max(record['peak_rss_mb'] or 0,
+                                        peak_rss_mb)
+
+    def pop_records(self) -> List[Dict[str, Any]]:
+        """Remove and return the records accumulated so far
+
+        This is used to send records from worker processes back to the main
+        process, which adds them with merge().
+        """
+        records = list(self._records.values())
+        self._records = {}
+        return records
+
+    def merge(self, records: Iterable[Dict[str, Any]]) -> None:
+        """Add records from pop_records() of another profiler"""
+        for record in records:
+            self._add(record['options'], record['stage'],
+                      wall_time=record['wall_time'],
+                      n_qpts=record['n_qpts'], calls=record['calls'],
+                      peak_rss_mb=record['peak_rss_mb'])
+
+    def report(self) -> List[Dict[str, Any]]:
+        """One row per (option set, stage), in order of first use"""
+        rows = []
+        for record in self._records.values():
+            row = dict(record)
+            row['qpts_per_second'] = (record['n_qpts'] / record['wall_time']
+                                      if record['n_qpts']
+                                      and record['wall_time'] else None)
+            rows.append({field: row[field] for field in REPORT_FIELDS})
+        return rows
+
+    def write(self, filename: str) -> None:
+        """Write report as CSV if filename ends in .csv, otherwise JSON"""
+        rows = self.report()
+        if filename.endswith('.csv'):
+            with open(filename, 'w', newline='') as fd:
+                writer = csv.DictWriter(fd, fieldnames=REPORT_FIELDS)
+                writer.writeheader()
+                writer.writerows(rows)
+        else:
+            with open(filename, 'w') as fd:
+                json.dump(rows, fd, indent=2)
+
+
+# Shared by all modules, so that library functions can be instrumented
+# without passing a profiler around
+PROFILER = Profiler()
@@ -0,0 +1,227 @@
+"""Force constants with small real-space terms removed
+
+For metals such as Nb the force constants are long-ranged, so the supercell
+is large (1728 cells for Nb) and building the dynamical matrix dominates the
+phonon calculation (51% of the time in the profile in
+01_parallelism_options.md). Most of the 3x3 blocks Phi(R; i, j) far from the
+origin are tiny, however.
+
+PrunedForceConstants drops every block whose norm is below a fraction of the
+largest one, and stores the rest in a sparse matrix mapping the phases
+exp(2 pi i q.R) of each remaining (cell, supercell image) lattice vector to
+the elements of the mass-weighted dynamical matrix. The dynamical matrices
+for a whole chunk of q-points are then one sparse-dense product.
+
+The dropped part of the dynamical matrix is bounded by the same norm at
+every q, so by Weyl's inequality each eigenvalue w^2 changes by at most
+eigenvalue_error_bound. frequency_error_bound and get_frequency_error_bound
+convert this to the largest possible error in each frequency, so that the
+tolerance can be chosen knowing what accuracy is given up.
+
+The dipole correction of polar materials is not supported; these have
+short-ranged force constants once the dipole part is removed, so little
+would be gained. Like ModeGrid, PrunedForceConstants has
+calculate_qpoint_phonon_modes and calculate_qpoint_frequencies methods and a
+crystal attribute, so it can be used in place of ForceConstants by the
+sample_sphere_* functions.
+"""
+
+from typing import Optional
+
+import numpy as np
+import scipy.sparse
+
+from euphonic import ureg, ForceConstants, Quantity
+from euphonic import QpointFrequencies, QpointPhononModes
+from euphonic.util import get_all_origins
+
+DEFAULT_PRUNE_TOLERANCE = 1e-3
+# Supercells searched for atom images, as in ForceConstants
+_N_SC_SHELLS = 2
+
+
+class PrunedForceConstants:
+    """Sparse force constants without the blocks smaller than a tolerance
+
+    Args:
+        force_constants: Force constants of a non-polar material
+        tolerance: Drop blocks Phi(R; i, j) whose 2-norm is less than this
+            fraction of the largest block's
+        acoustic_sum_rule: Add the sum of the dropped blocks of each atom to
+            its on-site block, so that the acoustic modes remain at zero
+            frequency at Gamma. This is included in the error bound.
+
+    Raises:
+        ValueError: force_constants has Born charges
+    """
+    def __init__(self, force_constants: ForceConstants,
+                 tolerance: float = DEFAULT_PRUNE_TOLERANCE,
+                 *,
+                 acoustic_sum_rule: bool = True) -> None:
+        if force_constants.born is not None:
+            raise ValueError('Pruned force constants cannot be used for '
+                             'polar materials (with Born charges)')
+        self.crystal = force_constants.crystal
+        self.tolerance = tolerance
+        n_atoms = self.crystal.n_atoms
+        n_cells = len(force_constants.cell_origins)
+
+        if not hasattr(force_constants, '_sc_image_i'):
+            force_constants._calculate_supercell_images(_N_SC_SHELLS)
+        # (n_cells, n_atoms, n_atoms, 3, 3) blocks in atomic units
+        blocks = force_constants._force_constants.reshape(
+            n_cells, n_atoms, 3, n_atoms, 3).transpose(0, 1, 3, 2, 4)
+        norms = np.linalg.norm(blocks, ord=2, axis=(-2, -1))
+        keep = norms >= tolerance * norms.max()
+
+        origin_cell = np.flatnonzero(
+            ~np.any(force_constants.cell_origins, axis=1))[0]
+        on_site = (origin_cell, np.arange(n_atoms), np.arange(n_atoms))
+        keep[on_site] = True
+        dropped = np.where(keep[..., np.newaxis, np.newaxis], 0, blocks)
+        blocks = blocks - dropped
+        if acoustic_sum_rule:
+            correction = dropped.sum(axis=(0, 2))
+            blocks[on_site] += correction
+        else:
+            correction = np.zeros((n_atoms, 3, 3))
+
+        inv_sqrt_mass = 1 / np.sqrt(self.crystal._atom_mass)
+        mass_weighting = np.outer(inv_sqrt_mass, inv_sqrt_mass)
+        self._set_entries(force_constants, blocks, keep, mass_weighting)
+
+        # Spectral norm of the dropped part of the dynamical matrix is at
+        # most that of the matrix of its block norms, at every q
+        dropped_norms = (np.linalg.norm(dropped, ord=2, axis=(-2, -1))
+                         .sum(axis=0))
+        dropped_norms[np.diag_indices(n_atoms)] += np.linalg.norm(
+            correction, ord=2, axis=(-2, -1))
+        self._eigenvalue_error_bound = np.linalg.norm(
+            dropped_norms * mass_weighting, ord=2)
+        self.kept_fraction = keep.sum() / keep.size
+
+    def _set_entries(self, force_constants: ForceConstants,
+                     blocks: np.ndarray, keep: np.ndarray,
+                     mass_weighting: np.ndarray) -> None:
+        """Build lattice vectors and sparse matrix of the kept blocks"""
+        n_atoms = self.crystal.n_atoms
+        sc_origins = (get_all_origins(np.repeat(_N_SC_SHELLS, 3) + 1,
+                                      min_xyz=-np.repeat(_N_SC_SHELLS, 3))
+                      @ force_constants.sc_matrix)
+
+        cell_i, atom_i, atom_j = np.nonzero(keep)
+        n_images = force_constants._n_sc_images[cell_i, atom_i, atom_j]
+        # One entry per kept block and supercell image of atom j
+        entry_block = np.repeat(np.arange(len(cell_i)), n_images)
+        image_i = np.arange(len(entry_block)) - np.repeat(
+            np.cumsum(n_images) - n_images, n_images)
+        sc_image = force_constants._sc_image_i[
+            cell_i[entry_block], atom_i[entry_block], atom_j[entry_block],
+            image_i]
+        self._lattice_vectors = (
+            force_constants.cell_origins[cell_i[entry_block]]
+            + sc_origins[sc_image])
+
+        values = (blocks[cell_i, atom_i, atom_j]
+                  * (mass_weighting[atom_i, atom_j]
+                     / n_images)[:, np.newaxis, np.newaxis])[entry_block]
+        # Element (3i + a, 3j + b) of the flattened dynamical matrix
+        xyz = np.arange(3)
+        rows = 3 * atom_i[:, None, None] + xyz[None, :, None]
+        cols = 3 * atom_j[:, None, None] + xyz[None, None, :]
+        elements = (rows * 3 * n_atoms + cols)[entry_block]
+        entries = np.broadcast_to(
+            np.arange(len(entry_block))[:, None, None], elements.shape)
+        self._dyn_mat_matrix = scipy.sparse.csr_matrix(
+            (values.ravel(), (elements.ravel(), entries.ravel())),
+            shape=((3 * n_atoms)**2, len(entry_block)))
+
+    @property
+    def n_entries(self) -> int:
+        """Number of (block, supercell image) terms in each dynamical matrix"""
+        return len(self._lattice_vectors)
+
+    @property
+    def eigenvalue_error_bound(self) -> Quantity:
+        """Largest possible change in any eigenvalue w^2 due to pruning"""
+        return ureg.Quantity(self._eigenvalue_error_bound,
+                             'hartree**2').to('meV**2')
+
+    @property
+    def frequency_error_bound(self) -> Quantity:
+        """Largest possible change in any frequency due to pruning
+
+        This is reached only if an eigenvalue changes sign (a real frequency
+        becoming imaginary, returned as negative, or the reverse); see
+        get_frequency_error_bound for the much smaller bounds of most
+        frequencies.
+        """
+        return ureg.Quantity(np.sqrt(2 * self._eigenvalue_error_bound),
+                             'hartree').to('meV')
+
+    def get_frequency_error_bound(self, frequencies: Quantity) -> Quantity:
+        """Largest possible change in each of the given pruned frequencies
+
+        The unpruned eigenvalue lies within eigenvalue_error_bound of the
+        pruned one, so the frequency lies between those of the two ends of
+        this interval. Away from zero the bound is about
+        eigenvalue_error_bound / (2 |w|).
+        """
+        evals = self._to_eigenvalues(frequencies)
+        error = self._eigenvalue_error_bound
+        upper = self._to_frequencies(evals + error) - frequencies
+        lower = frequencies - self._to_frequencies(evals - error)
+        return np.maximum(upper.to('meV'), lower.to('meV'))
+
+    def _calculate_dyn_mats(self, qpts: np.ndarray) -> np.ndarray:
+        """Mass-weighted dynamical matrices, shape (n_qpts, 3n, 3n)"""
+        n_modes = 3 * self.crystal.n_atoms
+        phases = np.exp(2j * np.pi * (self._lattice_vectors @ qpts.T))
+        dyn_mats = (self._dyn_mat_matrix @ phases).T.reshape(
+            len(qpts), n_modes, n_modes)
+        # Pruning may not drop both of a pair of transposed blocks
+        return (dyn_mats + np.conj(dyn_mats.transpose(0, 2, 1))) / 2
+
+    @staticmethod
+    def _to_frequencies(evals: np.ndarray) -> Quantity:
+        # Imaginary frequencies are returned as negative, as in euphonic
+        frequencies = np.sign(evals) * np.sqrt(np.abs(evals))
+        return ureg.Quantity(frequencies, 'hartree').to('meV')
+
+    @staticmethod
+    def _to_eigenvalues(frequencies: Quantity) -> np.ndarray:
+        frequencies = frequencies.to('hartree').magnitude
+        return np.sign(frequencies) * frequencies**2
+
+    def calculate_qpoint_frequencies(self, qpts: np.ndarray
+                                     ) -> QpointFrequencies:
+        """Frequencies at reduced wavevectors qpts"""
+        evals = np.linalg.eigvalsh(self._calculate_dyn_mats(qpts))
+        return QpointFrequencies(self.crystal, qpts,
+                                 self._to_frequencies(evals))
+
+    def calculate_qpoint_phonon_modes(self, qpts: np.ndarray
+                                      ) -> QpointPhononModes:
+        """Frequencies and eigenvectors at reduced wavevectors qpts"""
+        n_atoms = self.crystal.n_atoms
+        evals, evecs = np.linalg.eigh(self._calculate_dyn_mats(qpts))
+        evecs = evecs.transpose(0, 2, 1).reshape(len(qpts), 3 * n_atoms,
+                                                 n_atoms, 3)
+        return QpointPhononModes(self.crystal, qpts,
+                                 self._to_frequencies(evals), evecs)
+
+
+def prune_force_constants(force_constants: ForceConstants,
+                          tolerance: Optional[float]
+                          ) -> 'ForceConstants | PrunedForceConstants':
+    """PrunedForceConstants for tolerance, reporting the error bound
+
+    Returns force_constants unchanged if tolerance is None.
+    """
+    if tolerance is None:
+        return force_constants
+    pruned = PrunedForceConstants(force_constants, tolerance)
+    print(f"Pruned force constants: kept {pruned.kept_fraction:.1%} of "
+          f"blocks ({pruned.n_entries} terms); frequency error at most "
+          f"{pruned.frequency_error_bound:.3g~P}")
+    return pruned
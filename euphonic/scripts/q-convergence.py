@@ -2,25 +2,41 @@
 # euphonic 0.3.2+94.g92306dd
 
 import argparse
-from typing import Optional, Union
+from typing import List, Optional, Tuple, Union
 
 import matplotlib.pyplot as plt
 import numpy as np
 
 from euphonic import ureg, Quantity
-from euphonic import ForceConstants
+from euphonic import DebyeWaller, ForceConstants, Spectrum1D
 from euphonic.cli.utils import force_constants_from_file
 
 from euphonic.plot import _plot_1d_core, _plot_2d_core
-from euphonic.powder import sample_sphere_dos, sample_sphere_structure_factor
-
-from compare_spectra import diff_1d, diff_1d_avg
+from euphonic.spectra import Spectrum2D
+
+from broadening import WidthFunction, broaden, polynomial_width
+from compare_spectra import diff_1d, diff_1d_avg, error_1d_avg
+from disk_cache import (DiskCache, DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE,
+                        hash_key, spectrum_from_arrays, spectrum_to_arrays)
+from debye_waller_cache import cached_debye_waller
+from force_constants_cache import cached_force_constants
+from profiling import PROFILER
+from material_info import get_energy_bins, get_material_info
+from mode_grid import (DEFAULT_GRID_MAX_MEMORY, DEFAULT_GRID_SPACING,
+                       DEFAULT_GRID_TOLERANCE, cached_mode_grid,
+                       converged_mode_grid)
+from pruned_force_constants import prune_force_constants
+from sphere_sampling import (DEFAULT_CHUNK_SIZE, DEFAULT_SCRAMBLES,
+                             DEFAULT_TEMPERATURE,
+                             sample_sphere_shells,
+                             sample_sphere_shells_adaptive,
+                             sample_sphere_shells_rqmc)
 
 
 def get_parser() -> argparse.ArgumentParser:
     sampling_choices = {'golden', 'sphere-projected-grid',
                         'spherical-polar-grid', 'spherical-polar-improved',
-                        'random-sphere'}
+                        'random-sphere', 'sobol'}
 
     parser = argparse.ArgumentParser()
     parser.add_argument('files', nargs='+', type=str)
@@ -37,6 +53,11 @@ def get_parser() -> argparse.ArgumentParser:
     parser.add_argument('--sampling', type=str, default='golden',
                         choices=sampling_choices)
     parser.add_argument('--jitter', action='store_true')
+    parser.add_argument('--scrambles', type=int, default=DEFAULT_SCRAMBLES,
+                        help=("Number of independent scrambles for sobol "
+                              "sampling. The standard error estimated from "
+                              "these is shown instead of the error against "
+                              "a reference calculation"))
     parser.add_argument('-q', type=float, nargs='+', default=[0.1],
                         help=("mod(q) radius of sampled sphere in reciprocal "
                               "angstrom"))
@@ -46,42 +67,117 @@ def get_parser() -> argparse.ArgumentParser:
     parser.add_argument('--smear-width', '-s', dest='smear_width',
                         type=float, default=1.,
                         help="width of DOS smearing in meV")
+    parser.add_argument('--energy-broadening', type=float, nargs='+',
+                        default=None, dest='energy_broadening',
+                        metavar='COEFF',
+                        help=("Broaden with an energy-dependent FWHM "
+                              "c0 + c1 E + c2 E^2 + ... (E and FWHM in meV) "
+                              "instead of --smear-width, e.g. to model "
+                              "instrument resolution"))
     parser.add_argument('--ref-npts', default=int(1e4), type=int,
                         dest='ref_npts',
                         help="Number of qpoints for reference data")
+    parser.add_argument('--cache-dir', type=str, default=DEFAULT_CACHE_DIR,
+                        dest='cache_dir',
+                        help=("Directory for on-disk cache of reference data "
+                              "and binary copies of force constants"))
+    parser.add_argument('--cache-size', type=float,
+                        default=DEFAULT_CACHE_SIZE, dest='cache_size',
+                        help="Maximum size of on-disk cache in MB")
+    parser.add_argument('--no-cache', action='store_false', dest='use_cache',
+                        help="Always recalculate reference data")
+    parser.add_argument('--dw-spacing', type=float, default=None,
+                        dest='dw_spacing',
+                        help=("Maximum grid spacing for the Debye-Waller "
+                              "factor in recip. angstrom (the starting grid "
+                              "if --dw-tolerance is given)"))
+    parser.add_argument('--dw-tolerance', type=float, default=None,
+                        dest='dw_tolerance',
+                        help=("Double the Debye-Waller grid until the "
+                              "fractional change in e^-W at the largest |q| "
+                              "is below this tolerance"))
+    parser.add_argument('--adaptive', type=float, default=None,
+                        metavar='TOLERANCE',
+                        help=("Instead of a fixed --npts, add points to each "
+                              "sphere until the RMS relative change between "
+                              "rounds is below this tolerance. Points are "
+                              "taken from a halton sequence, so --sampling "
+                              "and --jitter are not used"))
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        dest='chunk_size',
+                        help=("Maximum number of q-points in each phonon "
+                              "calculation; all |q| shells are calculated "
+                              "together in chunks of this size"))
+    parser.add_argument('--mode-grid', type=float, nargs='?', default=None,
+                        const=0., dest='mode_grid', metavar='SPACING',
+                        help=("Precompute phonon modes on a grid over the "
+                              "Brillouin zone with this spacing in recip. "
+                              "angstrom, stored in the cache, and "
+                              "interpolate from it instead of calculating "
+                              "each sampling point. The reference is still "
+                              "calculated directly. Without SPACING, the "
+                              "spacing for structure factors is halved from "
+                              "a coarse grid until --mode-grid-tolerance is "
+                              "met"))
+    parser.add_argument('--mode-grid-tolerance', type=float,
+                        default=DEFAULT_GRID_TOLERANCE,
+                        dest='mode_grid_tolerance', metavar='TOL',
+                        help=("Before using --mode-grid for structure "
+                              "factors, compare S from the grid with a "
+                              "direct calculation on a few points of each "
+                              "sphere and stop if the relative RMS "
+                              "difference is above TOL"))
+    parser.add_argument('--mode-grid-memory', type=float,
+                        default=DEFAULT_GRID_MAX_MEMORY,
+                        dest='mode_grid_memory', metavar='MB',
+                        help=("Refuse to build a mode grid needing more "
+                              "than this much memory in MB"))
+    parser.add_argument('--prune-tolerance', type=float, default=None,
+                        dest='prune_tolerance', metavar='TOL',
+                        help=("Drop force constant blocks smaller than TOL "
+                              "times the largest when sampling (not for "
+                              "polar materials), and print the resulting "
+                              "bound on the frequency error. The reference "
+                              "is still calculated directly"))
+    parser.add_argument('--profile', type=str, default=None,
+                        metavar='FILE',
+                        help=("Record wall time, q-points per second and peak "
+                              "memory of each calculation stage and write "
+                              "them to FILE (CSV if FILE ends in .csv, "
+                              "otherwise JSON)"))
     parser.add_argument('--title', type=str, default=None)
     return parser
 
 
-def get_spectrum(force_constants: ForceConstants,
-                 *,
-                 energy_bins: Quantity,
-                 q: Quantity = (0.1 * ureg('1/angstrom')),
-                 npts: int = 1000,
-                 npts_density: bool = False,
-                 sampling: str = 'golden',
-                 jitter: bool = True,
-                 dos: bool = False,
-                 smear_width: Optional[Quantity] = (1 * ureg('meV'))):
-
-    assert isinstance(q, Quantity)
-
-    if npts_density:
-        npts = int(np.ceil(npts * (q.to('1/angstrom').magnitude**2)))
-
-    if dos:
-        sampling_function = sample_sphere_dos
-    else:
-        sampling_function = sample_sphere_structure_factor
-
-    spectrum = sampling_function(force_constants, mod_q=q, npts=npts,
-                                 sampling=sampling, jitter=jitter,
-                                 energy_bins=energy_bins)
+def get_spectra(force_constants: ForceConstants,
+                *,
+                energy_bins: Quantity,
+                q_series: Quantity = (np.array([0.1]) * ureg('1/angstrom')),
+                npts: int = 1000,
+                npts_density: bool = False,
+                sampling: str = 'golden',
+                jitter: bool = True,
+                dos: bool = False,
+                smear_width: Union[Quantity, WidthFunction, None] = (
+                    1 * ureg('meV')),
+                dw: Optional[DebyeWaller] = None,
+                chunk_size: int = DEFAULT_CHUNK_SIZE) -> List[Spectrum1D]:
+
+    assert isinstance(q_series, Quantity)
+
+    spectrum_2d = sample_sphere_shells(force_constants, q_series,
+                                       energy_bins=energy_bins, npts=npts,
+                                       npts_density=npts_density,
+                                       sampling=sampling, jitter=jitter,
+                                       dos=dos, dw=dw, chunk_size=chunk_size)
+    spectra = [Spectrum1D(energy_bins, z_row) for z_row in spectrum_2d.z_data]
 
     if smear_width is None:
-        return spectrum
+        return spectra
     else:
-        return spectrum.broaden(smear_width, shape='gauss')
+        with PROFILER.stage('broadening'):
+            return [broaden(spectrum, smear_width, shape='gauss')
+                    for spectrum in spectra]
 
 
 def _label_print(value: Union[str, Quantity, int, float]) -> str:
@@ -103,16 +199,92 @@ def plot(spectrum, ax, **mplargs):
     ax.set_ylabel(f'Intensity / {y_unit}')
 
 
-def get_ref_spectrum(force_constants, *, q, energy_bins, npts,
-                     dos, smear_width=None):
-    print("Calculating reference spectrum: "
-          f"q = {q}, npts = {npts}")
+def get_adaptive_spectra(force_constants: ForceConstants,
+                         *,
+                         energy_bins: Quantity,
+                         q_series: Quantity,
+                         tolerance: float,
+                         npts_max: int = int(1e5),
+                         dos: bool = False,
+                         smear_width: Union[Quantity, WidthFunction, None] = (
+                             1 * ureg('meV')),
+                         dw: Optional[DebyeWaller] = None,
+                         chunk_size: int = DEFAULT_CHUNK_SIZE
+                         ) -> List[Spectrum1D]:
+    spectrum_2d, shell_npts = sample_sphere_shells_adaptive(
+        force_constants, q_series, energy_bins=energy_bins,
+        tolerance=tolerance, smear_width=smear_width, npts_max=npts_max,
+        dos=dos, dw=dw, chunk_size=chunk_size)
+    for q, npts in zip(q_series, shell_npts):
+        print(f"Converged q={q.magnitude} with npts={npts}")
+    spectra = [Spectrum1D(energy_bins, z_row) for z_row in spectrum_2d.z_data]
 
-    return get_spectrum(force_constants,
-                        energy_bins=energy_bins,
-                        npts=npts, q=q, dos=dos,
-                        sampling='golden', jitter=False,
-                        smear_width=smear_width)
+    if smear_width is None:
+        return spectra
+    else:
+        with PROFILER.stage('broadening'):
+            return [broaden(spectrum, smear_width, shape='gauss')
+                    for spectrum in spectra]
+
+
+def get_rqmc_spectra(force_constants: ForceConstants,
+                     *,
+                     energy_bins: Quantity,
+                     q_series: Quantity,
+                     npts: int = 1000,
+                     npts_density: bool = False,
+                     n_scrambles: int = DEFAULT_SCRAMBLES,
+                     dos: bool = False,
+                     smear_width: Union[Quantity, WidthFunction, None] = (
+                         1 * ureg('meV')),
+                     dw: Optional[DebyeWaller] = None,
+                     chunk_size: int = DEFAULT_CHUNK_SIZE
+                     ) -> Tuple[List[Spectrum1D], List[Spectrum1D]]:
+    spectrum_2d, error_2d = sample_sphere_shells_rqmc(
+        force_constants, q_series, energy_bins=energy_bins, npts=npts,
+        npts_density=npts_density, n_scrambles=n_scrambles,
+        smear_width=smear_width, dos=dos, dw=dw, chunk_size=chunk_size)
+    return ([Spectrum1D(energy_bins, z_row) for z_row in spectrum_2d.z_data],
+            [Spectrum1D(energy_bins, z_row) for z_row in error_2d.z_data])
+
+
+def get_ref_spectra(force_constants, *, q_series, energy_bins, npts,
+                    dos, smear_width=None, cache=None, fc_hash=None,
+                    dw=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    # Cache the unbroadened spectra so they can be reused for any smear width
+    keys = [hash_key(force_constants=fc_hash, q=q.to('1/angstrom'),
+                     npts=npts, npts_density=False, dos=dos,
+                     energy_bins=energy_bins.to('meV'), sampling='golden',
+                     debye_waller=(None if dw is None else dw.debye_waller))
+            for q in q_series]
+    if cache is None:
+        spectra = [None] * len(keys)
+    else:
+        spectra = [cache.load(key) for key in keys]
+        spectra = [None if arrays is None else spectrum_from_arrays(arrays)
+                   for arrays in spectra]
+
+    missing = [i for i, spectrum in enumerate(spectra) if spectrum is None]
+    if missing:
+        print("Calculating reference spectra: "
+              f"q = {q_series[missing]}, npts = {npts}")
+        new_spectra = get_spectra(force_constants,
+                                  energy_bins=energy_bins,
+                                  npts=npts, q_series=q_series[missing],
+                                  dos=dos, sampling='golden', jitter=False,
+                                  smear_width=None, dw=dw,
+                                  chunk_size=chunk_size)
+        for i, spectrum in zip(missing, new_spectra):
+            spectra[i] = spectrum
+            if cache is not None:
+                cache.save(keys[i], **spectrum_to_arrays(spectrum))
+
+    if smear_width is None:
+        return spectra
+    else:
+        with PROFILER.stage('broadening'):
+            return [broaden(spectrum, smear_width, shape='gauss')
+                    for spectrum in spectra]
 
 
 spacing_data = {1: {'legend_bbox': (1.8, -0.2),
@@ -127,9 +299,23 @@ spacing_data = {1: {'legend_bbox': (1.8, -0.2),
 
 
 def main():
-    args = get_parser().parse_args()
+    parser = get_parser()
+    args = parser.parse_args()
+    PROFILER.enabled = args.profile is not None
+    if args.adaptive is not None and (args.sampling != 'golden'
+                                      or args.jitter):
+        parser.error('--adaptive always uses halton sampling, so cannot be '
+                     'used with --sampling or --jitter')
+    if args.sampling == 'sobol' and args.jitter:
+        parser.error('--jitter cannot be used with sobol sampling; the '
+                     'points are randomised by scrambling')
+    if args.mode_grid is not None and args.prune_tolerance is not None:
+        raise ValueError('--prune-tolerance cannot be used with --mode-grid')
     bin_width = args.bin_width * ureg('meV')
-    smear_width = args.smear_width * ureg('meV')
+    if args.energy_broadening is None:
+        smear_width = args.smear_width * ureg('meV')
+    else:
+        smear_width = polynomial_width(args.energy_broadening)
 
     fig = plt.figure(constrained_layout=True, figsize=(10, 10))
     gs = fig.add_gridspec(len(args.files), 4)
@@ -138,60 +324,137 @@ def main():
 
     abs_q_series = np.array(args.q) * ureg('1/angstrom')
 
+    if args.use_cache:
+        cache = DiskCache(args.cache_dir, max_size=args.cache_size)
+    else:
+        cache = None
+
     for row_index, filename in enumerate(args.files):
         spectrum_ax = fig.add_subplot(gs[row_index, 0])
         error_ax = fig.add_subplot(gs[row_index, 1])
 
-        force_constants = force_constants_from_file(filename)
+        if cache is None:
+            force_constants = force_constants_from_file(filename)
+            fc_hash = None
+        else:
+            force_constants, fc_hash = cached_force_constants(
+                filename, lambda: force_constants_from_file(filename),
+                args.cache_dir)
+
+        info = get_material_info(force_constants, fc_hash=fc_hash,
+                                 cache=cache)
 
         # Use geometric mean for a representative reciprocal lattice distance
-        recip_cell = force_constants.crystal.reciprocal_cell()
-        recip_lattice_constant = np.power(np.product(
+        recip_cell = info['reciprocal_cell']
+        recip_lattice_constant = np.power(np.prod(
             np.linalg.norm(recip_cell.magnitude, axis=1)),
                                           1/3) * recip_cell.units
         rel_q_series = abs_q_series / recip_lattice_constant
 
-        # Energy range: Gamma-point maximum + 20%
-        max_energy = np.max(force_constants
-                            .calculate_qpoint_phonon_modes(np.array([[0, 0, 0]]))
-                            .frequencies.to('meV').magnitude) * 1.2 * ureg('meV')
-        energy_bins = np.arange(0,
-                                (max_energy.to('meV').magnitude),
-                                bin_width.to('meV').magnitude) * max_energy.units
-
-        from euphonic.spectra import Spectrum2D
-        ref_spectrum_2d = None
+        energy_bins = get_energy_bins(info['max_energy'], bin_width)
+
+        if args.dos:
+            dw = None
+        else:
+            # Shared by the reference and every spectrum of this material
+            dw, _ = cached_debye_waller(
+                force_constants, DEFAULT_TEMPERATURE,
+                spacing=(None if args.dw_spacing is None
+                         else args.dw_spacing * ureg('1/angstrom')),
+                tolerance=args.dw_tolerance, q_max=np.max(abs_q_series),
+                fc_hash=fc_hash, cache=cache, chunk_size=args.chunk_size)
+
+        grid_options = dict(
+            spacing=(args.mode_grid * ureg('1/angstrom')
+                     if args.mode_grid else None),
+            max_memory=args.mode_grid_memory, fc_hash=fc_hash,
+            cache_dir=(args.cache_dir if args.use_cache else None),
+            chunk_size=args.chunk_size)
+        if args.mode_grid is None:
+            sampler = prune_force_constants(force_constants,
+                                            args.prune_tolerance)
+        elif not args.dos:
+            sampler, _ = converged_mode_grid(
+                force_constants, abs_q_series, energy_bins=energy_bins,
+                width=smear_width, dw=dw,
+                tolerance=args.mode_grid_tolerance, **grid_options)
+        else:
+            if grid_options['spacing'] is None:
+                grid_options['spacing'] = DEFAULT_GRID_SPACING
+            sampler = cached_mode_grid(force_constants, eigenvectors=False,
+                                       **grid_options)
+
+        options = dict(q_series=abs_q_series, energy_bins=energy_bins,
+                       dos=args.dos, smear_width=smear_width, dw=dw,
+                       chunk_size=args.chunk_size)
 
         box_data = []
         abs_rms_err = []
         rel_rms_err = []
         z_data = []
 
-        for q_index, q in enumerate(abs_q_series):
-            options = dict(q=q, energy_bins=energy_bins, dos=args.dos, smear_width=smear_width)
+        if args.sampling == 'sobol':
+            # Error is estimated from the spread between independent
+            # scrambles, so no reference calculation is needed
+            print(f"Calculating spectra: q={abs_q_series.magnitude}, "
+                  f"scrambles={args.scrambles}")
+            with PROFILER.options(file=filename, npts=args.npts,
+                                  scrambles=args.scrambles):
+                spectra, errors = get_rqmc_spectra(
+                    sampler, npts=args.npts,
+                    npts_density=args.npts_density,
+                    n_scrambles=args.scrambles, **options)
+
+            for spectrum, error in zip(spectra, errors):
+                box_data.append(error.y_data.magnitude)
+                rel_rms_err.append(error_1d_avg(spectrum, error,
+                                                fractional=True))
+                abs_rms_err.append(error_1d_avg(spectrum, error).magnitude)
+                z_data.append(spectrum.y_data.magnitude)
+            y_unit = spectrum.y_data_unit
+            error_label = 'Standard error'
+        else:
+            with PROFILER.options(file=filename, reference=True,
+                                  npts=args.ref_npts):
+                ref_spectra = get_ref_spectra(force_constants,
+                                              npts=args.ref_npts,
+                                              cache=cache, fc_hash=fc_hash,
+                                              **options)
+
+            print(f"Calculating spectra: q={abs_q_series.magnitude}")
+            if args.adaptive is None:
+                with PROFILER.options(file=filename, npts=args.npts):
+                    spectra = get_spectra(sampler,
+                                          npts=args.npts,
+                                          npts_density=args.npts_density,
+                                          sampling=args.sampling,
+                                          jitter=args.jitter,
+                                          **options)
+            else:
+                with PROFILER.options(file=filename, adaptive=args.adaptive):
+                    spectra = get_adaptive_spectra(sampler,
+                                                   tolerance=args.adaptive,
+                                                   npts_max=args.ref_npts,
+                                                   **options)
+
+            for spectrum, ref_spectrum in zip(spectra, ref_spectra):
+                with PROFILER.options(file=filename), \
+                        PROFILER.stage('comparison'):
+                    diff = diff_1d(spectrum, ref_spectrum)
+                    box_data.append(diff.magnitude)
+
+                    rel_rms_err.append(diff_1d_avg(spectrum, ref_spectrum,
+                                                   rms=True, fractional=True))
+                    abs_rms_err.append(diff_1d_avg(
+                        spectrum, ref_spectrum, rms=True,
+                        fractional=False).magnitude)
+
+                z_data.append(ref_spectrum.y_data.magnitude)
+            y_unit = ref_spectrum.y_data_unit
+            error_label = 'Residuals'
 
-            ref_spectrum = get_ref_spectrum(force_constants,
-                                            npts=args.ref_npts,
-                                            **options)
-
-            print(f"Calculating spectrum: q={q.magnitude}")
-            spectrum = get_spectrum(force_constants,
-                                    npts=args.npts, npts_density=args.npts_density,
-                                    **options)
-
-            diff = diff_1d(spectrum, ref_spectrum)
-            box_data.append(diff.magnitude)
-
-            # rms = diff_1d_avg(spectrum, ref_spectrum, rms=True, fractional=True)
-            # rms_data.append(rms.magnitude)
-            rel_rms_err.append(diff_1d_avg(spectrum, ref_spectrum,
-                                           rms=True, fractional=True))
-            abs_rms_err.append(diff_1d_avg(spectrum, ref_spectrum,
-                                           rms=True, fractional=False).magnitude)
-
-            z_data.append(ref_spectrum.y_data.magnitude)
         ref_spectrum_2d = Spectrum2D(abs_q_series, energy_bins,
-                                     np.array(z_data) * ureg(ref_spectrum.y_data_unit))
+                                     np.array(z_data) * ureg(y_unit))
         _plot_2d_core(ref_spectrum_2d, spectrum_ax)
 
         spectrum_ax.set_xlabel('|q| / recip. angstom')
@@ -199,7 +462,7 @@ def main():
 
         error_ax.boxplot(box_data, positions=abs_q_series, showmeans=False)
         error_ax.set_xlabel('|q| / recip. angstom')
-        error_ax.set_ylabel('Residuals')
+        error_ax.set_ylabel(error_label)
 
         error_ax.plot(abs_q_series.magnitude, abs_rms_err, color=f'C{row_index}')
 
@@ -213,6 +476,10 @@ def main():
     if args.title:
         fig.suptitle(args.title)
 
+    if args.profile:
+        PROFILER.write(args.profile)
+        print(f"Profile written to {args.profile}")
+
     plt.show()
 
 
@@ -2,6 +2,7 @@
 # euphonic 0.3.2+94.g92306dd
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 import functools
 import os
 from typing import Optional, Union
@@ -9,18 +10,31 @@ from typing import Optional, Union
 import matplotlib.pyplot as plt
 import numpy as np
 
-from euphonic import ureg, Quantity
+from euphonic import ureg, DebyeWaller, Quantity, Spectrum1D
 from euphonic.force_constants import ForceConstants
 from euphonic.plot import _plot_1d_core
-from euphonic.powder import sample_sphere_dos, sample_sphere_structure_factor
 
-from compare_spectra import diff_1d, diff_1d_avg
+from broadening import broaden_multi
+from compare_spectra import diff_1d_batch
+from disk_cache import (DiskCache, DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE,
+                        cached_spectrum, hash_key)
+from debye_waller_cache import cached_debye_waller
+from force_constants_cache import cached_force_constants
+from profiling import PROFILER
+from mode_grid import (DEFAULT_GRID_MAX_MEMORY, DEFAULT_GRID_SPACING,
+                       DEFAULT_GRID_TOLERANCE, cached_mode_grid,
+                       converged_mode_grid)
+from pruned_force_constants import (PrunedForceConstants,
+                                    prune_force_constants)
+from material_info import get_energy_bins, get_material_info
+from sphere_sampling import (DEFAULT_CHUNK_SIZE, DEFAULT_TEMPERATURE,
+                             sample_sphere)
 
 
 def get_parser() -> argparse.ArgumentParser:
     sampling_choices = {'golden', 'sphere-projected-grid',
                         'spherical-polar-grid', 'spherical-polar-improved',
-                        'random-sphere'}
+                        'random-sphere', 'sobol'}
 
     parser = argparse.ArgumentParser()
     parser.add_argument('file', type=str)
@@ -36,8 +50,10 @@ def get_parser() -> argparse.ArgumentParser:
                         )
     parser.add_argument('--sampling', type=str, nargs='+',
                         default=['golden'], choices=sampling_choices)
-    parser.add_argument('--jitter', type=str, nargs='+', default=['y'],
-                        help="Sequence of 'y', 'n' corresponding to sampling")
+    parser.add_argument('--jitter', type=str, nargs='+', default=None,
+                        help=("Sequence of 'y', 'n' corresponding to "
+                              "sampling. Default is 'y', except for sobol, "
+                              "which cannot be jittered"))
     parser.add_argument('-q', type=float, nargs='+', default=[0.1],
                         help=("mod(q) radius of sampled sphere in reciprocal "
                               "angstrom"))
@@ -50,44 +66,100 @@ def get_parser() -> argparse.ArgumentParser:
     parser.add_argument('--ref-npts', default=int(1e5), type=int,
                         dest='ref_npts',
                         help="Number of qpoints for reference data")
+    parser.add_argument('--cache-dir', type=str, default=DEFAULT_CACHE_DIR,
+                        dest='cache_dir',
+                        help=("Directory for on-disk cache of reference data "
+                              "and binary copies of force constants"))
+    parser.add_argument('--cache-size', type=float,
+                        default=DEFAULT_CACHE_SIZE, dest='cache_size',
+                        help="Maximum size of on-disk cache in MB")
+    parser.add_argument('--no-cache', action='store_false', dest='use_cache',
+                        help="Always recalculate reference data")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        dest='chunk_size',
+                        help=("Maximum number of q-points in each phonon "
+                              "calculation; limits peak memory use"))
+    parser.add_argument('--dw-spacing', type=float, default=None,
+                        dest='dw_spacing',
+                        help=("Maximum grid spacing for the Debye-Waller "
+                              "factor in recip. angstrom (the starting grid "
+                              "if --dw-tolerance is given)"))
+    parser.add_argument('--dw-tolerance', type=float, default=None,
+                        dest='dw_tolerance',
+                        help=("Double the Debye-Waller grid until the "
+                              "fractional change in e^-W at the largest |q| "
+                              "is below this tolerance"))
+    parser.add_argument('--mode-grid', type=float, nargs='?', default=None,
+                        const=0., dest='mode_grid', metavar='SPACING',
+                        help=("Precompute phonon modes on a grid over the "
+                              "Brillouin zone with this spacing in recip. "
+                              "angstrom, stored in the cache, and "
+                              "interpolate from it instead of calculating "
+                              "each sampling point. Without SPACING, the "
+                              "spacing for structure factors is halved from "
+                              "a coarse grid until --mode-grid-tolerance is "
+                              "met"))
+    parser.add_argument('--mode-grid-tolerance', type=float,
+                        default=DEFAULT_GRID_TOLERANCE,
+                        dest='mode_grid_tolerance', metavar='TOL',
+                        help=("Before using --mode-grid for structure "
+                              "factors, compare S from the grid with a "
+                              "direct calculation on a few points of each "
+                              "sphere and stop if the relative RMS "
+                              "difference is above TOL"))
+    parser.add_argument('--mode-grid-memory', type=float,
+                        default=DEFAULT_GRID_MAX_MEMORY,
+                        dest='mode_grid_memory', metavar='MB',
+                        help=("Refuse to build a mode grid needing more "
+                              "than this much memory in MB"))
+    parser.add_argument('--prune-tolerance', type=float, default=None,
+                        dest='prune_tolerance', metavar='TOL',
+                        help=("Drop force constant blocks smaller than TOL "
+                              "times the largest when sampling (not for "
+                              "polar materials), and print the resulting "
+                              "bound on the frequency error. The reference "
+                              "is still calculated directly"))
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help=("Number of worker processes used to calculate "
+                              "spectra in parallel"))
+    parser.add_argument('--profile', type=str, default=None,
+                        metavar='FILE',
+                        help=("Record wall time, q-points per second and peak "
+                              "memory of each calculation stage and write "
+                              "them to FILE (CSV if FILE ends in .csv, "
+                              "otherwise JSON)"))
     parser.add_argument('--title', type=str, default=None)
     return parser
 
 
 def get_spectrum(force_constants: ForceConstants,
                  *,
-                 bin_width: Quantity,
-                 max_energy: Quantity,
+                 energy_bins: Quantity,
                  q: Quantity = (0.1 * ureg('1/angstrom')),
                  npts: int = 1000,
                  npts_density: bool = False,
                  sampling: str = 'golden',
                  jitter: bool = True,
                  dos: bool = False,
-                 smear_width: Optional[Quantity] = (1 * ureg('meV'))):
+                 smear_width: Optional[Quantity] = (1 * ureg('meV')),
+                 dw: Optional[DebyeWaller] = None,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE):
 
     assert isinstance(q, Quantity)
 
     if npts_density:
         npts = int(np.ceil(npts * (q.to('1/angstrom').magnitude**2)))
 
-    energy_bins = np.arange(0,
-                            (max_energy.to('meV').magnitude),
-                            bin_width.to('meV').magnitude) * max_energy.units
-
-    if dos:
-        sampling_function = sample_sphere_dos
-    else:
-        sampling_function = sample_sphere_structure_factor
-
-    spectrum = sampling_function(force_constants, mod_q=q, npts=npts,
-                                 sampling=sampling, jitter=jitter,
-                                 energy_bins=energy_bins)
+    spectrum = sample_sphere(force_constants, mod_q=q, npts=npts,
+                             sampling=sampling, jitter=jitter,
+                             energy_bins=energy_bins, dos=dos, dw=dw,
+                             chunk_size=chunk_size)
 
     if smear_width is None:
         return spectrum
     else:
-        return spectrum.broaden(smear_width, shape='gauss')
+        with PROFILER.stage('broadening'):
+            return spectrum.broaden(smear_width, shape='gauss')
 
 
 def _label_print(value: Union[str, Quantity, int, float]) -> str:
@@ -120,16 +192,166 @@ def str2bool(str_bool: str) -> bool:
 
 @functools.lru_cache()
 def get_ref_spectrum(force_constants, *, q, max_energy, npts, dos, bin_width,
-                     npts_density=False):
-    print("Calculating reference spectrum: "
-          f"q = {q}, npts = {npts}")
-    return get_spectrum(force_constants,
-                        max_energy=max_energy,
-                        bin_width=bin_width,
-                        npts=npts, q=q, dos=dos,
-                        sampling='golden', jitter=False,
-                        smear_width=None,
-                        npts_density=npts_density)
+                     npts_density=False, cache=None, fc_hash=None,
+                     dw=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    energy_bins = get_energy_bins(max_energy, bin_width)
+
+    def calculate():
+        print("Calculating reference spectrum: "
+              f"q = {q}, npts = {npts}")
+        return get_spectrum(force_constants,
+                            energy_bins=energy_bins,
+                            npts=npts, q=q, dos=dos,
+                            sampling='golden', jitter=False,
+                            smear_width=None,
+                            npts_density=npts_density, dw=dw,
+                            chunk_size=chunk_size)
+
+    key = hash_key(force_constants=fc_hash, q=q.to('1/angstrom'), npts=npts,
+                   npts_density=npts_density, dos=dos,
+                   energy_bins=energy_bins.to('meV'), sampling='golden',
+                   debye_waller=(None if dw is None else dw.debye_waller))
+    with PROFILER.options(reference=True, q=_label_print(q), npts=npts):
+        return cached_spectrum(cache, key, calculate)
+
+
+def calculate_spectrum(force_constants: ForceConstants, options: dict,
+                       dw: Optional[DebyeWaller] = None):
+    labels = {key: _label_print(value) for key, value in options.items()
+              if key != 'energy_bins' and value is not None}
+    print("Calculating spectrum: ",
+          ", ".join([f'{key}={value}' for key, value in labels.items()]))
+    with PROFILER.options(**labels):
+        return get_spectrum(force_constants, dw=dw, **options)
+
+
+# Each worker process loads the force constants once, in _init_worker, rather
+# than having them pickled and sent along with every task
+_worker_force_constants = None
+_worker_dw = None
+
+
+def _load_force_constants(path: str, summary_name: str,
+                          cache_dir: Optional[str] = None) -> tuple:
+    """Read force constants, via binary cache in cache_dir if provided
+
+    Returns:
+        force_constants, fc_hash: fc_hash is None if cache_dir is None
+    """
+    def load():
+        return ForceConstants.from_phonopy(path=path,
+                                           summary_name=summary_name)
+
+    if cache_dir is None:
+        return load(), None
+    return cached_force_constants(os.path.join(path, summary_name), load,
+                                  cache_dir)
+
+
+def _init_worker(path: str, summary_name: str,
+                 cache_dir: Optional[str] = None,
+                 profile: bool = False,
+                 mode_grid: Optional[float] = None,
+                 dw_dict: Optional[dict] = None,
+                 eigenvectors: bool = True,
+                 prune_tolerance: Optional[float] = None) -> None:
+    global _worker_force_constants, _worker_dw
+    PROFILER.enabled = profile
+    if dw_dict is not None:
+        _worker_dw = DebyeWaller.from_dict(dw_dict)
+    force_constants, fc_hash = _load_force_constants(path, summary_name,
+                                                     cache_dir)
+    if mode_grid is None and prune_tolerance is None:
+        _worker_force_constants = force_constants
+    elif mode_grid is None:
+        _worker_force_constants = PrunedForceConstants(force_constants,
+                                                       prune_tolerance)
+    else:
+        # Normally already built (and checked against the memory limit) by
+        # the main process, so this maps the cached grid
+        _worker_force_constants = cached_mode_grid(
+            force_constants, spacing=mode_grid * ureg('1/angstrom'),
+            fc_hash=fc_hash, cache_dir=cache_dir, eigenvectors=eigenvectors,
+            max_memory=np.inf)
+
+
+def _pack_options(options: dict) -> tuple:
+    """Split Quantity options into magnitudes and units for pickling"""
+    units = {key: str(value.units) for key, value in options.items()
+             if isinstance(value, Quantity)}
+    magnitudes = {key: (value.magnitude if key in units else value)
+                  for key, value in options.items()}
+    return magnitudes, units
+
+
+def _worker_calculate_spectrum(packed_options: tuple):
+    magnitudes, units = packed_options
+    options = {key: (value * ureg(units[key]) if key in units else value)
+               for key, value in magnitudes.items()}
+    spectrum = calculate_spectrum(_worker_force_constants, options,
+                                  dw=_worker_dw)
+    # Profiling records are returned to be merged in the main process
+    return (_pack_options({'x_data': spectrum.x_data,
+                           'y_data': spectrum.y_data}),
+            PROFILER.pop_records())
+
+
+def calculate_spectra(force_constants: ForceConstants,
+                      options_list: list,
+                      *,
+                      jobs: int = 1,
+                      path: str = '',
+                      summary_name: str = 'phonopy.yaml',
+                      cache_dir: Optional[str] = None,
+                      mode_grid: Optional[float] = None,
+                      prune_tolerance: Optional[float] = None,
+                      dw: Optional[DebyeWaller] = None) -> list:
+    """Calculate a spectrum for each set of options, optionally in parallel
+
+    Args:
+        force_constants: Force constants (or ModeGrid or
+            PrunedForceConstants) used for serial calculation
+        options_list: Sequence of keyword argument dicts for get_spectrum
+        jobs: Number of worker processes. If 1, spectra are calculated in
+            this process.
+        path, summary_name: Location of phonopy data, which is read by
+            each worker process
+        cache_dir: If provided, workers read force constants from the binary
+            cache in this directory
+        mode_grid: If provided, workers use a ModeGrid with this spacing in
+            recip. angstrom
+        prune_tolerance: If provided, workers use PrunedForceConstants with
+            this tolerance
+        dw: Debye-Waller factor used for every spectrum
+
+    Returns:
+        list of Spectrum1D in the same order as options_list
+    """
+    # DOS calculations need only frequencies, so a mode grid without
+    # eigenvectors is enough
+    eigenvectors = not all(options['dos'] for options in options_list)
+
+    if jobs == 1:
+        return [calculate_spectrum(force_constants, options, dw=dw)
+                for options in options_list]
+
+    with ProcessPoolExecutor(max_workers=jobs,
+                             initializer=_init_worker,
+                             initargs=(path, summary_name, cache_dir,
+                                       PROFILER.enabled, mode_grid,
+                                       (None if dw is None
+                                        else dw.to_dict()),
+                                       eigenvectors,
+                                       prune_tolerance)) as executor:
+        results = executor.map(_worker_calculate_spectrum,
+                               map(_pack_options, options_list))
+        spectra = []
+        for (magnitudes, units), records in results:
+            PROFILER.merge(records)
+            spectra.append(Spectrum1D(
+                magnitudes['x_data'] * ureg(units['x_data']),
+                magnitudes['y_data'] * ureg(units['y_data'])))
+    return spectra
 
 
 spacing_data = {1: {'legend_bbox': (1.8, -0.2),
@@ -149,8 +371,12 @@ spacing_data = {1: {'legend_bbox': (1.8, -0.2),
 
 
 def main():
-    args = get_parser().parse_args()
+    parser = get_parser()
+    args = parser.parse_args()
     filename = args.file
+    PROFILER.enabled = args.profile is not None
+    if args.mode_grid is not None and args.prune_tolerance is not None:
+        raise ValueError('--prune-tolerance cannot be used with --mode-grid')
     summary_name = os.path.basename(filename)
     path = os.path.dirname(filename)
 
@@ -182,23 +408,27 @@ def main():
                          "Please only provide multiple choices for one of: "
                          "npts, q, smear-width, sampling")
 
-    if len(args.sampling) > 1:
-        if len(args.jitter) == 1:
-            jitter_options = args.jitter * len(args.sampling)
-        elif len(args.jitter) != len(args.sampling):
-            raise ValueError("Either give a single jitter value, or they "
-                             "should correspond to sampling choices.")
-        else:
-            jitter_options = args.jitter
-
-        jitter_options = list(map(str2bool, jitter_options))
-    elif len(args.jitter) > 1:
+    if args.jitter is None:
+        # Sobol points are randomised by scrambling instead
+        jitter_options = [sampling != 'sobol' for sampling in args.sampling]
+    elif len(args.jitter) == 1:
+        jitter_options = [str2bool(args.jitter[0])] * len(args.sampling)
+    elif len(args.sampling) == 1:
         raise ValueError("Multiple jitter values should be accompanied by "
                          "multiple sampling values. (These can be repeated as "
                          "appropriate.)")
-
+    elif len(args.jitter) != len(args.sampling):
+        raise ValueError("Either give a single jitter value, or they "
+                         "should correspond to sampling choices.")
     else:
-        fixed_options['jitter'] = str2bool(args.jitter[0])
+        jitter_options = list(map(str2bool, args.jitter))
+
+    if any(jitter and sampling == 'sobol'
+           for sampling, jitter in zip(args.sampling, jitter_options)):
+        parser.error('--jitter cannot be used with sobol sampling; the '
+                     'points are randomised by scrambling')
+    if len(args.sampling) == 1:
+        fixed_options['jitter'] = jitter_options[0]
 
     bin_width = args.bin_width * ureg('meV')
 
@@ -213,13 +443,30 @@ def main():
         row_values = [fixed_options[row_key]]
         del fixed_options[row_key]
 
-    force_constants = ForceConstants.from_phonopy(
-        path=path, summary_name=summary_name)
+    if args.use_cache:
+        cache = DiskCache(args.cache_dir, max_size=args.cache_size)
+        cache_dir = args.cache_dir
+    else:
+        cache, cache_dir = None, None
+
+    force_constants, fc_hash = _load_force_constants(path, summary_name,
+                                                     cache_dir)
+
+    max_energy = get_material_info(force_constants, fc_hash=fc_hash,
+                                   cache=cache)['max_energy']
+    energy_bins = get_energy_bins(max_energy, bin_width)
 
-    # Energy range: Gamma-point maximum + 20%
-    max_energy = np.max(force_constants
-                        .calculate_qpoint_phonon_modes(np.array([[0, 0, 0]]))
-                        .frequencies.to('meV').magnitude) * 1.2 * ureg('meV')
+    if args.dos:
+        dw = None
+    else:
+        # Calculated once and shared by the reference and all cells
+        dw, _ = cached_debye_waller(
+            force_constants, DEFAULT_TEMPERATURE,
+            spacing=(None if args.dw_spacing is None
+                     else args.dw_spacing * ureg('1/angstrom')),
+            tolerance=args.dw_tolerance,
+            q_max=max(args.q) * ureg('1/angstrom'), fc_hash=fc_hash,
+            cache=cache, chunk_size=args.chunk_size)
 
     fig, axes = plt.subplots(nrows=len(row_values), ncols=3, squeeze=False
                                # figsize=(10, 10)
@@ -234,6 +481,101 @@ def main():
             box_ax.sharey(ref_axes[1])
             err_ax.sharey(ref_axes[2])
 
+    all_cell_options = []
+    for row_index, row_value in enumerate(row_values):
+        for i, value in enumerate(comparison_values):
+            options = fixed_options.copy()
+            options.update({comparison_key: value,
+                            row_key: row_value,
+                            'energy_bins': energy_bins,
+                            'dos': args.dos,
+                            'npts_density': args.npts_density,
+                            'chunk_size': args.chunk_size})
+            if comparison_key == 'sampling':
+                options.update({'jitter': jitter_options[i]})
+            elif row_key == 'sampling':
+                options.update({'jitter': jitter_options[row_index]})
+            all_cell_options.append(options)
+
+    grid_spacing = None
+    grid_options = dict(
+        spacing=(args.mode_grid * ureg('1/angstrom')
+                 if args.mode_grid else None),
+        max_memory=args.mode_grid_memory, fc_hash=fc_hash,
+        cache_dir=cache_dir, chunk_size=args.chunk_size)
+    if args.mode_grid is None:
+        sampler = prune_force_constants(force_constants,
+                                        args.prune_tolerance)
+    elif not args.dos:
+        sampler, grid_spacing = converged_mode_grid(
+            force_constants, np.array(args.q) * ureg('1/angstrom'),
+            energy_bins=energy_bins,
+            width=min(args.smear_width) * ureg('meV'), dw=dw,
+            tolerance=args.mode_grid_tolerance, **grid_options)
+    else:
+        if grid_options['spacing'] is None:
+            grid_options['spacing'] = DEFAULT_GRID_SPACING
+        grid_spacing = grid_options['spacing']
+        sampler = cached_mode_grid(force_constants, eigenvectors=False,
+                                   **grid_options)
+
+    # Cells which differ only in smear width share one unbroadened
+    # spectrum, which is broadened to all of their widths at once
+    sampling_groups = {}
+    for cell_index, options in enumerate(all_cell_options):
+        sampling_key = tuple((key, _label_print(value))
+                             for key, value in options.items()
+                             if key not in ('smear_width', 'energy_bins'))
+        sampling_groups.setdefault(sampling_key, []).append(cell_index)
+
+    unbroadened_spectra = calculate_spectra(
+        sampler,
+        [dict(all_cell_options[cell_indices[0]], smear_width=None)
+         for cell_indices in sampling_groups.values()],
+        jobs=args.jobs, path=path, summary_name=summary_name,
+        cache_dir=cache_dir,
+        mode_grid=(None if grid_spacing is None
+                   else grid_spacing.to('1/angstrom').magnitude),
+        prune_tolerance=args.prune_tolerance, dw=dw)
+
+    all_spectra = [None] * len(all_cell_options)
+    for (sampling_key, cell_indices), spectrum in zip(
+            sampling_groups.items(), unbroadened_spectra):
+        smear_widths = [all_cell_options[cell_index]['smear_width']
+                        for cell_index in cell_indices]
+        # Labelled like the calculation of the unbroadened spectrum
+        labels = {key: value for key, value in sampling_key
+                  if value != 'None'}
+        with PROFILER.options(**labels), PROFILER.stage('broadening'):
+            broadened = broaden_multi(
+                spectrum,
+                np.array([width.to('meV').magnitude
+                          for width in smear_widths]) * ureg('meV'),
+                shapes='gauss')
+        for line_index, cell_index in enumerate(cell_indices):
+            all_spectra[cell_index] = broadened[line_index]
+
+    all_smear_widths = np.unique(
+        [options['smear_width'].to('meV').magnitude
+         for options in all_cell_options]) * ureg('meV')
+    broadened_refs = {}
+
+    def get_broadened_ref(q, smear_width):
+        if str(q) not in broadened_refs:
+            ref_spectrum = get_ref_spectrum(
+                force_constants, max_energy=max_energy, npts=args.ref_npts,
+                dos=args.dos, bin_width=bin_width, q=q,
+                npts_density=args.npts_density, cache=cache, fc_hash=fc_hash,
+                dw=dw, chunk_size=args.chunk_size)
+            with PROFILER.options(reference=True, q=_label_print(q),
+                                  npts=args.ref_npts), \
+                    PROFILER.stage('broadening'):
+                broadened_refs[str(q)] = broaden_multi(
+                    ref_spectrum, all_smear_widths, shapes='gauss')
+        line_index = np.argmin(np.abs(
+            all_smear_widths - smear_width.to('meV')).magnitude)
+        return broadened_refs[str(q)][line_index]
+
     labels = []
 
     for row_index, row_value in enumerate(row_values):
@@ -244,47 +586,47 @@ def main():
         rms_data = []
         rel_data = []
 
+        # Compare all cells which share a reference spectrum in one batch
+        row_cells = range(row_index * len(comparison_values),
+                          (row_index + 1) * len(comparison_values))
+        ref_groups = {}
+        for cell_index in row_cells:
+            options = all_cell_options[cell_index]
+            ref_groups.setdefault(
+                (str(options['q']), str(options['smear_width'])), []
+                ).append(cell_index)
+
+        cell_diffs = {}
+        for cell_indices in ref_groups.values():
+            options = all_cell_options[cell_indices[0]]
+            ref_spectrum = get_broadened_ref(options['q'],
+                                             options['smear_width'])
+            with PROFILER.options(**{row_key: _label_print(row_value)}), \
+                    PROFILER.stage('comparison'):
+                batch_diff = diff_1d_batch(
+                    [all_spectra[cell_index] for cell_index in cell_indices],
+                    ref_spectrum)
+            for batch_index, cell_index in enumerate(cell_indices):
+                cell_diffs[cell_index] = (batch_diff, batch_index)
+
         for i, value in enumerate(comparison_values):
-            options = fixed_options.copy()
-            options.update({comparison_key: value,
-                            row_key: row_value,
-                            'max_energy': max_energy,
-                            'bin_width': bin_width,
-                            'dos': args.dos,
-                            'npts_density': args.npts_density})
-            if comparison_key == 'sampling':
-                options.update({'jitter': jitter_options[i]})
-            elif row_key == 'sampling':
-                options.update({'jitter': jitter_options[row_index]})
+            cell_index = row_cells[i]
+            options = all_cell_options[cell_index]
 
-            ref_spectrum = get_ref_spectrum(force_constants,
-                                            max_energy=max_energy,
-                                            npts=args.ref_npts,
-                                            dos=args.dos,
-                                            bin_width=bin_width,
-                                            q=options['q'],
-                                            npts_density=args.npts_density,
-                                            ).broaden(options['smear_width'],
-                                                      shape='gauss')
+            ref_spectrum = get_broadened_ref(options['q'],
+                                             options['smear_width'])
 
             if (i == 0) and (comparison_key != 'q'):
                 _plot_1d_core(ref_spectrum, data_ax)
                 if (row_index == 0):
                     labels.append("Reference")
 
-            print("Calculating spectrum: ",
-                  ", ".join([f'{key}={_label_print(value)}'
-                             for key, value in options.items()]))
-            spectrum = get_spectrum(force_constants, **options)
+            spectrum = all_spectra[cell_index]
 
-            diff = diff_1d(spectrum, ref_spectrum)
-            box_data.append(diff.magnitude)
-
-            rms = diff_1d_avg(spectrum, ref_spectrum, rms=True, fractional=True)
-            rms_data.append(rms.magnitude)
-            # rms_rel = diff_1d_avg(spectrum, ref_spectrum,
-            #                       rms=True, fractional=True)
-            mean_err = diff_1d_avg(spectrum, ref_spectrum, rms=False)
+            batch_diff, batch_index = cell_diffs[cell_index]
+            box_data.append(batch_diff.residuals[batch_index])
+            rms_data.append(batch_diff.fractional_rms[batch_index])
+            mean_err = batch_diff.mean[batch_index] * batch_diff.units
 
             if comparison_key == 'sampling':
                 label_rotation = 30
@@ -352,6 +694,10 @@ def main():
     if args.title:
         fig.suptitle(args.title)
 
+    if args.profile:
+        PROFILER.write(args.profile)
+        print(f"Profile written to {args.profile}")
+
     plt.show()
 
 
@@ -10,13 +10,26 @@ import numpy as np
 from euphonic import ureg
 from euphonic.force_constants import ForceConstants
 from euphonic.plot import plot_1d
-from euphonic.powder import sample_sphere_dos, sample_sphere_structure_factor
+
+from broadening import broaden, polynomial_width
+from disk_cache import DiskCache, DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE
+from debye_waller_cache import cached_debye_wallers
+from force_constants_cache import cached_force_constants
+from material_info import get_energy_bins, get_material_info
+from mode_grid import (DEFAULT_GRID_MAX_MEMORY, DEFAULT_GRID_SPACING,
+                       DEFAULT_GRID_TOLERANCE, cached_mode_grid,
+                       converged_mode_grid)
+from pruned_force_constants import prune_force_constants
+from sphere_sampling import (DEFAULT_CHUNK_SIZE, NESTED_SAMPLING,
+                             sample_sphere, sample_sphere_prefixes,
+                             sample_sphere_temperatures)
+from profiling import PROFILER
 
 
 def get_parser() -> argparse.ArgumentParser:
     sampling_choices = {'golden', 'sphere-from-square-grid',
                         'spherical-polar-grid', 'spherical-polar-improved',
-                        'random-sphere'}
+                        'random-sphere', 'halton', 'sobol'}
     parser = argparse.ArgumentParser()
     parser.add_argument('file', type=str,
                         help='Path to Phonopy YAML file')
@@ -30,44 +43,215 @@ def get_parser() -> argparse.ArgumentParser:
                         help="width of DOS bins in meV")
     parser.add_argument('--smear-width', '-s', type=float, default=1.,
                         help="width of DOS smearing in meV")
+    parser.add_argument('--energy-broadening', type=float, nargs='+',
+                        default=None, dest='energy_broadening',
+                        metavar='COEFF',
+                        help=("Broaden with an energy-dependent FWHM "
+                              "c0 + c1 E + c2 E^2 + ... (E and FWHM in meV) "
+                              "instead of the fixed 1 meV, e.g. to model "
+                              "instrument resolution"))
     parser.add_argument('--neutron', action='store_true',
                         help='Calculate structure factor instead of DOS')
-    parser.add_argument('--temperature', type=float, default=273.,
-                        help='Temperature (K) used for structure factors')
+    parser.add_argument('--temperature', type=float, nargs='+',
+                        default=[273.],
+                        help=('Temperature (K) used for structure factors. '
+                              'If several are given, phonons are calculated '
+                              'once and a spectrum is plotted for each '
+                              'temperature'))
+    parser.add_argument('--dw-spacing', type=float, default=None,
+                        dest='dw_spacing',
+                        help=("Maximum grid spacing for the Debye-Waller "
+                              "factor in recip. angstrom (the starting grid "
+                              "if --dw-tolerance is given)"))
+    parser.add_argument('--dw-tolerance', type=float, default=None,
+                        dest='dw_tolerance',
+                        help=("Double the Debye-Waller grid until the "
+                              "fractional change in e^-W at the largest |q| "
+                              "is below this tolerance"))
+    parser.add_argument('--incremental', action='store_true',
+                        help=('Calculate only the largest npts and obtain '
+                              'the others from prefixes of the same point '
+                              'set. Requires nested sampling: '
+                              + ', '.join(sorted(NESTED_SAMPLING))))
+    parser.add_argument('--cache-dir', type=str, default=DEFAULT_CACHE_DIR,
+                        dest='cache_dir',
+                        help=("Directory for on-disk cache of material data "
+                              "and binary copies of force constants"))
+    parser.add_argument('--cache-size', type=float,
+                        default=DEFAULT_CACHE_SIZE, dest='cache_size',
+                        help="Maximum size of on-disk cache in MB")
+    parser.add_argument('--no-cache', action='store_false', dest='use_cache',
+                        help="Always recalculate material data")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        dest='chunk_size',
+                        help=("Maximum number of q-points in each phonon "
+                              "calculation; limits peak memory use"))
+    parser.add_argument('--mode-grid', type=float, nargs='?', default=None,
+                        const=0., dest='mode_grid', metavar='SPACING',
+                        help=("Precompute phonon modes on a grid over the "
+                              "Brillouin zone with this spacing in recip. "
+                              "angstrom, stored in the cache, and "
+                              "interpolate from it instead of calculating "
+                              "each sampling point. Without SPACING, the "
+                              "spacing for structure factors is halved from "
+                              "a coarse grid until --mode-grid-tolerance is "
+                              "met"))
+    parser.add_argument('--mode-grid-tolerance', type=float,
+                        default=DEFAULT_GRID_TOLERANCE,
+                        dest='mode_grid_tolerance', metavar='TOL',
+                        help=("Before using --mode-grid for structure "
+                              "factors, compare S from the grid with a "
+                              "direct calculation on a few points of each "
+                              "sphere and stop if the relative RMS "
+                              "difference is above TOL"))
+    parser.add_argument('--mode-grid-memory', type=float,
+                        default=DEFAULT_GRID_MAX_MEMORY,
+                        dest='mode_grid_memory', metavar='MB',
+                        help=("Refuse to build a mode grid needing more "
+                              "than this much memory in MB"))
+    parser.add_argument('--prune-tolerance', type=float, default=None,
+                        dest='prune_tolerance', metavar='TOL',
+                        help=("Drop force constant blocks smaller than TOL "
+                              "times the largest when sampling (not for "
+                              "polar materials), and print the resulting "
+                              "bound on the frequency error"))
+    parser.add_argument('--profile', type=str, default=None,
+                        metavar='FILE',
+                        help=("Record wall time, q-points per second and peak "
+                              "memory of each calculation stage and write "
+                              "them to FILE (CSV if FILE ends in .csv, "
+                              "otherwise JSON)"))
     return parser
 
 
 def main():
-    args = get_parser().parse_args()
+    parser = get_parser()
+    args = parser.parse_args()
     filename = args.file
+    PROFILER.enabled = args.profile is not None
+    if args.mode_grid is not None and args.prune_tolerance is not None:
+        parser.error('--prune-tolerance cannot be used with --mode-grid')
+    if args.incremental:
+        if args.sampling not in NESTED_SAMPLING:
+            parser.error(f'--sampling {args.sampling} cannot be used with '
+                         '--incremental; use one of '
+                         + ', '.join(sorted(NESTED_SAMPLING)))
+        if args.jitter:
+            parser.error('--jitter cannot be used with --incremental')
 
-    temperature = args.temperature * ureg['K']
+    temperatures = [temperature * ureg('K')
+                    for temperature in args.temperature]
+    if len(temperatures) > 1:
+        if not args.neutron:
+            parser.error('Several temperatures can only be used with '
+                         '--neutron')
+        if args.incremental:
+            parser.error('Several temperatures cannot be used with '
+                         '--incremental')
 
     summary_name = os.path.basename(filename)
     path = os.path.dirname(filename)
 
-    force_constants = ForceConstants.from_phonopy(
-        path=path, summary_name=summary_name)
+    def load_force_constants():
+        return ForceConstants.from_phonopy(path=path,
+                                           summary_name=summary_name)
+
+    if args.use_cache:
+        cache = DiskCache(args.cache_dir, max_size=args.cache_size)
+        force_constants, fc_hash = cached_force_constants(
+            filename, load_force_constants, args.cache_dir)
+    else:
+        cache, fc_hash = None, None
+        force_constants = load_force_constants()
+
+    max_energy = get_material_info(force_constants, fc_hash=fc_hash,
+                                   cache=cache)['max_energy']
+    energy_bins = get_energy_bins(max_energy, args.bin_width * ureg('meV'))
+
+    dos_options = dict(energy_bins=energy_bins, sampling=args.sampling,
+                       dos=(not args.neutron), temperature=temperatures[0],
+                       chunk_size=args.chunk_size)
+    mod_q = args.q * ureg('1/angstrom')
+
+    if args.neutron:
+        # Calculated once from the force constants and shared by every npts
+        dws, _ = cached_debye_wallers(
+            force_constants, temperatures,
+            spacing=(None if args.dw_spacing is None
+                     else args.dw_spacing * ureg('1/angstrom')),
+            tolerance=args.dw_tolerance, q_max=mod_q, fc_hash=fc_hash,
+            cache=cache, chunk_size=args.chunk_size)
+        dos_options['dw'] = dws[0]
+
+    if args.energy_broadening is None:
+        broadening_width = 1 * ureg('meV')
+    else:
+        broadening_width = polynomial_width(args.energy_broadening)
+
+    grid_options = dict(
+        spacing=(args.mode_grid * ureg('1/angstrom')
+                 if args.mode_grid else None),
+        max_memory=args.mode_grid_memory, fc_hash=fc_hash,
+        cache_dir=(args.cache_dir if args.use_cache else None),
+        chunk_size=args.chunk_size)
+    if args.mode_grid is None:
+        sampler = prune_force_constants(force_constants,
+                                        args.prune_tolerance)
+    elif args.neutron:
+        sampler, _ = converged_mode_grid(
+            force_constants, np.atleast_1d(mod_q), energy_bins=energy_bins,
+            width=broadening_width, dw=dws[0],
+            tolerance=args.mode_grid_tolerance, **grid_options)
+    else:
+        if grid_options['spacing'] is None:
+            grid_options['spacing'] = DEFAULT_GRID_SPACING
+        sampler = cached_mode_grid(force_constants, eigenvectors=False,
+                                   **grid_options)
+
+    if args.incremental:
+        with PROFILER.options(npts=max(args.npts), incremental=True):
+            dos_list = sample_sphere_prefixes(sampler, mod_q,
+                                              npts=args.npts, **dos_options)
+    elif len(temperatures) > 1:
+        # One spectrum per (npts, temperature), from one phonon calculation
+        # per npts
+        del dos_options['temperature'], dos_options['dw'], dos_options['dos']
+        dos_list = []
+        for npts in args.npts:
+            with PROFILER.options(npts=npts):
+                dos_list += sample_sphere_temperatures(
+                    sampler, mod_q, temperatures=temperatures, dws=dws,
+                    npts=npts, jitter=args.jitter, **dos_options)
+    else:
+        dos_list = []
+        for npts in args.npts:
+            with PROFILER.options(npts=npts):
+                dos_list.append(sample_sphere(sampler, mod_q,
+                                              npts=npts, jitter=args.jitter,
+                                              **dos_options))
+
+    if len(temperatures) > 1:
+        labels = [f'{npts}, {temperature:~P}' for npts in args.npts
+                  for temperature in temperatures]
+        npts_list = [npts for npts in args.npts for _ in temperatures]
+    else:
+        labels = npts_list = args.npts
 
     dos_collection = {}
 
-    for npts in args.npts:
-        if args.neutron:
-            dos = sample_sphere_structure_factor(force_constants, args.q,
-                                                 sampling=args.sampling,
-                                                 temperature=temperature,
-                                                 npts=npts, jitter=args.jitter)
-        else:
-            dos = sample_sphere_dos(force_constants, args.q,
-                                    sampling=args.sampling,
-                                    npts=npts, jitter=args.jitter)
-        broad_dos = dos.broaden(1 * ureg('meV'), shape='lorentz')
+    for label, npts, dos in zip(labels, npts_list, dos_list):
+        with PROFILER.options(npts=npts), PROFILER.stage('broadening'):
+            broad_dos = broaden(dos, broadening_width, shape='lorentz')
 
-        dos_collection.update({npts: broad_dos})
+        dos_collection.update({label: broad_dos})
 
     label_list, dos_list = map(list, zip(*dos_collection.items()))
     fig = plot_1d(dos_list, y_min=0, labels=label_list, title=summary_name)
 
+    if args.profile:
+        PROFILER.write(args.profile)
+        print(f"Profile written to {args.profile}")
+
     plt.show()
 
 
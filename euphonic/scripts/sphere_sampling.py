@@ -0,0 +1,844 @@
+"""Batched, streaming powder averaging over spherical q-point shells
+
+Rather than sampling and calculating each |q| shell in a separate call to
+sample_sphere_dos or sample_sphere_structure_factor, the q-points of all
+shells are generated lazily as one stream. Phonons are calculated over this
+stream in fixed-size chunks and each chunk is histogrammed straight into the
+rows of a 2D intensity array, so peak memory depends on the chunk size
+rather than the number of points.
+
+sample_sphere_shells_adaptive instead grows the number of points on each
+shell in rounds, using a progressive sequence so that no calculated points
+are discarded, until the spectrum stops changing.
+
+sample_sphere_shells_rqmc splits the points of each shell between several
+independently scrambled Sobol' sequences, so that the statistical error of
+the average can be estimated from their spread without a reference
+calculation.
+
+sample_sphere_temperatures calculates the phonons on a sphere once and
+evaluates the structure factor at several temperatures from them; only the
+Debye-Waller and Bose factors depend on temperature.
+"""
+
+import itertools
+import warnings
+from typing import (Iterable, Iterator, List, Optional, Sequence, Tuple,
+                    Union)
+
+import numpy as np
+
+try:
+    from scipy.stats import qmc
+except ImportError:  # Added in SciPy 1.7
+    qmc = None
+
+import euphonic.sampling
+from euphonic import ureg, Quantity, Spectrum1D, Spectrum1DCollection
+from euphonic import Spectrum2D
+from euphonic import DebyeWaller, ForceConstants, QpointFrequencies
+from euphonic import QpointPhononModes
+from euphonic.powder import _qpts_cart_to_frac
+from euphonic.util import mp_grid
+
+from broadening import WidthFunction, broaden
+from compare_spectra import diff_1d_avg
+from profiling import PROFILER
+
+DEFAULT_CHUNK_SIZE = 1000
+DEFAULT_TEMPERATURE = 273 * ureg('K')
+DEFAULT_DW_SPACING = 0.025 * ureg('1/angstrom')
+DEFAULT_SCRAMBLES = 8
+
+# Sampling schemes for which any prefix of a point set is also well
+# distributed, so that a point set can be extended without recalculation
+NESTED_SAMPLING = {'halton', 'random-sphere'}
+
+_GOLDEN_RATIO = (1 + np.sqrt(5)) / 2
+
+
+def get_shell_npts(npts: int, mod_q: Quantity,
+                   npts_density: bool = False) -> int:
+    """Number of points to sample on shell, optionally scaled by area
+
+    If npts_density is True, npts is interpreted as the number of points on a
+    sphere of radius 1 recip. angstrom and scaled to the same density.
+    """
+    if npts_density:
+        return int(np.ceil(npts * (mod_q.to('1/angstrom').magnitude**2)))
+    else:
+        return npts
+
+
+def get_debye_waller(force_constants: ForceConstants,
+                     temperature: Quantity,
+                     dw_spacing: Quantity = DEFAULT_DW_SPACING,
+                     *,
+                     grid: Optional[Sequence[int]] = None,
+                     chunk_size: int = DEFAULT_CHUNK_SIZE) -> DebyeWaller:
+    """Debye-Waller factor on the automatic grid used by sample_sphere_*
+
+    Args:
+        force_constants: Force constants of material
+        temperature: Temperature of Debye-Waller factor
+        dw_spacing: Maximum spacing of Monkhorst-Pack grid
+        grid: Number of grid points along each reciprocal axis; overrides
+            dw_spacing
+        chunk_size: Maximum number of q-points per phonon calculation. The
+            Debye-Waller factor is a weighted mean over q-points, so the
+            results of each chunk are combined without holding all the
+            eigenvectors at once.
+    """
+    return get_debye_wallers(force_constants, [temperature], dw_spacing,
+                             grid=grid, chunk_size=chunk_size)[0]
+
+
+def get_debye_wallers(force_constants: ForceConstants,
+                      temperatures: Sequence[Quantity],
+                      dw_spacing: Quantity = DEFAULT_DW_SPACING,
+                      *,
+                      grid: Optional[Sequence[int]] = None,
+                      chunk_size: int = DEFAULT_CHUNK_SIZE
+                      ) -> List[DebyeWaller]:
+    """Debye-Waller factors at several temperatures from one set of modes
+
+    Arguments are as for get_debye_waller. The phonons on the grid are
+    calculated once and used for every temperature.
+    """
+    if grid is None:
+        grid = force_constants.crystal.get_mp_grid_spec(dw_spacing)
+    dw_qpts = mp_grid(grid)
+    with PROFILER.stage('debye-waller', n_qpts=len(dw_qpts)):
+        dw_sums = [0] * len(temperatures)
+        for start in range(0, len(dw_qpts), chunk_size):
+            chunk_qpts = dw_qpts[start:start + chunk_size]
+            dw_phonons = force_constants.calculate_qpoint_phonon_modes(
+                chunk_qpts)
+            for i, temperature in enumerate(temperatures):
+                dw_chunk = dw_phonons.calculate_debye_waller(temperature)
+                dw_sums[i] = (dw_sums[i]
+                              + dw_chunk.debye_waller * len(chunk_qpts))
+    return [DebyeWaller(force_constants.crystal, dw_sum / len(dw_qpts),
+                        temperature)
+            for dw_sum, temperature in zip(dw_sums, temperatures)]
+
+
+def sample_sphere_shells(force_constants: ForceConstants,
+                         mod_q: Quantity,
+                         *,
+                         energy_bins: Quantity,
+                         npts: Union[int, Sequence[int]] = 1000,
+                         npts_density: bool = False,
+                         sampling: str = 'golden',
+                         jitter: bool = False,
+                         dos: bool = False,
+                         temperature: Optional[Quantity] = DEFAULT_TEMPERATURE,
+                         dw: Optional[DebyeWaller] = None,
+                         chunk_size: int = DEFAULT_CHUNK_SIZE) -> Spectrum2D:
+    """Powder-average DOS or coherent S over several |q| shells at once
+
+    Args:
+        force_constants: Force constants of material
+        mod_q: 1-D array Quantity of sphere radii in reciprocal length units
+        energy_bins: Energy bin edges of output spectra
+        npts: Number of points sampled on each sphere, or a sequence of
+            values corresponding to mod_q
+        npts_density: Scale npts by sphere area (see get_shell_npts)
+        sampling: Sphere sampling scheme, as for sample_sphere_dos
+        jitter: Randomly displace sampling points
+        dos: Compute phonon DOS instead of coherent S
+        temperature: Temperature for Debye-Waller and Bose factors of S. If
+            both this and dw are None, these factors are omitted.
+        dw: Debye-Waller factor for S. If not provided, and temperature is
+            not None, it is calculated once and used for all shells.
+        chunk_size: Maximum number of q-points per phonon calculation
+
+    Returns:
+        Spectrum2D:
+            Powder-averaged spectra with |q| on the x-axis and energy on the
+            y-axis
+    """
+    if isinstance(npts, int):
+        npts = [npts] * len(mod_q)
+    shell_npts = np.array([get_shell_npts(n, q, npts_density)
+                           for n, q in zip(npts, mod_q)])
+
+    if not dos and dw is None and temperature is not None:
+        dw = get_debye_waller(force_constants, temperature,
+                              chunk_size=chunk_size)
+
+    chunks = iter_shell_chunks(force_constants, mod_q, shell_npts,
+                               sampling=sampling, jitter=jitter,
+                               chunk_size=chunk_size)
+
+    # Grid schemes may round npts up, so count the points actually used
+    z_data = np.zeros((len(mod_q), len(energy_bins) - 1))
+    counts = np.zeros(len(mod_q), dtype=int)
+    z_unit = _add_shell_histograms(force_constants, chunks,
+                                   z_data[np.newaxis], counts,
+                                   energy_bins=energy_bins, dos=dos,
+                                   dws=[dw])
+    z_data /= counts[:, np.newaxis]
+
+    return Spectrum2D(mod_q, energy_bins, z_data * z_unit)
+
+
+def sample_sphere(force_constants: ForceConstants,
+                  mod_q: Quantity,
+                  **kwargs) -> Spectrum1D:
+    """Powder-average DOS or coherent S over a single |q| sphere
+
+    The sampling points are streamed in chunks, so that peak memory use
+    depends on chunk_size rather than npts. Arguments are as for
+    sample_sphere_shells, except that mod_q is a scalar.
+    """
+    spectrum_2d = sample_sphere_shells(force_constants,
+                                       np.atleast_1d(mod_q.magnitude)
+                                       * mod_q.units,
+                                       **kwargs)
+    return Spectrum1D(spectrum_2d.y_data, spectrum_2d.z_data[0])
+
+
+def sample_sphere_prefixes(force_constants: ForceConstants,
+                           mod_q: Quantity,
+                           *,
+                           npts: Sequence[int],
+                           energy_bins: Quantity,
+                           sampling: str = 'halton',
+                           dos: bool = False,
+                           temperature: Optional[Quantity] = DEFAULT_TEMPERATURE,
+                           dw: Optional[DebyeWaller] = None,
+                           chunk_size: int = DEFAULT_CHUNK_SIZE
+                           ) -> List[Spectrum1D]:
+    """Powder-average a single |q| sphere for several npts at the cost of one
+
+    Only max(npts) points are calculated; the spectrum for each smaller npts
+    is the histogram of a prefix of the same sequence. This requires a
+    sampling scheme whose prefixes are themselves well distributed (see
+    NESTED_SAMPLING).
+
+    Args:
+        force_constants: Force constants of material
+        mod_q: Scalar sphere radius in reciprocal length units
+        npts: Numbers of points for which spectra are required
+        energy_bins, dos, temperature, dw, chunk_size:
+            As for sample_sphere_shells
+        sampling: One of NESTED_SAMPLING
+
+    Returns:
+        list of Spectrum1D corresponding to npts
+    """
+    if sampling not in NESTED_SAMPLING:
+        raise ValueError(f'Sampling "{sampling}" is not nested; use one of '
+                         + ', '.join(sorted(NESTED_SAMPLING)))
+
+    if not dos and dw is None and temperature is not None:
+        dw = get_debye_waller(force_constants, temperature,
+                              chunk_size=chunk_size)
+
+    # Treat each interval between requested npts as a separate "shell" of
+    # the same radius, then accumulate them to get the prefix histograms
+    checkpoints = np.unique(npts)
+    segment_npts = np.diff(checkpoints, prepend=0)
+    segment_start = checkpoints - segment_npts
+    chunks = iter_shell_chunks(
+        force_constants,
+        np.full(len(checkpoints), mod_q.to('1/angstrom').magnitude)
+        * ureg('1/angstrom'),
+        segment_npts, sampling=sampling, chunk_size=chunk_size,
+        start=(segment_start if sampling == 'halton' else None))
+
+    z_sum = np.zeros((len(checkpoints), len(energy_bins) - 1))
+    counts = np.zeros(len(checkpoints), dtype=int)
+    z_unit = _add_shell_histograms(force_constants, chunks,
+                                   z_sum[np.newaxis], counts,
+                                   energy_bins=energy_bins, dos=dos,
+                                   dws=[dw])
+    z_data = (np.cumsum(z_sum, axis=0)
+              / np.cumsum(counts)[:, np.newaxis]) * z_unit
+
+    return [Spectrum1D(energy_bins, z_data[np.searchsorted(checkpoints, n)])
+            for n in npts]
+
+
+def sample_sphere_temperatures(force_constants: ForceConstants,
+                               mod_q: Quantity,
+                               *,
+                               temperatures: Sequence[Quantity],
+                               energy_bins: Quantity,
+                               npts: int = 1000,
+                               sampling: str = 'golden',
+                               jitter: bool = False,
+                               dws: Optional[Sequence[DebyeWaller]] = None,
+                               chunk_size: int = DEFAULT_CHUNK_SIZE
+                               ) -> List[Spectrum1D]:
+    """Powder-average coherent S over a single |q| sphere at several T
+
+    The phonons at each sampling point are calculated once; the structure
+    factors at all temperatures are then evaluated together from them, chunk
+    by chunk, so that the cost of extra temperatures is small and the modes
+    never need to be held for the whole sphere.
+
+    Args:
+        force_constants: Force constants of material
+        mod_q: Scalar sphere radius in reciprocal length units
+        temperatures: Temperatures for Debye-Waller and Bose factors
+        dws: Debye-Waller factor for each temperature. If not provided,
+            these are calculated with get_debye_wallers.
+        energy_bins, npts, sampling, jitter, chunk_size:
+            As for sample_sphere_shells
+
+    Returns:
+        list of Spectrum1D corresponding to temperatures
+    """
+    if dws is None:
+        dws = get_debye_wallers(force_constants, temperatures,
+                                chunk_size=chunk_size)
+    elif len(dws) != len(temperatures):
+        raise ValueError('A Debye-Waller factor is needed for each '
+                         'temperature')
+
+    chunks = iter_shell_chunks(
+        force_constants,
+        np.atleast_1d(mod_q.to('1/angstrom').magnitude) * ureg('1/angstrom'),
+        [npts], sampling=sampling, jitter=jitter, chunk_size=chunk_size)
+
+    z_sum = np.zeros((len(dws), 1, len(energy_bins) - 1))
+    counts = np.zeros(1, dtype=int)
+    z_unit = _add_shell_histograms(force_constants, chunks, z_sum, counts,
+                                   energy_bins=energy_bins, dos=False,
+                                   dws=dws)
+    return [Spectrum1D(energy_bins, z_row[0] / counts[0] * z_unit)
+            for z_row in z_sum]
+
+
+def iter_sphere_blocks(npts: int,
+                       *,
+                       sampling: str = 'golden',
+                       jitter: bool = False,
+                       start: int = 0,
+                       seed=None,
+                       block_size: int = DEFAULT_CHUNK_SIZE
+                       ) -> Iterator[np.ndarray]:
+    """Lazily yield the points of a unit sphere sampling scheme as arrays
+
+    Sampling options are those of sample_sphere_dos, plus 'halton' (see
+    halton_sphere) and 'sobol' (see sobol_sphere). For 'halton', the sequence
+    may be continued from point number start. For 'sobol', seed determines
+    the scrambling.
+
+    Yields:
+        (n, 3) arrays of Cartesian unit vectors, of at most block_size
+        points except for 'sobol', which gives the whole set at once
+    """
+    if start and sampling != 'halton':
+        raise ValueError(f'Sampling "{sampling}" cannot be continued')
+
+    if sampling == 'halton':
+        for block_start in range(start, start + npts, block_size):
+            yield halton_sphere(block_start,
+                                min(block_size, start + npts - block_start))
+        return
+    elif sampling == 'sobol':
+        yield sobol_sphere(npts, seed=seed)
+        return
+    elif sampling == 'golden':
+        for block_start in range(0, npts, block_size):
+            yield golden_sphere(npts, block_start,
+                                min(block_start + block_size, npts),
+                                jitter=jitter)
+        return
+    elif sampling in ('sphere-projected-grid', 'sphere-from-square-grid'):
+        n_cols = int(np.ceil(np.sqrt(npts / 2)))
+        points = euphonic.sampling.sphere_from_square_grid(
+            n_cols * 2, n_cols, jitter=jitter)
+    elif sampling == 'spherical-polar-grid':
+        n_cols = int(np.ceil(np.sqrt(npts / 2)))
+        points = euphonic.sampling.spherical_polar_grid(
+            n_cols * 2, n_cols, jitter=jitter)
+    elif sampling == 'spherical-polar-improved':
+        points = euphonic.sampling.spherical_polar_improved(
+            npts, jitter=jitter)
+    elif sampling == 'random-sphere':
+        points = euphonic.sampling.random_sphere(npts)
+    else:
+        raise ValueError(f'Unknown sampling method "{sampling}"')
+
+    # The other schemes are euphonic generators of single points; read
+    # them straight into arrays
+    point_dtype = np.dtype((float, 3))
+    while True:
+        block = np.fromiter(itertools.islice(points, block_size),
+                            dtype=point_dtype)
+        if not len(block):
+            return
+        yield block
+
+
+def iter_shell_chunks(force_constants: ForceConstants,
+                      mod_q: Quantity,
+                      shell_npts: Sequence[int],
+                      *,
+                      sampling: str = 'golden',
+                      jitter: bool = False,
+                      chunk_size: int = DEFAULT_CHUNK_SIZE,
+                      start: Optional[Sequence[int]] = None,
+                      seeds: Optional[Sequence] = None
+                      ) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """Yield sampling points of several shells in fixed-size chunks
+
+    Chunks may span the boundary between shells, so every chunk except the
+    last contains exactly chunk_size points. If start is given, the sampling
+    sequence of each shell is continued from that point; seeds gives a
+    random seed for each shell (see iter_sphere_blocks).
+
+    Yields:
+        (np.ndarray, np.ndarray):
+            (n, 3) array of q-points in fractional coordinates and (n,)
+            array of the index of the shell each point belongs to
+    """
+    mod_q = mod_q.to('1/angstrom').magnitude
+    if start is None:
+        start = np.zeros(len(shell_npts), dtype=int)
+    if seeds is None:
+        seeds = [None] * len(shell_npts)
+
+    def to_chunk(points, shell_index):
+        qpts_cart = (points * mod_q[shell_index, np.newaxis]
+                     * ureg('1/angstrom'))
+        return (_qpts_cart_to_frac(qpts_cart, force_constants.crystal),
+                shell_index)
+
+    # Blocks of each shell are buffered until there is at least one full
+    # chunk, which is then sliced off
+    buffered_points, buffered_shells = [], []
+    n_buffered = 0
+    for shell, (n, shell_start, seed) in enumerate(zip(shell_npts, start,
+                                                       seeds)):
+        for block in iter_sphere_blocks(n, sampling=sampling, jitter=jitter,
+                                        start=shell_start, seed=seed,
+                                        block_size=chunk_size):
+            buffered_points.append(block)
+            buffered_shells.append(np.full(len(block), shell))
+            n_buffered += len(block)
+            if n_buffered < chunk_size:
+                continue
+            points = np.concatenate(buffered_points)
+            shell_index = np.concatenate(buffered_shells)
+            n_full = n_buffered - n_buffered % chunk_size
+            for chunk_start in range(0, n_full, chunk_size):
+                chunk = slice(chunk_start, chunk_start + chunk_size)
+                yield to_chunk(points[chunk], shell_index[chunk])
+            buffered_points = [points[n_full:]]
+            buffered_shells = [shell_index[n_full:]]
+            n_buffered -= n_full
+
+    if n_buffered:
+        yield to_chunk(np.concatenate(buffered_points),
+                       np.concatenate(buffered_shells))
+
+
+def _calculate_structure_factors(phonons: QpointPhononModes,
+                                 dws: Sequence[Optional[DebyeWaller]]
+                                 ) -> np.ndarray:
+    """Structure factor of each mode for each of several Debye-Waller factors
+
+    Returns:
+        (len(dws), n_qpts, n_modes) array of structure factors in mbarn
+    """
+    return np.stack([
+        phonons.calculate_structure_factor(dw=dw).structure_factors.to(
+            'mbarn').magnitude
+        for dw in dws])
+
+
+def _bin_structure_factors(frequencies: Quantity,
+                           structure_factors: np.ndarray,
+                           temperatures: Sequence[Optional[Quantity]],
+                           shells: np.ndarray,
+                           n_shells: int,
+                           energy_bins: Quantity) -> np.ndarray:
+    """Sum Bose-populated structure factors into shell and energy bins
+
+    Intensities are placed at +frequency (with a factor n + 1) and
+    -frequency (with a factor n), where n is the Bose factor at each
+    temperature, as in StructureFactor.calculate_1d_average; with no
+    temperature both are unweighted.
+
+    Args:
+        frequencies: (n_qpts, n_modes) frequencies
+        structure_factors: (n_temperatures, n_qpts, n_modes) array
+        temperatures: Temperature of each row of structure_factors, or None
+        shells: (n_qpts,) index of shell of each q-point
+        n_shells: Number of shells
+        energy_bins: Energy bin edges
+
+    Returns:
+        (n_temperatures, n_shells, n_bins) array of sums over q-points of
+        intensity per unit energy, in energy_bins units
+    """
+    frequencies = frequencies.to('meV').magnitude
+    # Converting a 0 1/cm bin edge warns of division by zero
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        bin_edges = energy_bins.to('meV').magnitude
+    n_bins = len(bin_edges) - 1
+    shells = np.broadcast_to(shells[:, np.newaxis], frequencies.shape)
+
+    populations = []
+    for temperature in temperatures:
+        if temperature is None:
+            populations.append((1, 1))
+            continue
+        k_t = (temperature * ureg.k).to('meV').magnitude
+        if k_t > 0:
+            bose = 1 / np.expm1(np.abs(frequencies) / k_t)
+        else:
+            bose = np.zeros(frequencies.shape)
+        populations.append((1 + bose, bose))
+
+    z_sum = np.zeros((len(temperatures), n_shells * n_bins))
+    for sign, factor_index in ((1, 0), (-1, 1)):
+        index = np.digitize(sign * frequencies, bin_edges) - 1
+        in_range = (index >= 0) & (index < n_bins)
+        flat_index = (shells * n_bins + index)[in_range]
+        for i, population in enumerate(populations):
+            weights = (population[factor_index]
+                       * structure_factors[i])[in_range]
+            z_sum[i] += np.bincount(flat_index, weights=weights,
+                                    minlength=n_shells * n_bins)
+    z_sum = z_sum.reshape(len(temperatures), n_shells, n_bins)
+    return z_sum / np.diff(energy_bins.magnitude)
+
+
+def _add_shell_histograms(force_constants: ForceConstants,
+                          chunks: Iterable[Tuple[np.ndarray, np.ndarray]],
+                          z_sum: np.ndarray,
+                          counts: np.ndarray,
+                          *,
+                          energy_bins: Quantity,
+                          dos: bool,
+                          dws: Sequence[Optional[DebyeWaller]]):
+    """Add histograms of q-points to the row of z_sum for their shell
+
+    Phonons are calculated for one chunk (as from iter_shell_chunks) at a
+    time, and released as soon as it has been histogrammed. For the DOS only
+    frequencies are calculated, so no eigenvectors are allocated. z_sum has
+    shape (len(dws), n_shells, n_bins): the structure factor of each chunk
+    is evaluated with every Debye-Waller factor (and its temperature's Bose
+    factor) in dws. For the DOS, dws must have length 1. Rows of z_sum are
+    incremented by the sum (not average) of the spectra at each q-point in
+    that shell, and counts by the number of those q-points. Returns the
+    units of z_sum.
+    """
+    z_unit = None
+    # Sampling points are generated lazily, so time their production too
+    chunks = PROFILER.iterate('sampling', chunks,
+                              count=lambda chunk: len(chunk[0]))
+    for qpts_frac, chunk_shells in chunks:
+        with PROFILER.stage('phonons', n_qpts=len(qpts_frac)):
+            if dos:
+                phonons = force_constants.calculate_qpoint_frequencies(
+                    qpts_frac)
+            else:
+                phonons = force_constants.calculate_qpoint_phonon_modes(
+                    qpts_frac)
+
+        with PROFILER.stage('histogram', n_qpts=len(qpts_frac)):
+            if dos:
+                for shell in np.unique(chunk_shells):
+                    mask = chunk_shells == shell
+                    spectrum = QpointFrequencies(
+                        force_constants.crystal, phonons.qpts[mask],
+                        phonons.frequencies[mask]).calculate_dos(energy_bins)
+                    # Each chunk gives an average over its own points
+                    z_sum[0, shell] += (spectrum.y_data.magnitude
+                                        * np.count_nonzero(mask))
+                    z_unit = spectrum.y_data.units
+            else:
+                structure_factors = _calculate_structure_factors(phonons,
+                                                                 dws)
+                z_sum += _bin_structure_factors(
+                    phonons.frequencies, structure_factors,
+                    [None if dw is None else dw.temperature for dw in dws],
+                    chunk_shells, z_sum.shape[1], energy_bins)
+                z_unit = ureg.Unit('mbarn') / energy_bins.units
+                del structure_factors
+            counts += np.bincount(chunk_shells, minlength=len(counts))
+
+        # Drop eigenvectors before the next chunk is calculated
+        del phonons
+    return z_unit
+
+
+def _radical_inverse(indices: np.ndarray, base: int) -> np.ndarray:
+    """Van der Corput radical inverse of integer indices in given base"""
+    indices = np.array(indices)
+    result = np.zeros(indices.shape)
+    factor = 1. / base
+    while np.any(indices > 0):
+        indices, digits = np.divmod(indices, base)
+        result += digits * factor
+        factor /= base
+    return result
+
+
+def _square_to_sphere(u: np.ndarray, v: np.ndarray) -> np.ndarray:
+    """Area-preserving map of points in the unit square to the unit sphere"""
+    cos_theta = 1 - 2 * u
+    phi = 2 * np.pi * v
+    sin_theta = np.sqrt(1 - cos_theta**2)
+    return np.stack([sin_theta * np.cos(phi),
+                     sin_theta * np.sin(phi),
+                     cos_theta], axis=1)
+
+
+def golden_sphere(npts: int, start: int = 0, stop: Optional[int] = None,
+                  *, jitter: bool = False) -> np.ndarray:
+    """Points start to stop of an npts-point golden-ratio sphere sampling
+
+    The same points as euphonic.sampling.golden_sphere, which yields them
+    one at a time, calculated as an array. Jitter is drawn from the same
+    random generator, in the same order.
+
+    Returns:
+        (stop - start, 3) array of Cartesian unit vectors
+    """
+    if stop is None:
+        stop = npts
+    indices = np.arange(start, stop)
+    x = indices / npts + 1 / (2 * npts)
+    y = indices / _GOLDEN_RATIO
+    if jitter:
+        displacement = ((euphonic.sampling.rng.random((len(indices), 2))
+                         - 0.5) / np.sqrt(npts))
+        x += displacement[:, 0]
+        y += displacement[:, 1]
+    # euphonic maps x to cos(theta) = 2x - 1
+    return _square_to_sphere(1 - np.mod(x, 1), np.mod(y, 1))
+
+
+def halton_sphere(start: int, npts: int) -> np.ndarray:
+    """Points start, ..., start + npts - 1 of a progressive sphere sequence
+
+    A 2D Halton sequence (bases 2 and 3) is mapped to the unit sphere with an
+    area-preserving projection. Any prefix of the sequence is well
+    distributed, so a sampling can be refined by adding further points
+    without discarding those already calculated.
+
+    Returns:
+        (npts, 3) array of Cartesian unit vectors
+    """
+    # Index 0 maps onto a pole; start the sequence from 1
+    indices = np.arange(start + 1, start + npts + 1)
+    return _square_to_sphere(_radical_inverse(indices, 2),
+                             _radical_inverse(indices, 3))
+
+
+def sobol_sphere(npts: int, seed=None) -> np.ndarray:
+    """Points of a randomly scrambled 2D Sobol' sequence on the unit sphere
+
+    Each scrambling is an unbiased sample of the sphere with low-discrepancy
+    (quasi-Monte Carlo) convergence, so independent scramblings can be used
+    to estimate the error of an average. The sequence is best balanced when
+    npts is a power of 2.
+
+    Args:
+        npts: Number of points
+        seed: Seed or numpy.random.Generator used for scrambling
+
+    Returns:
+        (npts, 3) array of Cartesian unit vectors
+    """
+    if qmc is None:
+        raise ImportError('Sobol sampling requires scipy.stats.qmc '
+                          '(SciPy >= 1.7)')
+    sampler = qmc.Sobol(d=2, scramble=True, seed=seed)
+    with warnings.catch_warnings():
+        # Warns if npts is not a power of 2
+        warnings.simplefilter('ignore', UserWarning)
+        points = sampler.random(npts)
+    return _square_to_sphere(points[:, 0], points[:, 1])
+
+
+def sample_sphere_shells_rqmc(
+        force_constants: ForceConstants,
+        mod_q: Quantity,
+        *,
+        energy_bins: Quantity,
+        npts: Union[int, Sequence[int]] = 1000,
+        n_scrambles: int = DEFAULT_SCRAMBLES,
+        npts_density: bool = False,
+        smear_width: Union[Quantity, WidthFunction, None] = None,
+        dos: bool = False,
+        temperature: Optional[Quantity] = DEFAULT_TEMPERATURE,
+        dw: Optional[DebyeWaller] = None,
+        seed=None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE) -> Tuple[Spectrum2D, Spectrum2D]:
+    """Powder-average over |q| shells with randomised quasi-Monte Carlo
+
+    The points on each shell are divided between n_scrambles independently
+    scrambled Sobol' sequences (see sobol_sphere). The spectrum is the mean
+    of the averages over each scramble, and its standard error is estimated
+    from their spread, so convergence can be judged without a reference
+    calculation.
+
+    Args:
+        force_constants: Force constants of material
+        mod_q: 1-D array Quantity of sphere radii in reciprocal length units
+        energy_bins: Energy bin edges of output spectra
+        npts: Total number of points sampled on each sphere (rounded up to a
+            multiple of n_scrambles), or a sequence of values corresponding
+            to mod_q
+        n_scrambles: Number of independent scrambles; at least 2
+        npts_density: Scale npts by sphere area (see get_shell_npts)
+        smear_width: If provided, Gaussian broadening is applied to each
+            scramble before the mean and error are taken. May be a function
+            of energy (see broadening.broaden).
+        dos, temperature, dw, chunk_size: As for sample_sphere_shells
+        seed: Seed for the scrambles
+
+    Returns:
+        (Spectrum2D, Spectrum2D):
+            Powder-averaged spectra and their standard error, with |q| on the
+            x-axis and energy on the y-axis
+    """
+    if n_scrambles < 2:
+        raise ValueError('At least 2 scrambles are needed to estimate error')
+
+    if isinstance(npts, int):
+        npts = [npts] * len(mod_q)
+    scramble_npts = np.array(
+        [int(np.ceil(get_shell_npts(n, q, npts_density) / n_scrambles))
+         for n, q in zip(npts, mod_q)])
+
+    if not dos and dw is None and temperature is not None:
+        dw = get_debye_waller(force_constants, temperature,
+                              chunk_size=chunk_size)
+
+    # Each scramble of each shell is treated as a separate "shell" of the
+    # same radius; replica i * n_scrambles + j is scramble j of shell i
+    n_replicas = len(mod_q) * n_scrambles
+    seeds = [np.random.default_rng(seed_sequence) for seed_sequence
+             in np.random.SeedSequence(seed).spawn(n_replicas)]
+    chunks = iter_shell_chunks(
+        force_constants, np.repeat(mod_q.to('1/angstrom').magnitude,
+                                   n_scrambles) * ureg('1/angstrom'),
+        np.repeat(scramble_npts, n_scrambles), sampling='sobol',
+        chunk_size=chunk_size, seeds=seeds)
+
+    z_sum = np.zeros((n_replicas, len(energy_bins) - 1))
+    counts = np.zeros(n_replicas, dtype=int)
+    z_unit = _add_shell_histograms(force_constants, chunks,
+                                   z_sum[np.newaxis], counts,
+                                   energy_bins=energy_bins, dos=dos,
+                                   dws=[dw])
+    replicas = z_sum / counts[:, np.newaxis]
+
+    if smear_width is not None:
+        with PROFILER.stage('broadening'):
+            replicas = broaden(
+                Spectrum1DCollection(energy_bins, replicas * z_unit),
+                smear_width, shape='gauss').y_data.to(z_unit).magnitude
+
+    replicas = replicas.reshape(len(mod_q), n_scrambles, -1)
+    z_mean = np.mean(replicas, axis=1)
+    z_error = np.std(replicas, axis=1, ddof=1) / np.sqrt(n_scrambles)
+
+    return (Spectrum2D(mod_q, energy_bins, z_mean * z_unit),
+            Spectrum2D(mod_q, energy_bins, z_error * z_unit))
+
+
+def sample_sphere_shells_adaptive(
+        force_constants: ForceConstants,
+        mod_q: Quantity,
+        *,
+        energy_bins: Quantity,
+        tolerance: float = 1e-2,
+        smear_width: Union[Quantity, WidthFunction, None] = (
+            1 * ureg('meV')),
+        npts_initial: int = 100,
+        npts_max: int = int(1e5),
+        growth: int = 2,
+        threshold: float = 1e-12,
+        dos: bool = False,
+        temperature: Optional[Quantity] = DEFAULT_TEMPERATURE,
+        dw: Optional[DebyeWaller] = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE) -> Tuple[Spectrum2D, np.ndarray]:
+    """Powder-average over |q| shells, adding points until converged
+
+    Each shell starts with npts_initial points of halton_sphere. In each
+    round, the number of points on every unconverged shell is multiplied by
+    growth, reusing the points already calculated. A shell is converged when
+    the RMS fractional change (as diff_1d_avg with rms=True, fractional=True)
+    between rounds falls below tolerance, or npts_max is reached.
+
+    Args:
+        force_constants: Force constants of material
+        mod_q: 1-D array Quantity of sphere radii in reciprocal length units
+        energy_bins: Energy bin edges of output spectra
+        tolerance: Convergence threshold for RMS fractional change
+        smear_width: Gaussian width applied to spectra before comparison,
+            as the unbroadened histograms are very noisy, or a function of
+            energy (see broadening.broaden). (The returned spectra are not
+            broadened.)
+        npts_initial: Number of points in first round
+        npts_max: Maximum number of points on any shell
+        growth: Factor by which npts increases each round
+        threshold: Ignore bins with values smaller than this when comparing
+        dos, temperature, dw, chunk_size: As for sample_sphere_shells
+
+    Returns:
+        (Spectrum2D, array of int):
+            Powder-averaged spectra with |q| on the x-axis and energy on the
+            y-axis, and the number of points used for each shell
+    """
+    if not dos and dw is None and temperature is not None:
+        dw = get_debye_waller(force_constants, temperature,
+                              chunk_size=chunk_size)
+
+    n_shells = len(mod_q)
+    z_sum = np.zeros((n_shells, len(energy_bins) - 1))
+    shell_npts = np.zeros(n_shells, dtype=int)
+    previous = [None] * n_shells
+    active = np.ones(n_shells, dtype=bool)
+    z_unit = None
+
+    while np.any(active):
+        # Points to add to each active shell in this round
+        target = np.where(shell_npts == 0, npts_initial, shell_npts * growth)
+        new_npts = np.where(active, np.minimum(target, npts_max) - shell_npts,
+                            0)
+        shells = np.flatnonzero(new_npts)
+
+        chunks = iter_shell_chunks(force_constants, mod_q[shells],
+                                   new_npts[shells], sampling='halton',
+                                   chunk_size=chunk_size,
+                                   start=shell_npts[shells])
+        z_unit = _add_shell_histograms(force_constants,
+                                       ((qpts, shells[index])
+                                        for qpts, index in chunks),
+                                       z_sum[np.newaxis], shell_npts,
+                                       energy_bins=energy_bins,
+                                       dos=dos, dws=[dw])
+
+        for shell in shells:
+            spectrum = Spectrum1D(energy_bins,
+                                  z_sum[shell] / shell_npts[shell] * z_unit)
+            if smear_width is not None:
+                with PROFILER.stage('broadening'):
+                    spectrum = broaden(spectrum, smear_width, shape='gauss')
+
+            if previous[shell] is not None:
+                with PROFILER.stage('comparison'):
+                    change = diff_1d_avg(spectrum, previous[shell], rms=True,
+                                         fractional=True, threshold=threshold)
+                if change.magnitude < tolerance:
+                    active[shell] = False
+            previous[shell] = spectrum
+
+            if shell_npts[shell] >= npts_max:
+                active[shell] = False
+
+    z_data = z_sum / shell_npts[:, np.newaxis]
+    return Spectrum2D(mod_q, energy_bins, z_data * z_unit), shell_npts
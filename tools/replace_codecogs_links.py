@@ -1,6 +1,18 @@
 import re
 
 CODECOGS_SVG_PATTERN=r'\[(.*)\](:|\()\s*(http://latex.codecogs.com/svg.latex\?[^\)\n]*)'
+CODECOGS_SERVER='http://latex.codecogs.com'
+
+# Defaults for fetching many SVGs: concurrent requests (and pooled
+# connections), retries of failed requests with exponential backoff, and
+# the timeout of each request in seconds
+MAX_WORKERS=8
+RETRIES=3
+BACKOFF=0.5
+TIMEOUT=30
+
+# URL and link name of each SVG in a content-addressed store, by filename
+STORE_INDEX='index.json'
 
 def sanitise(x, keep=['_','-','=']):
     s = "".join([c for c in x if c.isalnum() or c in keep]).rstrip()
@@ -19,7 +31,27 @@ def linkname_url(lines):
         name_per_url[r.groups()[2]] = r.groups()[0]
     return name_per_url
 
-def fetch_svg(url, linkname, outdir):
+def make_session(max_workers=MAX_WORKERS, retries=RETRIES, backoff=BACKOFF):
+    """ Create an HTTP session to share between fetches
+
+    The session keeps up to max_workers connections open for reuse, and
+    retries connection errors and server errors (5xx and 429) up to retries
+    times, waiting backoff, 2*backoff, 4*backoff... seconds in between.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    retry = Retry(total=retries, backoff_factor=backoff,
+                  status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=('GET',), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def fetch_svg(url, linkname, outdir, session=None, server=None):
     """ Fetch a remote SVG image from the provided URL
 
     The linkname is sanitised to produce a viable filename which is returned.
@@ -27,8 +59,10 @@ def fetch_svg(url, linkname, outdir):
     URL.
     If the target filename does not exist the remote content is fetched and
     written followed by the generating URL.
+    The request is made with session if given, and to server instead of
+    latex.codecogs.com if given (e.g. a local stand-in for testing).
     """
-    import requests, pathlib
+    import pathlib
     name = sanitise(linkname)
     outPath = pathlib.Path('.','svg',name+'.svg')
     out = str(outPath)
@@ -41,19 +75,103 @@ def fetch_svg(url, linkname, outdir):
                 r = re.search(CODECOGS_SVG_PATTERN, line)
                 if linkname not in r.groups()[0] and url not in r.groups()[2]:
                     msg = 'The file {} exists for link {} instead of {}'
-                    raise Exception(msg.format(out, r.groups()[0]), linkname)
+                    raise Exception(msg.format(out, r.groups()[0], linkname))
     else:
-        r = requests.get(url)
-        if not r.ok:
-            raise Exception("Fetching {} failed with reason {}".format(url, r.reason))
-        with open(out,'wb') as out_file:
-            out_file.write(r.content)
-        # add the generating URL as a comment in the SVG file
-        with open(out,'a') as out_file:
-            comment = '\n<!-- Generated from\n[{}]: {}\n-->'.format(linkname,url)
-            out_file.write(comment)
+        download_svg(url, linkname, out, session, server)
     return out.replace('\\','/') # always use unix-style path separators
 
+def download_svg(url, linkname, out, session=None, server=None):
+    """ Write the remote SVG image of the URL to out, followed by the URL """
+    import requests
+    fetch_url = url if server is None else url.replace(CODECOGS_SERVER, server.rstrip('/'), 1)
+    r = (session or requests).get(fetch_url, timeout=TIMEOUT)
+    if not r.ok:
+        raise Exception("Fetching {} failed with reason {}".format(url, r.reason))
+    with open(out,'wb') as out_file:
+        out_file.write(r.content)
+    # add the generating URL as a comment in the SVG file
+    with open(out,'a') as out_file:
+        comment = '\n<!-- Generated from\n[{}]: {}\n-->'.format(linkname,url)
+        out_file.write(comment)
+
+def fetch_svgs(name_per_url, outdir, max_workers=MAX_WORKERS, session=None, server=None):
+    """ Fetch the SVG images of many URLs concurrently
+
+    Up to max_workers requests are made at once, by default with a session
+    from make_session. URLs whose link names give the same filename are
+    fetched one after another, in order, as fetch_svg checks an existing
+    file against its URL.
+
+    Returns a dictionary with URL keys and the SVG filenames
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    if session is None:
+        session = make_session(max_workers)
+    groups = {}
+    for url, name in name_per_url.items():
+        groups.setdefault(sanitise(name), []).append((url, name))
+
+    def fetch_group(group):
+        return [(url, fetch_svg(url, name, outdir, session, server)) for url, name in group]
+
+    with ThreadPoolExecutor(max_workers) as executor:
+        locs = dict(loc for group in executor.map(fetch_group, groups.values()) for loc in group)
+    return {url: locs[url] for url in name_per_url}
+
+def store_name(url):
+    """ Filename of the SVG of a URL in a content-addressed store """
+    import hashlib
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()[:16] + '.svg'
+
+def fetch_to_store(name_per_url, store, max_workers=MAX_WORKERS, session=None, server=None):
+    """ Fetch the SVG images of URLs which are not yet in a store
+
+    Each SVG is stored as store_name(url), and the store's index file lists
+    the URL and link name of each, so stored URLs are found without reading
+    the SVGs. Up to max_workers requests are made at once.
+
+    Returns a dictionary with URL keys and the SVG paths
+    """
+    import json
+    from pathlib import Path
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    store = Path(store)
+    store.mkdir(parents=True, exist_ok=True)
+    index_path = Path(store, STORE_INDEX)
+    index = {}
+    if index_path.exists():
+        with open(index_path, 'r') as index_file:
+            index = json.load(index_file)
+    paths = {url: Path(store, store_name(url)) for url in name_per_url}
+    for url, path in paths.items():
+        if path.name in index and index[path.name]['url'] != url:
+            msg = 'The file {} exists for URL {} instead of {}'
+            raise Exception(msg.format(path, index[path.name]['url'], url))
+    missing = [url for url, path in paths.items() if path.name not in index or not path.exists()]
+    if session is None:
+        session = make_session(max_workers)
+
+    error = None
+    try:
+        with ThreadPoolExecutor(max_workers) as executor:
+            futures = {executor.submit(download_svg, url, name_per_url[url], str(paths[url]),
+                                       session, server): url for url in missing}
+            # index every SVG as it is fetched, so a failure does not lose the others
+            for future in as_completed(futures):
+                url = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    error = error or e
+                else:
+                    index[paths[url].name] = {'url': url, 'link': name_per_url[url]}
+    finally:
+        with open(index_path, 'w') as index_file:
+            json.dump(index, index_file, indent=1, sort_keys=True)
+    if error is not None:
+        raise error
+    return paths
+
 def update_lines(lines, url_loc):
     ul = []
     for line in lines:
@@ -67,7 +185,14 @@ def update_lines(lines, url_loc):
         ul.append(line)
     return ul
 
-def replace_codecogs_links(filename, backup_ext=None):
+def backup(filename, lines, backup_ext):
+    """ Write lines to filename with the extension backup_ext appended """
+    ext = backup_ext if '.' in backup_ext else '.'+backup_ext
+    with open(str(filename)+ext, 'w') as f:
+        for line in lines:
+            f.write(line)
+
+def replace_codecogs_links(filename, backup_ext=None, max_workers=MAX_WORKERS, retries=RETRIES, server=None):
     from pathlib import Path
     cwd = Path().cwd()
     fpath = Path(*Path(filename).absolute().parts[:-1])
@@ -81,23 +206,72 @@ def replace_codecogs_links(filename, backup_ext=None):
     if not (outdir.exists() and outdir.is_dir()):
         outdir.mkdir()
     if backup_ext:
-        ext = backup_ext if '.' in backup_ext else '.'+backup_ext
-        with open(filename+ext, 'w') as f:
-            for line in lines:
-                f.write(line)
+        backup(filename, lines, backup_ext)
+    # Fetch everything before truncating the file, in case a fetch fails
+    loc_per_url = fetch_svgs(linkname_url(lines), outdir, max_workers,
+                             make_session(max_workers, retries), server)
     with open(filename, 'w') as f:
-        loc_per_url = {u: fetch_svg(u, n, outdir) for u, n in linkname_url(lines).items()}
         for line in update_lines(lines, loc_per_url):
             f.write(line)
 
+def replace_codecogs_links_in_tree(directory, backup_ext=None, store=None, max_workers=MAX_WORKERS,
+                                   retries=RETRIES, server=None):
+    """ Replace codecogs links in all markdown files below a directory
+
+    Equations are fetched once for all files into a content-addressed store,
+    directory/svg by default, see fetch_to_store. All files are then rewritten
+    in one pass, linking to the store by relative paths. Files without
+    codecogs links are not rewritten.
+    """
+    import os
+    from pathlib import Path
+    root = Path(directory)
+    store = Path(store) if store else Path(root, 'svg')
+    lines_per_file = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+        for name in sorted(filenames):
+            if not name.endswith('.md'):
+                continue
+            path = Path(dirpath, name)
+            with open(path, 'r') as f:
+                lines = f.readlines()
+            if any(re.search(CODECOGS_SVG_PATTERN, line) for line in lines):
+                lines_per_file[path] = lines
+
+    name_per_url = {}
+    for lines in lines_per_file.values():
+        for url, name in linkname_url(lines).items():
+            name_per_url.setdefault(url, name)
+    print('Found {} equations in {} files'.format(len(name_per_url), len(lines_per_file)))
+    svg_per_url = fetch_to_store(name_per_url, store, max_workers, make_session(max_workers, retries), server)
+
+    for path, lines in lines_per_file.items():
+        loc_per_url = {url: os.path.relpath(svg_per_url[url], path.parent).replace('\\', '/')
+                       for url in linkname_url(lines)}
+        if backup_ext:
+            backup(path, lines, backup_ext)
+        with open(path, 'w') as f:
+            for line in update_lines(lines, loc_per_url):
+                f.write(line)
+
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser(description='Replace codecogs svg links with local svg images')
-    parser.add_argument('filename', type=str, help='the markdown filename')
+    parser.add_argument('filename', type=str, help='the markdown filename, or directory with --batch')
     parser.add_argument('-b', '--backup', type=str, help='backup the original file with the given extension')
+    parser.add_argument('-j', '--jobs', type=int, default=MAX_WORKERS, help='the number of SVGs to fetch at once')
+    parser.add_argument('-r', '--retries', type=int, default=RETRIES, help='the number of retries of failed fetches')
+    parser.add_argument('--server', type=str, help='fetch from this server instead of latex.codecogs.com, e.g. a local stand-in')
+    parser.add_argument('--batch', action='store_true',
+                        help='replace links in all markdown files below the directory, sharing one store of SVGs')
+    parser.add_argument('--store', type=str, help='the directory of SVGs with --batch (default: svg in the directory)')
     args = parser.parse_args()
 
-    replace_codecogs_links(args.filename, args.backup)
+    if args.batch:
+        replace_codecogs_links_in_tree(args.filename, args.backup, args.store, args.jobs, args.retries, args.server)
+    else:
+        replace_codecogs_links(args.filename, args.backup, args.jobs, args.retries, args.server)
     #print('replace_codecogs_links({},{})'.format(args.filename, args.backup))
 
 # where the per-observation weights, ![w_i](https://latex.codecogs.com/svg.latex?w_i), could be constant or some function of the variance,